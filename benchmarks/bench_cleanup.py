@@ -0,0 +1,61 @@
+"""
+Stress Engine.cleanup() with a large engine2.json state: a deep tree of
+directories, files, lines and symlinks, postponed parent directories and
+package cleaners which are still claimed by other helpers. See
+homely._test.cleanup for how the state is generated.
+
+Three cleanups are timed: the first one after most of the tree stops being
+wanted, a second one which should change nothing, and a last one after the
+rest of the tree stops being wanted. The convergence invariants are checked
+after each of them.
+
+Run from the root of the repo with:
+
+    python -m benchmarks.bench_cleanup [DEPTH] [FANOUT] [FILES] [PACKAGES]
+"""
+import io
+import os
+import shutil
+import sys
+import tempfile
+
+
+def main(depth=4, fanout=3, files=2, packages=50):
+    tmpdir = tempfile.mkdtemp()
+    # homely reads $HOME when it is imported, and the package facts must not
+    # be written to the real one
+    os.environ['HOME'] = tmpdir
+    from homely import _ui
+    from homely._test.cleanup import (checkinvariants, forget, generate,
+                                      runcleanup)
+
+    # discard the log output so that we are only timing homely itself
+    _ui._OUTSTREAM = io.StringIO()
+    _ui._OUTSTREAM.write = len
+
+    failed = False
+    try:
+        root = os.path.join(tmpdir, 'stress')
+        os.mkdir(root)
+        state = generate(root, depth, fanout, files, packages, keepevery=3)
+        print("{} paths, {} kept, {} packages".format(
+            len(state.created), len(state.keep), len(state.packages)))
+        for name in ("partial", "repeat", "forget"):
+            if name == "forget":
+                forget(state)
+            engine, elapsed = runcleanup(state)
+            problems = checkinvariants(state, engine)
+            print("{:<8} {:>8.2f}s  {}".format(
+                name, elapsed, "ok" if not problems else
+                "{} problems".format(len(problems))))
+            for problem in problems[:10]:
+                print("    " + problem)
+            failed = failed or bool(problems)
+    finally:
+        shutil.rmtree(tmpdir)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
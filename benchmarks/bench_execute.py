@@ -0,0 +1,46 @@
+"""
+Measure how long homely.system.execute() takes to filter a large amount of
+command output through homely's logging functions.
+
+Run from the root of the repo with:
+
+    python -m benchmarks.bench_execute [MEGABYTES]
+"""
+import io
+import sys
+import time
+
+from homely import _ui
+from homely.system import execute
+
+SHAPES = [
+    # lines which include a multi-byte character, so that chunk boundaries
+    # regularly fall in the middle of a character
+    ("short lines", ("x" * 48) + "é" + ("y" * 48), 1),
+    # lines which are much longer than a single chunk of output
+    ("long lines", "z" * 1024, 8 * 1024),
+]
+
+
+def bench(megabytes, part, repeat):
+    linesize = len(part.encode('utf-8')) * repeat + 1
+    count = max(1, megabytes * 1024 * 1024 // linesize)
+    script = 'import sys\nsys.stdout.write(({!r} * {} + "\\n") * {})'.format(
+        part, repeat, count)
+    start = time.perf_counter()
+    execute([sys.executable, '-c', script])
+    return count, time.perf_counter() - start
+
+
+def main(megabytes=100):
+    # discard the log output so that we are only timing homely itself
+    _ui._OUTSTREAM = io.StringIO()
+    _ui._OUTSTREAM.write = len
+    for name, part, repeat in SHAPES:
+        count, elapsed = bench(megabytes, part, repeat)
+        print("{}: {} MB ({} lines) in {:.2f}s ({:.1f} MB/s)".format(
+            name, megabytes, count, elapsed, megabytes / elapsed))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
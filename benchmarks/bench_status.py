@@ -0,0 +1,52 @@
+"""
+Measure how long 'homely updatestatus' takes to answer, which matters because
+shell prompts run it on every render. The fast path in homely._status is
+compared against the full command line interface in homely._cli.
+
+Run from the root of the repo with:
+
+    python -m benchmarks.bench_status [RUNS]
+"""
+import subprocess
+import sys
+import time
+
+COMMANDS = [
+    ("fast path", [sys.executable, '-c',
+                   'from homely._status import entrypoint; entrypoint()',
+                   'updatestatus']),
+    ("homely._cli", [sys.executable, '-m', 'homely._cli', 'updatestatus']),
+    ("python only", [sys.executable, '-c', 'pass']),
+]
+
+
+def bench(cmd, runs):
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.call(cmd)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def importtime(module):
+    # total import time of `module` in microseconds, as measured by python
+    # itself
+    cmd = [sys.executable, '-X', 'importtime', '-c', 'import ' + module]
+    output = subprocess.run(cmd, capture_output=True, text=True).stderr
+    last = output.strip().splitlines()[-1]
+    return int(last.split('|')[1])
+
+
+def main(runs=20):
+    for name, cmd in COMMANDS:
+        print("{:<12} {:>7.1f}ms (best of {})".format(
+            name, bench(cmd, runs) * 1000, runs))
+    for module in ('homely._status', 'homely._cli'):
+        print("import {:<14} {:>7.1f}ms".format(
+            module, importtime(module) / 1000))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
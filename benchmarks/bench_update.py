@@ -0,0 +1,227 @@
+"""
+Measure how 'homely update' scales with the number of helpers in a dotfiles
+repo. For each size, a synthetic repo is generated using homely's test repo
+handler, and three updates are timed in a fresh $HOME:
+
+first
+    The first update, which creates everything.
+noop
+    A second update, where every helper is already done.
+cleanup
+    An update after the HOMELY.py script has been emptied, so that everything
+    is cleaned up.
+
+For each update the wall time and peak RSS are recorded. If strace is
+installed, the updates are repeated under strace to count the syscalls they
+make (strace slows them down too much to time them at the same time).
+
+With --inprocess, the updates are run inside the benchmark's own process
+using homely._test.system.runhomely(). This leaves out the time python takes
+to start, but the peak RSS is then the benchmark process's peak so far, and
+syscalls are not counted.
+
+Results are written as JSON, by default to
+benchmarks/results/bench_update-<VERSION>.json, so they can be compared from
+one release to the next.
+
+Run from the root of the repo with:
+
+    python -m benchmarks.bench_update [--sizes 100,1000] [--output FILE]
+                                      [--inprocess]
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+
+from homely import version
+from homely._test import contents
+from homely._test.system import HOMELY, TempRepo, _getfakeenv, runhomely
+
+SIZES = [100, 1000, 10000, 50000]
+
+# each generated HOMELY.py script uses a mix of these helpers, with 100
+# helpers in each @section
+SCRIPT = """
+from homely.files import blockinfile, lineinfile, mkdir, symlink, writefile
+from homely.general import section
+
+HELPERS = {helpers}
+PER_SECTION = 100
+# how many lines or blocks go in each file
+PER_FILE = 100
+
+mkdir('~/bench')
+for subdir in ('lines', 'blocks', 'links', 'dirs', 'written'):
+    mkdir('~/bench/' + subdir)
+
+
+def helper(i):
+    kind = i % 5
+    if kind == 0:
+        lineinfile('~/bench/lines/%d.txt' % (i // PER_FILE), 'line %d' % i)
+    elif kind == 1:
+        blockinfile('~/bench/blocks/%d.txt' % (i // PER_FILE),
+                    ['block %d' % i],
+                    prefix='# start %d' % i,
+                    suffix='# end %d' % i)
+    elif kind == 2:
+        symlink('target.txt', '~/bench/links/%d' % i)
+    elif kind == 3:
+        mkdir('~/bench/dirs/%d' % i)
+    else:
+        with writefile('~/bench/written/%d.txt' % i) as f:
+            f.write('file %d\\n' % i)
+
+
+def makesection(start):
+    def chunk():
+        for i in range(start, min(start + PER_SECTION, HELPERS)):
+            helper(i)
+    chunk.__name__ = 'chunk%d' % start
+    section(chunk)
+
+
+for start in range(0, HELPERS, PER_SECTION):
+    makesection(start)
+"""
+
+
+def _runinprocess(cmd, home):
+    start = time.perf_counter()
+    returncode, output = runhomely(cmd[3:], home)
+    elapsed = time.perf_counter() - start
+    if returncode != 0:
+        raise Exception("{} exited with {}:\n{}".format(cmd, returncode,
+                                                        output))
+    return elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _run(cmd, env):
+    # os.wait4() gives the resource usage of this one child, rather than the
+    # maximum over every child we have waited for
+    start = time.perf_counter()
+    proc = subprocess.Popen(cmd, env=env, stdout=subprocess.DEVNULL)
+    _, status, usage = os.wait4(proc.pid, 0)
+    elapsed = time.perf_counter() - start
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if proc.returncode != 0:
+        raise Exception("{} exited with {}".format(cmd, proc.returncode))
+    # ru_maxrss is in KiB on linux
+    return elapsed, usage.ru_maxrss
+
+
+def _syscalls(cmd, env, tmpdir):
+    output = os.path.join(tmpdir, 'strace.txt')
+    _run(['strace', '-f', '-c', '-o', output] + cmd, env)
+    with open(output) as f:
+        lines = f.read().splitlines()
+    # the "calls" column of the line with the totals
+    (total, ) = [line for line in lines if line.rstrip().endswith('total')]
+    return int(total.split()[3])
+
+
+def _scenarios(tmpdir, helpers, inprocess):
+    """
+    Generate a repo with `helpers` helpers, and yield the command,
+    environment and $HOME to run each scenario after preparing for it.
+    """
+    home = os.path.join(tmpdir, 'home')
+    os.mkdir(home)
+    env = _getfakeenv(home)
+    repo = TempRepo(tmpdir, 'bench-{}'.format(helpers))
+    contents(repo.remotepath + '/target.txt', 'target\n')
+
+    # register the repo while its HOMELY.py is empty, so that the first
+    # update can be timed on its own
+    contents(repo.remotepath + '/HOMELY.py', '')
+    if inprocess:
+        _runinprocess(HOMELY('add') + [repo.url], home)
+    else:
+        subprocess.check_call(HOMELY('add') + [repo.url], env=env,
+                              stdout=subprocess.DEVNULL)
+
+    update = HOMELY('update')
+    contents(repo.remotepath + '/HOMELY.py', SCRIPT.format(helpers=helpers))
+    yield "first", update, env, home
+    yield "noop", update, env, home
+    contents(repo.remotepath + '/HOMELY.py', '')
+    yield "cleanup", update, env, home
+
+
+def bench(helpers, syscalls, inprocess):
+    results = {}
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for scenario, cmd, env, home in _scenarios(tmpdir, helpers,
+                                                   inprocess):
+            if inprocess:
+                wall, maxrss = _runinprocess(cmd, home)
+            else:
+                wall, maxrss = _run(cmd, env)
+            results[scenario] = {"wall": round(wall, 4),
+                                 "maxrss_kib": maxrss,
+                                 "syscalls": None}
+    finally:
+        shutil.rmtree(tmpdir)
+
+    if syscalls:
+        tmpdir = tempfile.mkdtemp()
+        try:
+            for scenario, cmd, env, _ in _scenarios(tmpdir, helpers, False):
+                results[scenario]["syscalls"] = _syscalls(cmd, env, tmpdir)
+        finally:
+            shutil.rmtree(tmpdir)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', default=','.join(map(str, SIZES)),
+                        help="comma-separated numbers of helpers")
+    parser.add_argument('--output',
+                        default=os.path.join(
+                            os.path.dirname(__file__), 'results',
+                            'bench_update-{}.json'.format(version)),
+                        help="where to write the results")
+    parser.add_argument('--inprocess', action='store_true',
+                        help="run homely in this process, not a subprocess")
+    args = parser.parse_args()
+
+    syscalls = not args.inprocess and shutil.which('strace') is not None
+    if not syscalls and not args.inprocess:
+        print("strace is not installed - syscalls will not be counted")
+
+    results = []
+    for helpers in map(int, args.sizes.split(',')):
+        for scenario, result in bench(helpers, syscalls,
+                                      args.inprocess).items():
+            print("{:>6} helpers {:<8} {:>8.2f}s {:>8.1f} MiB {:>10}".format(
+                helpers, scenario, result["wall"],
+                result["maxrss_kib"] / 1024,
+                "-" if result["syscalls"] is None
+                else "{} syscalls".format(result["syscalls"])))
+            results.append({"helpers": helpers, "scenario": scenario,
+                            **result})
+
+    os.makedirs(os.path.dirname(args.output), exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump({
+            "homely": version,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "inprocess": args.inprocess,
+            "time": time.time(),
+            "results": results,
+        }, f, indent=2)
+        f.write('\n')
+    print("Results written to {}".format(args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,58 +1,43 @@
 # NOTE: this file is python3-only because of asyncio
 import asyncio
+import atexit
 import sys
 
+# homely's long-lived event loop. This is created the first time a subprocess
+# needs to be filtered and is kept until the engine is reset, so that many
+# calls to execute() don't each pay the cost of setting up a new event loop.
+_LOOP = None
 
-def _runasync(stdoutfilter, stderrfilter, cmd, **kwargs):
-    assert asyncio is not None
-
-    async def _runandfilter(cmd, **kwargs):
-        loop = asyncio.get_event_loop()
-
-        def factory():
-            return FilteringProtocol(asyncio.streams._DEFAULT_LIMIT, loop)
-
-        class FilteringProtocol(asyncio.subprocess.SubprocessStreamProtocol):
-            _stdout = b""
-            _stderr = b""
-
-            def pipe_data_received(self, fd, data):
-                if fd == 1:
-                    if stdoutfilter:
-                        self._stdout = stdoutfilter(self._stdout + data, False)
-                    else:
-                        self.stdout.feed_data(data)
-                elif fd == 2:
-                    if stderrfilter:
-                        self._stderr = stderrfilter(self._stderr + data, False)
-                    else:
-                        self.stderr.feed_data(data)
-                else:
-                    raise Exception("Unexpected fd %r" % fd)
-
-            def pipe_connection_lost(self, fd, exc):
-                if fd == 1:
-                    if stdoutfilter and self._stdout:
-                        stdoutfilter(self._stdout, True)
-                elif fd == 2:
-                    if stderrfilter and self._stderr:
-                        stderrfilter(self._stderr, True)
-                return super().pipe_connection_lost(fd, exc)
-
-        transport, protocol = await loop.subprocess_exec(factory,
-                                                         *cmd,
-                                                         **kwargs)
-        process = asyncio.subprocess.Process(transport, protocol, loop)
-
-        # now wait for the process to complete
-        out, err = await process.communicate()
-        return process.returncode, out, err
-
-    run_kwargs = {}
-    if sys.version_info >= (3, 13):
-        run_kwargs['loop_factory'] = asyncio.EventLoop
-
-    return asyncio.run(
-        _runandfilter(cmd, **kwargs),
-        **run_kwargs,
-    )
+
+def getloop():
+    global _LOOP
+    if _LOOP is None or _LOOP.is_closed():
+        if sys.version_info >= (3, 13):
+            _LOOP = asyncio.EventLoop()
+        else:
+            _LOOP = asyncio.new_event_loop()
+    return _LOOP
+
+
+def closeloop():
+    global _LOOP
+    if _LOOP is None:
+        return
+    loop, _LOOP = _LOOP, None
+    if loop.is_closed():
+        return
+    try:
+        loop.run_until_complete(loop.shutdown_asyncgens())
+    finally:
+        loop.close()
+
+
+atexit.register(closeloop)
+
+
+def runcoroutine(coro):
+    """
+    Run a coroutine to completion on homely's event loop, and return its
+    result.
+    """
+    return getloop().run_until_complete(coro)
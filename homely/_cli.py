@@ -1,18 +1,27 @@
 import os
 import sys
-import time
 
 from click import UsageError, argument, echo, group, option, version_option
 
 from homely import version
 from homely._errors import (ERR_NO_COMMITS, ERR_NOT_A_REPO, JsonError,
                             NotARepo, RepoHasNoCommitsError)
-from homely._ui import (PROMPT_ALWAYS, PROMPT_NEVER, addfromremote, note,
-                        run_update, setallowpull, setverbose, setwantprompt,
+from homely._events import addsink, removesink
+from homely._history import (neverdone, readhistory, regressions,
+                             slowesthelpers, slowestsections)
+from homely._profile import allocationsummary, setprofiling
+from homely._scheduler import getscheduler
+from homely._status import AUTOUPDATE_INTERVAL
+from homely._status import main as statusmain
+from homely._status import setpaused, updateblocked
+from homely._trace import TraceSink
+from homely._ui import (PROMPT_ALWAYS, PROMPT_NEVER, addfromremote,
+                        badloglevel, flushlog, head, note, run_update,
+                        setallowpull, setbuffered, setverbose, setwantprompt,
                         warn)
-from homely._utils import (FAILFILE, OUTFILE, PAUSEFILE, STATUSCODES, RepoInfo,
-                           RepoListConfig, UpdateStatus, getstatus, mkcfgdir,
-                           saveconfig)
+from homely._utils import (FAILFILE, FSYNC_FILE, OUTFILE, RepoInfo,
+                           RepoListConfig, UpdateStatus, badfsync, editrecord,
+                           getstatus, mkcfgdir, saveconfig)
 from homely._vcs import getrepohandler
 
 CMD = os.path.basename(sys.argv[0])
@@ -183,8 +192,20 @@ def forget(identifier):
         help="Only process the named sections (whole names only)")
 @option('--quick', is_flag=True,
         help="Skip every @section except those marked with quick=True")
+@option('--stats', is_flag=True,
+        help="Print a summary of the time spent running subprocesses")
+@option('--trace', metavar="FILE",
+        help="Write a timeline of the update to FILE which can be opened in"
+        " Perfetto or chrome://tracing")
+@option('--profile', metavar="DIR",
+        help="Profile each HOMELY.py script and @section, and write the"
+        " results to a .prof file for each one in DIR")
+@option('--profile-memory', is_flag=True,
+        help="Print which lines of each HOMELY.py script and @section"
+        " allocated the most memory")
 @_globals
-def update(identifiers, nopull, only, quick):
+def update(identifiers, nopull, only, quick, stats, trace, profile,
+           profile_memory):
     '''
     Performs a `git pull` in each of the repositories registered with
     `homely add`, runs all of their HOMELY.py scripts, and then performs
@@ -203,6 +224,18 @@ def update(identifiers, nopull, only, quick):
     HOMELY.py script - the --nopull option stops you from wasting time checking
     the internet for the same updates on every run, and the --only option
     allows you to execute only the section you are working on.
+
+    The --stats option prints how many subprocesses of each kind (git,
+    network, package-manager, compile, other) were run, and how much wall
+    time, CPU time and memory they used.
+
+    The --trace option writes a timeline showing how long each repo, section,
+    helper, cleaner and subprocess took, in Chrome's Trace Event Format.
+
+    The --profile option runs each HOMELY.py script and @section under
+    cProfile and writes a .prof file for each of them, which can be read using
+    python's pstats module or tools such as snakeviz. The --profile-memory
+    option prints the lines which allocated the most memory in each of them.
     '''
     mkcfgdir()
     setallowpull(not nopull)
@@ -221,15 +254,64 @@ def update(identifiers, nopull, only, quick):
     else:
         updatelist = list(cfg.find_all())
         cleanup = True
-    success = run_update(updatelist,
-                         pullfirst=not nopull,
-                         only=only,
-                         quick=quick,
-                         cancleanup=cleanup and not quick)
+    if trace:
+        tracer = TraceSink(trace)
+        addsink(tracer)
+    setprofiling(profile, profile_memory)
+    try:
+        success = run_update(updatelist,
+                             pullfirst=not nopull,
+                             only=only,
+                             quick=quick,
+                             cancleanup=cleanup and not quick)
+    finally:
+        if trace:
+            removesink(tracer)
+            tracer.close()
+    if profile_memory:
+        with head("Memory allocations"):
+            for line in allocationsummary():
+                note(line)
+    if stats:
+        with head("Subprocess statistics"):
+            for line in getscheduler().summary():
+                note(line)
     if not success:
         sys.exit(1)
 
 
+@homely.command()
+@option('--count', default=10, show_default=True, metavar="N",
+        help="How many of the slowest sections and helpers to show")
+@_globals
+def stats(count):
+    """
+    Shows where recent 'homely update' runs spent their time: the slowest
+    sections and helpers, helpers that had to make changes in every run
+    instead of being "Already done", and anything that took much longer in
+    the most recent run than the median of the runs before it.
+    """
+    history = readhistory()
+    if not history:
+        raise Fatal("No updates have been recorded yet")
+
+    with head("Slowest sections (median of {} runs)".format(len(history))):
+        for section, duration in slowestsections(history, count):
+            note("{:8.2f}s  {}".format(duration, section))
+
+    with head("Slowest helpers"):
+        for helper, duration in slowesthelpers(history, count):
+            note("{:8.2f}s  {}".format(duration, helper))
+
+    with head('Helpers which are never "Already done"'):
+        for helper, runs in neverdone(history):
+            note("{} ({} runs)".format(helper, runs))
+
+    with head("Regressions in the most recent run"):
+        for name, duration, median in regressions(history):
+            note("{}: {:.2f}s (median {:.2f}s)".format(name, duration, median))
+
+
 @homely.command()
 @option('--pause', is_flag=True,
         help="Pause automatic updates. This can be useful while you are"
@@ -244,9 +326,13 @@ def update(identifiers, nopull, only, quick):
 @option('--clear', is_flag=True,
         help="Clear any previous update error so that autoupdate can initiate"
         " updates again.")
+@option('--listen', is_flag=True,
+        help="Starts a daemon process which keeps running and starts a"
+        " 'homely update' whenever one is due, and lets shell prompts query"
+        " the status and request updates using a unix socket")
 @_globals
 def autoupdate(**kwargs):
-    options = ('pause', 'unpause', 'outfile', 'daemon', 'clear')
+    options = ('pause', 'unpause', 'outfile', 'daemon', 'clear', 'listen')
     action = None
     for name in options:
         if kwargs[name]:
@@ -261,43 +347,52 @@ def autoupdate(**kwargs):
 
     mkcfgdir()
     if action == "pause":
-        with open(PAUSEFILE, 'w'):
-            pass
+        setpaused(True)
         return
 
     if action == "unpause":
-        if os.path.exists(PAUSEFILE):
-            os.unlink(PAUSEFILE)
+        setpaused(False)
         return
 
     if action == "clear":
-        if os.path.exists(FAILFILE):
-            os.unlink(FAILFILE)
+        with editrecord() as record:
+            if record["time"] is None:
+                record["state"] = UpdateStatus.NEVER.value
+            else:
+                record["state"] = UpdateStatus.OK.value
+            if os.path.exists(FAILFILE):
+                os.unlink(FAILFILE)
         return
 
     if action == "outfile":
         print(OUTFILE)
         return
 
+    if action == "listen":
+        from homely._control import ControlServer, request
+        if request("ping") is not None:
+            print("Can't start daemon - another daemon is already listening")
+            sys.exit(1)
+
+        import daemon  # type: ignore
+
+        from homely._utils import _getumask
+
+        # DaemonContext() would otherwise clear the umask, which would let
+        # other users connect to the socket until it is chmod()ed, and give
+        # updates started by the daemon world-writable files
+        with daemon.DaemonContext(detach_process=True, umask=_getumask()):
+            ControlServer(interval=AUTOUPDATE_INTERVAL).serve_forever()
+        return
+
     # is an update necessary?
     assert action == "daemon"
 
     # check if we're allowed to start an update
     status, mtime, _ = getstatus()
-    if status == UpdateStatus.FAILED:
-        print("Can't start daemon - previous update failed")
-        sys.exit(1)
-    if status == UpdateStatus.PAUSED:
-        print("Can't start daemon - updates are paused")
-        sys.exit(1)
-    if status == UpdateStatus.RUNNING:
-        print("Can't start daemon - an update is already running")
-        sys.exit(1)
-
-    # abort the update if it hasn't been long enough
-    interval = 20 * 60 * 60
-    if mtime is not None and (time.time() - mtime) < interval:
-        print("Can't start daemon - too soon to start another update")
+    reason = updateblocked(status, mtime)
+    if reason is not None:
+        print("Can't start daemon - " + reason)
         sys.exit(1)
 
     assert status in (UpdateStatus.OK,
@@ -329,8 +424,11 @@ def autoupdate(**kwargs):
 
 
 @homely.command()
+@option('--progress', is_flag=True,
+        help="If an update is running, print the section it is up to and when"
+        " it is expected to finish")
 @_globals
-def updatestatus():
+def updatestatus(progress):
     """
     Returns an exit code indicating the state of the current or previous
     'homely update' process. The exit code will be one of the following:
@@ -341,17 +439,32 @@ def updatestatus():
       5  ..  The most recent update raised Warnings or failed altogether.
       1  ..  (An unexpected error occurred trying to get the status.)
     """
-    status = getstatus()[0]
-    sys.exit(STATUSCODES[status])
-
-
-def main():
+    statusmain(progress=progress)
+
+
+def main(args=None):
+    # log messages are written in the background while homely keeps working
+    setbuffered(True)
+    # a bad environment variable mustn't stop homely from working, so it is
+    # only reported. This isn't a warn() because it mustn't count as an
+    # update warning.
+    badenv = [
+        ("HOMELY_LOGLEVEL", badloglevel(), "note"),
+        ("HOMELY_FSYNC", badfsync(), FSYNC_FILE),
+    ]
+    for name, value, default in badenv:
+        if value is not None:
+            echo("WARNING: Invalid ${} {!r}, using {!r}".format(
+                name, value, default), err=True)
     try:
         # FIXME: always ensure git is installed first
-        homely()
+        homely(args)
     except (Fatal, JsonError) as err:
+        flushlog()
         echo("ERROR: %s" % err, err=True)
         sys.exit(1)
+    finally:
+        flushlog()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,288 @@
+"""
+A unix socket which lets shell prompts talk to the 'homely autoupdate
+--listen' daemon instead of polling ~/.homely and starting updates themselves.
+
+Clients send one JSON object per line and receive one JSON object per line in
+reply. The requests are:
+
+{"op": "status"}
+    Reply with the current status record.
+{"op": "subscribe"}
+    Reply with the current status record, and again every time it changes,
+    until the client disconnects.
+{"op": "update"}
+    Start an update unless one is already running or autoupdate is paused or
+    blocked by a failed update. Requests from several clients result in a
+    single update.
+{"op": "pause"}, {"op": "unpause"}
+    The same as 'homely autoupdate --pause' and 'homely autoupdate --unpause'.
+{"op": "shutdown"}
+    Stop the daemon.
+
+This module must only import from the standard library, the same as
+homely._status.
+"""
+import json
+import os
+import socket
+import socketserver
+import subprocess
+import sys
+import threading
+from io import BufferedIOBase
+from os.path import join
+from typing import Any, Iterator, Optional, Sequence
+
+from homely._status import (OUTFILE, ROOT, STATUSFILE, readrecord,
+                            recordstatus, setpaused, updateblocked)
+
+SOCKETPATH = join(ROOT, "control.sock")
+
+# how often the daemon checks the status record for changes, in seconds
+POLL_INTERVAL = 0.25
+
+# how long clients wait for the daemon to answer, in seconds
+CLIENT_TIMEOUT = 2.0
+
+# how long the daemon waits for a subscriber to read what it is sent before
+# giving up on it, in seconds
+SEND_TIMEOUT = 5.0
+
+UPDATE_CMD = [sys.executable, '-m', 'homely._cli', 'update', '--neverprompt']
+
+
+def _statusreply(record: dict) -> dict:
+    status, timestamp, section = recordstatus(record)
+    return {
+        "status": status.value,
+        "time": timestamp,
+        "section": section,
+        "record": record,
+    }
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    server: "_Server"
+
+    def handle(self) -> None:
+        control = self.server.control
+        for line in self.rfile:
+            try:
+                msg = json.loads(line)
+                op = msg["op"]
+            except (ValueError, KeyError, TypeError):
+                self._reply({"error": "invalid request"})
+                continue
+            if op == "subscribe":
+                # a subscriber which stops reading mustn't hold up the others
+                self.connection.settimeout(SEND_TIMEOUT)
+                control._subscribe(self.wfile)
+                return
+            self._reply(control._handle(op))
+
+    def _reply(self, msg: dict) -> None:
+        self.wfile.write(json.dumps(msg).encode('utf-8') + b"\n")
+        self.wfile.flush()
+
+
+class _Server(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+    control: "ControlServer"
+
+
+class ControlServer:
+    """
+    Answers requests on `path` and watches the status record, starting
+    `command` to perform each update. If `interval` isn't None, updates are
+    also started once `interval` seconds have passed since the last one.
+    """
+
+    def __init__(
+        self,
+        path: str = SOCKETPATH,
+        command: Sequence[str] = UPDATE_CMD,
+        interval: Optional[float] = None,
+        pollinterval: float = POLL_INTERVAL,
+    ) -> None:
+        self._path = path
+        self._command = list(command)
+        self._interval = interval
+        self._pollinterval = pollinterval
+        self._lock = threading.Lock()
+        # held while writing to subscribers, so that they receive updates in
+        # order without holding up anything which only needs self._lock
+        self._sendlock = threading.Lock()
+        self._child: Optional[subprocess.Popen] = None
+        self._subscribers: list[tuple[BufferedIOBase, threading.Event]] = []
+        self._stopping = threading.Event()
+        self._record = readrecord()
+        self._recordid: Any = None
+
+        # a socket left behind by a daemon that died can be replaced, but not
+        # one that somebody is still listening on
+        if os.path.exists(path):
+            if request("ping", path) is not None:
+                raise OSError("Another daemon is listening on %s" % path)
+            os.unlink(path)
+        self._server = _Server(path, _Handler)
+        self._server.control = self
+        # anybody who can connect can start updates and stop the daemon
+        os.chmod(path, 0o600)
+
+    def _handle(self, op: str) -> dict:
+        if op == "ping":
+            return {"ok": True}
+        if op == "status":
+            self._checkrecord()
+            return _statusreply(self._record)
+        if op == "update":
+            started, reason = self.startupdate(0)
+            return {"ok": started, "reason": reason}
+        if op in ("pause", "unpause"):
+            setpaused(op == "pause")
+            self._checkrecord()
+            return {"ok": True}
+        if op == "shutdown":
+            self._stopping.set()
+            threading.Thread(target=self._server.shutdown, daemon=True).start()
+            return {"ok": True}
+        return {"error": "unknown request %r" % op}
+
+    def _subscribe(self, wfile: BufferedIOBase) -> None:
+        # the handler thread sits here until the client goes away, so that
+        # _broadcast() can write to wfile from the watcher thread
+        gone = threading.Event()
+        with self._sendlock:
+            with self._lock:
+                self._subscribers.append((wfile, gone))
+                record = self._record
+            self._send(wfile, gone, _statusreply(record))
+        while not (gone.wait(1) or self._stopping.is_set()):
+            pass
+        with self._lock:
+            self._subscribers.remove((wfile, gone))
+
+    @staticmethod
+    def _send(wfile: BufferedIOBase, gone: threading.Event, msg: dict) -> None:
+        try:
+            wfile.write(json.dumps(msg).encode('utf-8') + b"\n")
+            wfile.flush()
+        except OSError:
+            gone.set()
+
+    def _broadcast(self, msg: dict) -> None:
+        with self._sendlock:
+            with self._lock:
+                subscribers = list(self._subscribers)
+            for wfile, gone in subscribers:
+                if not gone.is_set():
+                    self._send(wfile, gone, msg)
+
+    def _checkrecord(self) -> None:
+        # look at the status record and tell subscribers if it has changed
+        try:
+            st = os.stat(STATUSFILE)
+            recordid: Any = (st.st_ino, st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            recordid = None
+        with self._lock:
+            if recordid == self._recordid and recordid is not None:
+                return
+            self._recordid = recordid
+            record = readrecord()
+            if record == self._record:
+                return
+            self._record = record
+        self._broadcast(_statusreply(record))
+
+    def startupdate(self, interval: Optional[float]) -> tuple[bool, str | None]:
+        """
+        Start an update if one is allowed. Returns (started, reason) where
+        `reason` explains why an update wasn't started.
+        """
+        with self._lock:
+            if self._child is not None and self._child.poll() is None:
+                return False, "an update is already running"
+            status, mtime, _ = recordstatus(readrecord())
+            reason = updateblocked(status, mtime, interval or 0)
+            if reason is not None:
+                return False, reason
+            with open(OUTFILE, 'w') as outfile:
+                self._child = subprocess.Popen(self._command,
+                                               stdin=subprocess.DEVNULL,
+                                               stdout=outfile,
+                                               stderr=subprocess.STDOUT)
+            return True, None
+
+    def _watch(self) -> None:
+        while not self._stopping.wait(self._pollinterval):
+            self._checkrecord()
+            with self._lock:
+                if self._child is not None and self._child.poll() is not None:
+                    self._child = None
+            if self._interval is not None:
+                self.startupdate(self._interval)
+
+    def serve_forever(self) -> None:
+        watcher = threading.Thread(target=self._watch, daemon=True)
+        watcher.start()
+        try:
+            self._server.serve_forever()
+        finally:
+            self._stopping.set()
+            watcher.join()
+            self._server.server_close()
+            try:
+                os.unlink(self._path)
+            except FileNotFoundError:
+                pass
+            if self._child is not None:
+                self._child.wait()
+
+
+def _connect(path: str, timeout: Optional[float]) -> socket.socket:
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def request(op: str,
+            path: str = SOCKETPATH,
+            timeout: float = CLIENT_TIMEOUT) -> Optional[dict]:
+    """
+    Send a request to the daemon and return its reply, or None if no daemon
+    is listening.
+    """
+    try:
+        with _connect(path, timeout) as sock:
+            sock.sendall(json.dumps({"op": op}).encode('utf-8') + b"\n")
+            with sock.makefile('rb') as f:
+                line = f.readline()
+    except OSError:
+        return None
+    if not line:
+        return None
+    return json.loads(line)
+
+
+def subscribe(path: str = SOCKETPATH) -> Iterator[dict]:
+    """
+    Yield the status from the daemon each time it changes, starting with the
+    current status. Yields nothing if no daemon is listening, and stops when
+    the daemon exits.
+    """
+    try:
+        sock = _connect(path, CLIENT_TIMEOUT)
+    except OSError:
+        return
+    with sock:
+        sock.sendall(b'{"op": "subscribe"}\n')
+        sock.settimeout(None)
+        with sock.makefile('rb') as f:
+            for line in f:
+                yield json.loads(line)
@@ -2,17 +2,30 @@ import json
 import os
 from typing import Optional
 
+from homely._asyncioutils import closeloop
 from homely._errors import CleanupConflict, CleanupObstruction, HelperError
-from homely._ui import note, warn
+from homely._events import span
+from homely._hooks import lifecycle
+from homely._privileged import closeworker
+from homely._ui import helperstarted, note, warn
 from homely._utils import (ENGINE2_CONFIG_PATH, FactConfig, RepoInfo,
-                           isnecessarypath)
+                           commitedits, forgetparsed, isnecessarypath)
 
 _ENGINE: "Optional[Engine]" = None
 _REPO: Optional[RepoInfo] = None
 
+# every Helper, Cleaner and Engine shares the same facts, which are only
+# written to facts.json by commitfacts() rather than every time one changes
+_FACTS: Optional[FactConfig] = None
+_FACTS_CHANGED = False
+
 
 def initengine(quick: bool) -> "Engine":
-    global _ENGINE
+    global _ENGINE, _FACTS
+    forgetparsed()
+    # read the facts again in case something else has changed them
+    commitfacts()
+    _FACTS = None
     _ENGINE = Engine(ENGINE2_CONFIG_PATH, quick=quick)
     return _ENGINE
 
@@ -20,6 +33,10 @@ def initengine(quick: bool) -> "Engine":
 def resetengine() -> None:
     global _ENGINE
     _ENGINE = None
+    commitfacts()
+    forgetparsed()
+    closeloop()
+    closeworker()
 
 
 def getengine() -> "Engine":
@@ -41,31 +58,45 @@ def _exists(path):
     return os.path.exists(path) or os.path.islink(path)
 
 
-class _AccessibleFacts:
-    _facts = None
+def _getfacts() -> FactConfig:
+    global _FACTS
+    if _FACTS is None:
+        _FACTS = FactConfig()
+    return _FACTS
+
+
+def commitfacts() -> None:
+    """
+    Write the facts to facts.json if any of them have changed.
+    """
+    global _FACTS_CHANGED
+    if _FACTS is not None and _FACTS_CHANGED:
+        _FACTS.writejson()
+        _FACTS_CHANGED = False
+
 
+class _AccessibleFacts:
     def _setfact(self, name, value):
-        if self._facts is None:
-            self._facts = FactConfig()
-        self._facts.jsondata[name] = value
-        self._facts.writejson()
+        global _FACTS_CHANGED
+        _getfacts().jsondata[name] = value
+        _FACTS_CHANGED = True
 
     def _clearfact(self, name):
-        if self._facts is None:
-            self._facts = FactConfig()
-        self._facts.jsondata.pop(name, None)
-        self._facts.writejson()
+        global _FACTS_CHANGED
+        if _getfacts().jsondata.pop(name, None) is not None:
+            _FACTS_CHANGED = True
 
     def _getfact(self, name, *args):
-        if self._facts is None:
-            self._facts = FactConfig()
         if len(args):
-            return self._facts.jsondata.get(name, *args)
-        return self._facts.jsondata[name]
+            return _getfacts().jsondata.get(name, *args)
+        return _getfacts().jsondata[name]
 
 
 class Helper(_AccessibleFacts):
-    _facts = None
+    # set this to True if the helper's isdone() and makechanges() only use
+    # homely._utils.readtext() and modifytext() to access the files they
+    # change, so that the Engine can let them take part in batchedits()
+    batchable = False
 
     def getcleaner(self):
         """
@@ -290,11 +321,16 @@ class Engine(_AccessibleFacts):
 
     def run(self, helper):
         assert isinstance(helper, Helper)
+        helperstarted()
+
+        # other helpers need to see any changes being held by batchedits()
+        if not helper.batchable:
+            commitedits()
 
         cfg_modified = False
 
         # what claims does this helper make?
-        self._claims.update(*helper.getclaims())
+        self._claims.update(helper.getclaims())
 
         # take ownership of paths
         for path, type_ in helper.pathsownable().items():
@@ -305,7 +341,11 @@ class Engine(_AccessibleFacts):
         # get a cleaner for this helper
         cleaner = helper.getcleaner()
 
-        if helper.isdone():
+        with span("helper.isdone", helper=helper.description) as result, \
+                lifecycle("isdone", helper, helper.description) as hook:
+            isdone = result["done"] = hook.outcome = helper.isdone()
+
+        if isdone:
             # if there is already a cleaner for this thing, add and remove it
             # so it hangs around. If there is no cleaner but the thing is
             # already done, it means we shouldn't be cleaning it up
@@ -342,7 +382,12 @@ class Engine(_AccessibleFacts):
                     cfg_modified = False
 
                 try:
-                    helper.makechanges()
+                    with span("helper.makechanges",
+                              helper=helper.description), \
+                            lifecycle("makechanges", helper,
+                                      helper.description) as hook:
+                        helper.makechanges()
+                        hook.outcome = True
                 except HelperError as err:
                     warn("Failed: %s" % err.args[0])
         self._helpers.append(helper)
@@ -354,6 +399,7 @@ class Engine(_AccessibleFacts):
 
     def cleanup(self, conflicts):
         assert conflicts in (self.RAISE, self.WARN, self.POSTPONE, self.ASK)
+        commitedits()
         note("CLEANING UP %d items ..." % (
             len(self._old_cleaners) + len(self._created)))
         stack = list(self._old_cleaners)
@@ -363,7 +409,11 @@ class Engine(_AccessibleFacts):
             for cleaner in stack:
                 # TODO: do we still need this complexity?
                 self._removecleaner(cleaner)
-                self._tryclean(cleaner, conflicts, affected)
+                with span("cleaner", cleaner=cleaner.description) as result, \
+                        lifecycle("cleaner", cleaner,
+                                  cleaner.description) as hook:
+                    result["outcome"] = hook.outcome = self._tryclean(
+                        cleaner, conflicts, affected)
                 self._savecfg()
 
             assert len(deferred) < len(stack), "Every cleaner wants to go last"
@@ -388,6 +438,8 @@ class Engine(_AccessibleFacts):
             if len(self._old_paths_owned) >= before:
                 raise Exception("All paths want to delay cleaning")
 
+        commitfacts()
+
     def pathstoclean(self):
         ret = {}
         for path, type_ in self._old_paths_owned.items():
@@ -399,11 +451,13 @@ class Engine(_AccessibleFacts):
         return ret
 
     def _tryclean(self, cleaner, conflicts, affected):
+        # returns "notneeded", "postponed", "cleaned" or "aborted"
+
         # if the cleaner is not needed, we get rid of it
         # FIXME try/except around the isneeded() call
         if not cleaner.isneeded():
             note("{}: Not needed".format(cleaner.description))
-            return
+            return "notneeded"
 
         # run the cleaner now
         with note("Cleaning: {}".format(cleaner.description)):
@@ -413,7 +467,7 @@ class Engine(_AccessibleFacts):
                 if claim in self._claims:
                     note("Postponed: Something else claimed %r" % claim)
                     self._addcleaner(cleaner)
-                    return
+                    return "postponed"
 
             try:
                 affected.extend(cleaner.makechanges())
@@ -425,11 +479,13 @@ class Engine(_AccessibleFacts):
                     note("Postponed: %s" % why)
                     # add the cleaner back in
                     self._addcleaner(cleaner)
-                    return
+                    return "postponed"
                 # NOTE: eventually we'd like to ask the user what to do, but
                 # for now we just issue a warning
                 assert conflicts in (self.WARN, self.ASK)
                 warn("Aborted: %s" % err.why)
+                return "aborted"
+        return "cleaned"
 
     def _trycleanpath(self, path, type_, conflicts):
         def _discard():
@@ -52,6 +52,20 @@ class SystemError(Exception):
     """
 
 
+class CommandTimeout(SystemError):
+    """
+    Raised by the homely._utils.run() function when a subprocess is still
+    running after its timeout has expired. The subprocess will have been
+    killed.
+    """
+    def __init__(self, cmd, timeout):
+        super(CommandTimeout, self).__init__(
+            "{} timed out after {} seconds".format(" ".join(map(str, cmd)),
+                                                   timeout))
+        self.cmd = cmd
+        self.timeout = timeout
+
+
 class ConnectionError(Exception):
     """
     Raised when a remote resource such as git repo or download URL are not
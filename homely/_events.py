@@ -0,0 +1,98 @@
+"""
+Structured events describing what 'homely update' is doing, for tools which
+would otherwise have to parse homely's log output.
+
+Every event is a dict with the "event" name, the wall clock time "ts" it was
+emitted and any other fields that describe it. Work which takes time is
+described by a pair of events such as "section.start" and "section.end",
+which share the same "span" id. The ".end" event also has the "duration" of
+the work in seconds, its "error" if an exception was raised, and any
+results.
+
+During 'homely update' the events of the current run are written to
+EVENTFILE, one JSON object per line. Other consumers can receive the events
+in-process using addsink().
+"""
+import itertools
+import json
+import threading
+import time
+from contextlib import contextmanager
+from os.path import join
+from typing import Any, Callable, Iterator
+
+from homely._status import ROOT
+
+# the events from the most recent 'homely update'
+EVENTFILE = join(ROOT, "update-events.jsonl")
+
+Sink = Callable[[dict], None]
+
+_SINKS: list[Sink] = []
+_SPANIDS = itertools.count(1)
+
+
+def addsink(sink: Sink) -> None:
+    """
+    Call `sink` with each event from now on.
+    """
+    _SINKS.append(sink)
+
+
+def removesink(sink: Sink) -> None:
+    _SINKS.remove(sink)
+
+
+def emit(event: str, **fields: Any) -> None:
+    if not _SINKS:
+        return
+    record = {"event": event, "ts": time.time(), **fields}
+    for sink in list(_SINKS):
+        sink(record)
+
+
+@contextmanager
+def span(kind: str, **fields: Any) -> Iterator[dict]:
+    """
+    Emit "<kind>.start" and "<kind>.end" events around a block of code. The
+    block can add results to the dict it is given, and these are included in
+    the "<kind>.end" event.
+    """
+    results: dict[str, Any] = {}
+    if not _SINKS:
+        yield results
+        return
+    spanid = next(_SPANIDS)
+    emit(kind + ".start", span=spanid, **fields)
+    started = time.perf_counter()
+    try:
+        yield results
+    except BaseException as err:
+        results.setdefault("error", repr(err))
+        raise
+    finally:
+        emit(kind + ".end", **{
+            **fields,
+            **results,
+            "span": spanid,
+            "duration": time.perf_counter() - started,
+        })
+
+
+class JsonLinesSink:
+    """
+    A sink which writes each event to `path` as a line of JSON.
+    """
+
+    def __init__(self, path: str) -> None:
+        self._lock = threading.Lock()
+        self._file = open(path, 'w')
+
+    def __call__(self, record: dict) -> None:
+        line = json.dumps(record, default=str)
+        with self._lock:
+            self._file.write(line + "\n")
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
@@ -0,0 +1,240 @@
+"""
+A history of recent 'homely update' runs, used by 'homely stats' to show
+where updates spend their time and how that changes from run to run.
+
+Each run is stored as one line of JSON in HISTORYFILE, and only the most
+recent HISTORY_SIZE runs are kept.
+"""
+import json
+import os
+import statistics
+import threading
+import time
+from os.path import join
+from typing import Any
+
+from homely._status import ROOT
+
+HISTORYFILE = join(ROOT, "update-history.jsonl")
+DEFAULT_HISTORY_SIZE = 50
+
+# how many of the slowest helpers, and of the helpers which weren't done, are
+# kept for each run. Keeping every helper would make the history of a large
+# repo huge, and it is rewritten after every update.
+HISTORY_HELPERS = 50
+
+# a section or run is a regression when it takes this many times longer than
+# its median, and at least REGRESSION_MINIMUM seconds longer
+REGRESSION_FACTOR = 1.5
+REGRESSION_MINIMUM = 0.1
+
+Record = dict[str, Any]
+
+
+def _historysize() -> int:
+    # a bad $HOMELY_HISTORY_SIZE mustn't stop homely from working, and at
+    # least the current run is always kept
+    try:
+        size = int(os.environ.get("HOMELY_HISTORY_SIZE", DEFAULT_HISTORY_SIZE))
+    except ValueError:
+        return DEFAULT_HISTORY_SIZE
+    return max(size, 1)
+
+
+HISTORY_SIZE = _historysize()
+
+
+def _round(duration: float) -> float:
+    return round(duration, 4)
+
+
+class HistorySink:
+    """
+    An event sink which builds the history record for one update.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        # description => [seconds spent in isdone() and makechanges(),
+        #                 whether isdone() returned True]
+        self._helpers: dict[str, list] = {}
+        self.record: Record = {
+            "time": time.time(),
+            "duration": None,
+            "result": None,
+            "full": False,
+            "sections": {},
+            # [description, seconds] of the slowest helpers, slowest first
+            "slowest": [],
+            # descriptions of the helpers which had to make changes, slowest
+            # first
+            "notdone": [],
+            # category => number of subprocesses
+            "processes": {},
+        }
+
+    def __call__(self, event: dict) -> None:
+        name = event["event"]
+        record = self.record
+        with self._lock:
+            if name == "run.start":
+                record["full"] = event["full"]
+            elif name == "run.end":
+                record["duration"] = _round(event["duration"])
+                record["result"] = event["result"]
+            elif name == "section.end":
+                sections = record["sections"]
+                section = event["section"]
+                sections[section] = _round(
+                    sections.get(section, 0) + event["duration"])
+            elif name in ("helper.isdone.end", "helper.makechanges.end"):
+                helper = self._helpers.setdefault(event["helper"], [0, False])
+                helper[0] = _round(helper[0] + event["duration"])
+                if event.get("done"):
+                    helper[1] = True
+            elif name == "process.start":
+                processes = record["processes"]
+                category = event["category"]
+                processes[category] = processes.get(category, 0) + 1
+
+    def finish(self) -> Record:
+        """
+        Add the slowest helpers and the ones which weren't done to the
+        record, and return it.
+        """
+        with self._lock:
+            helpers = sorted(self._helpers.items(),
+                             key=lambda item: item[1][0],
+                             reverse=True)
+            self.record["slowest"] = [
+                [helper, duration]
+                for helper, (duration, _) in helpers[:HISTORY_HELPERS]]
+            self.record["notdone"] = [
+                helper for helper, (_, done) in helpers
+                if not done][:HISTORY_HELPERS]
+            return self.record
+
+
+def readhistory(path: str = HISTORYFILE) -> list[Record]:
+    """
+    Return the stored runs, oldest first.
+    """
+    try:
+        with open(path) as f:
+            lines = f.readlines()
+    except FileNotFoundError:
+        return []
+    history = []
+    for line in lines:
+        try:
+            history.append(json.loads(line))
+        except ValueError:
+            # a damaged line only loses that one run
+            continue
+    return history
+
+
+def saverun(record: Record,
+            path: str = HISTORYFILE,
+            limit: int = HISTORY_SIZE) -> None:
+    """
+    Add `record` to the history, and forget the oldest runs so that only
+    `limit` are kept.
+    """
+    history = readhistory(path)
+    history.append(record)
+    # history[-0:] would be the whole list
+    kept = history[-limit:] if limit > 0 else []
+    lines = [json.dumps(r, separators=(',', ':'), default=str) + "\n"
+             for r in kept]
+    with open(path + ".new", 'w') as f:
+        f.writelines(lines)
+    os.replace(path + ".new", path)
+
+
+def slowestsections(history: list[Record],
+                    count: int) -> list[tuple[str, float]]:
+    """
+    Return the `count` sections with the longest median duration.
+    """
+    durations: dict[str, list[float]] = {}
+    for record in history:
+        for section, duration in record["sections"].items():
+            durations.setdefault(section, []).append(duration)
+    medians = [(section, statistics.median(values))
+               for section, values in durations.items()]
+    medians.sort(key=lambda pair: pair[1], reverse=True)
+    return medians[:count]
+
+
+def slowesthelpers(history: list[Record],
+                   count: int) -> list[tuple[str, float]]:
+    """
+    Return the `count` helpers with the longest median duration, out of the
+    runs where they were among the slowest.
+    """
+    durations: dict[str, list[float]] = {}
+    for record in history:
+        for helper, duration in record["slowest"]:
+            durations.setdefault(helper, []).append(duration)
+    medians = [(helper, statistics.median(values))
+               for helper, values in durations.items()]
+    medians.sort(key=lambda pair: pair[1], reverse=True)
+    return medians[:count]
+
+
+def neverdone(history: list[Record]) -> list[tuple[str, int]]:
+    """
+    Return the helpers which had to make changes in the most recent run and
+    in the runs just before it, along with the number of runs in a row, when
+    that is more than one. These are usually helpers whose isdone() is wrong,
+    or changes which are being undone by something else between updates.
+    """
+    if not history:
+        return []
+    notdone = [set(record["notdone"]) for record in history]
+    found = []
+    for helper in notdone[-1]:
+        runs = 0
+        for helpers in reversed(notdone):
+            if helper not in helpers:
+                break
+            runs += 1
+        if runs > 1:
+            found.append((helper, runs))
+    return sorted(found)
+
+
+def _isregression(duration: float, median: float) -> bool:
+    return (duration > median * REGRESSION_FACTOR
+            and duration - median >= REGRESSION_MINIMUM)
+
+
+def regressions(history: list[Record]) -> list[tuple[str, float, float]]:
+    """
+    Compare the most recent run with the median of the runs before it, and
+    return the name, duration and median duration of the whole run and of
+    each section that took much longer than usual.
+    """
+    if len(history) < 2:
+        return []
+    *previous, last = history
+    found = []
+
+    if last["duration"] is not None:
+        # only compare runs of the same kind
+        totals = [r["duration"] for r in previous
+                  if r["full"] == last["full"] and r["duration"] is not None]
+        if totals:
+            median = statistics.median(totals)
+            if _isregression(last["duration"], median):
+                found.append(("<update>", last["duration"], median))
+
+    for section, duration in last["sections"].items():
+        values = [r["sections"][section] for r in previous
+                  if section in r["sections"]]
+        if values:
+            median = statistics.median(values)
+            if _isregression(duration, median):
+                found.append((section, duration, median))
+    return found
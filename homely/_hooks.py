@@ -0,0 +1,180 @@
+"""
+Lifecycle hooks for plugins which want to time, measure or police what
+helpers and cleaners do, without subclassing or monkeypatching the engine.
+
+A plugin is any object with one or more of these methods, each of which is
+called with a HookEvent:
+
+before_isdone, after_isdone
+    Around each call to a helper's isdone(). The "after" event's outcome is
+    the value returned by isdone().
+before_makechanges, after_makechanges
+    Around each call to a helper's makechanges(). The "after" event's outcome
+    is True, or the exception that was raised.
+cleaner_start, cleaner_finish
+    Around each cleaner. The "finish" event's outcome is one of "cleaned",
+    "postponed", "notneeded" or "aborted".
+
+Plugins can be registered using register(), by an installed package using an
+entry point in the "homely.hooks" group, or by a dotfiles repo in its
+pyproject.toml:
+
+    [tool.homely]
+    hooks = ["mymodule:MyPlugin"]
+
+When a plugin is a class, an instance of it is registered.
+"""
+import importlib
+import sys
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from types import TracebackType
+from typing import Any, Callable, Optional
+
+from homely._utils import loadtoml
+
+ENTRY_POINT_GROUP = "homely.hooks"
+
+# the before/after method names for each stage
+_STAGES = {
+    "isdone": ("before_isdone", "after_isdone"),
+    "makechanges": ("before_makechanges", "after_makechanges"),
+    "cleaner": ("cleaner_start", "cleaner_finish"),
+}
+HOOKNAMES = tuple(name for pair in _STAGES.values() for name in pair)
+
+
+@dataclass
+class HookEvent:
+    hook: str
+    # the Helper or Cleaner
+    subject: Any
+    description: str
+    # how long the stage took in seconds, for "after" events
+    duration: Optional[float] = None
+    outcome: Any = None
+
+
+Hook = Callable[[HookEvent], None]
+
+_HOOKS: dict[str, list[Hook]] = {name: [] for name in HOOKNAMES}
+_PLUGINS: list[Any] = []
+# plugins which have been loaded already, by entry point name or spec
+_LOADED: set[str] = set()
+
+
+def register(plugin: Any) -> None:
+    _PLUGINS.append(plugin)
+    for name in HOOKNAMES:
+        method = getattr(plugin, name, None)
+        if method is not None:
+            _HOOKS[name].append(method)
+
+
+def unregister(plugin: Any) -> None:
+    _PLUGINS.remove(plugin)
+    for name in HOOKNAMES:
+        _HOOKS[name][:] = [h for h in _HOOKS[name]
+                           if getattr(h, '__self__', None) is not plugin]
+
+
+class lifecycle:
+    """
+    Call the hooks for `stage` around a block of code. The block should set
+    `outcome` to the result of the stage. When no hooks are registered for
+    the stage this does very little.
+    """
+    __slots__ = ('outcome', '_names', '_subject', '_description', '_started')
+
+    def __init__(self, stage: str, subject: Any, description: str) -> None:
+        self.outcome: Any = None
+        self._names = _STAGES[stage]
+        self._subject = subject
+        self._description = description
+        self._started = 0.0
+
+    def __enter__(self) -> "lifecycle":
+        before = self._names[0]
+        if _HOOKS[before]:
+            event = HookEvent(before, self._subject, self._description)
+            for hook in _HOOKS[before]:
+                hook(event)
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self,
+                 exc_type: Optional[type],
+                 exc_val: Optional[BaseException],
+                 exc_tb: Optional[TracebackType]) -> None:
+        after = self._names[1]
+        if not _HOOKS[after]:
+            return
+        event = HookEvent(after,
+                          self._subject,
+                          self._description,
+                          time.perf_counter() - self._started,
+                          self.outcome if exc_val is None else exc_val)
+        for hook in _HOOKS[after]:
+            hook(event)
+
+
+def _registerloaded(obj: Any) -> None:
+    register(obj() if isinstance(obj, type) else obj)
+
+
+def loadplugin(spec: str, path: Optional[str] = None) -> None:
+    """
+    Import and register the plugin named by `spec`, which looks like
+    "module:attribute". If `path` is given, the module is imported from there.
+    Each plugin is only loaded once.
+    """
+    if spec in _LOADED:
+        return
+    modname, _, attr = spec.partition(':')
+    obj: Any
+    if path is not None and path not in sys.path:
+        # the path is only added while importing, so that files in a dotfiles
+        # repo can't hide other modules from everything imported afterwards
+        sys.path.insert(0, path)
+        try:
+            obj = importlib.import_module(modname)
+        finally:
+            sys.path.remove(path)
+    else:
+        obj = importlib.import_module(modname)
+    for part in filter(None, attr.split('.')):
+        obj = getattr(obj, part)
+    _LOADED.add(spec)
+    _registerloaded(obj)
+
+
+def loadentrypoints() -> None:
+    """
+    Register the plugins from installed packages' "homely.hooks" entry
+    points.
+    """
+    from importlib.metadata import entry_points
+
+    for ep in entry_points(group=ENTRY_POINT_GROUP):
+        if ep.value in _LOADED:
+            continue
+        _LOADED.add(ep.value)
+        _registerloaded(ep.load())
+
+
+def pyprojecthooks(repopath: str) -> list[str]:
+    """
+    Return the plugins listed in [tool.homely] hooks in the repo's
+    pyproject.toml.
+    """
+    pyproject = Path(repopath) / 'pyproject.toml'
+    if not pyproject.exists():
+        return []
+    data = loadtoml(pyproject)
+    hooks = data.get('tool', {}).get('homely', {}).get('hooks', [])
+    if not (isinstance(hooks, list)
+            and all(isinstance(h, str) for h in hooks)):
+        raise ValueError("tool.homely.hooks in {} must be a list of"
+                         " strings".format(pyproject))
+    return hooks
@@ -0,0 +1,124 @@
+"""
+Metrics for the node_exporter textfile collector. When HOMELY_METRICS_FILE is
+set, each 'homely update' writes a summary of the run to that file in
+Prometheus' text exposition format.
+"""
+import os
+import threading
+import time
+from typing import Optional
+
+from homely._status import UpdateStatus
+
+_PREFIX = "homely_update_"
+
+# name, type and help text for each metric
+_METRICS = [
+    ("duration_seconds", "gauge",
+     "How long the last update took."),
+    ("timestamp_seconds", "gauge",
+     "When the last update finished, as a unix timestamp."),
+    ("status", "gauge",
+     "1 for the result of the last update, 0 for every other result."),
+    ("pull_duration_seconds", "gauge",
+     "How long the git pull of each repo took."),
+    ("helpers", "gauge",
+     "How many helpers were executed or were already done."),
+    ("messages", "gauge",
+     "How many warnings, connection failures and dirty repos were"
+     " reported."),
+    ("cleaners", "gauge",
+     "How many cleaners finished with each outcome."),
+]
+
+
+def metricsfile() -> Optional[str]:
+    return os.getenv("HOMELY_METRICS_FILE") or None
+
+
+def _escape(value: str) -> str:
+    return (value.replace("\\", "\\\\")
+            .replace("\"", "\\\"")
+            .replace("\n", "\\n"))
+
+
+class MetricsSink:
+    """
+    An event sink which collects the metrics for one update.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._duration = 0.0
+        self._result = UpdateStatus.OK.value
+        self._pulls: dict[str, float] = {}
+        self._helpers = {"executed": 0, "done": 0}
+        self._messages = {"warn": 0, "noconn": 0, "dirty": 0}
+        self._cleaners = {"cleaned": 0, "postponed": 0, "notneeded": 0,
+                          "aborted": 0}
+
+    def __call__(self, record: dict) -> None:
+        event = record["event"]
+        with self._lock:
+            if event == "run.end":
+                self._duration = record["duration"]
+                self._result = record["result"]
+                self._messages["warn"] = record.get("warnings") or 0
+                self._messages["noconn"] = record.get("noconn") or 0
+                self._messages["dirty"] = record.get("dirty") or 0
+            elif event == "pull.end":
+                self._pulls[record["repo"]] = record["duration"]
+            elif event == "helper.isdone.end" and record.get("done"):
+                self._helpers["done"] += 1
+            elif event == "helper.makechanges.end":
+                self._helpers["executed"] += 1
+            elif event == "cleaner.end" and "outcome" in record:
+                outcome = record["outcome"]
+                self._cleaners[outcome] = self._cleaners.get(outcome, 0) + 1
+
+    def _samples(self, name: str) -> list[tuple[dict[str, str], float]]:
+        if name == "duration_seconds":
+            return [({}, self._duration)]
+        if name == "timestamp_seconds":
+            return [({}, time.time())]
+        if name == "status":
+            return [({"status": s.value}, int(s.value == self._result))
+                    for s in UpdateStatus]
+        if name == "pull_duration_seconds":
+            return [({"repo": repo}, duration)
+                    for repo, duration in sorted(self._pulls.items())]
+        if name == "helpers":
+            return [({"result": k}, v) for k, v in self._helpers.items()]
+        if name == "messages":
+            return [({"kind": k}, v) for k, v in self._messages.items()]
+        assert name == "cleaners"
+        return [({"outcome": k}, v) for k, v in self._cleaners.items()]
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            for name, type_, help_ in _METRICS:
+                lines.append("# HELP {}{} {}".format(_PREFIX, name, help_))
+                lines.append("# TYPE {}{} {}".format(_PREFIX, name, type_))
+                for labels, value in self._samples(name):
+                    labeltext = ",".join(
+                        '{}="{}"'.format(k, _escape(v))
+                        for k, v in labels.items())
+                    if labeltext:
+                        labeltext = "{" + labeltext + "}"
+                    lines.append("{}{}{} {}".format(
+                        _PREFIX, name, labeltext, value))
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str) -> None:
+        """
+        Write the metrics to `path`. The file is replaced atomically so the
+        textfile collector never sees half of it.
+        """
+        # the temporary file must be in the same directory for os.replace()
+        # to be atomic, and its name mustn't end in .prom or node_exporter
+        # might read it
+        tmp = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp, path)
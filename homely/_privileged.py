@@ -0,0 +1,363 @@
+"""
+Commands which need to run as root are sent to a single privileged worker
+process, so that `sudo` only needs to be invoked (and authenticated) once per
+run of homely.
+
+The worker is started using `sudo` and talks to homely over a unix socket
+which is connected to the worker's stdin. Each command's stdin/stdout/stderr
+file descriptors are passed to the worker along with the command, so that the
+command's output still arrives in homely's own pipes and can be filtered and
+logged as usual.
+"""
+import atexit
+import itertools
+import json
+import os
+import socket
+import struct
+import subprocess
+import sys
+import threading
+from types import SimpleNamespace
+from typing import IO, Any, Optional, Sequence
+
+# how long to wait for the worker to say hello before giving up on it
+STARTUP_TIMEOUT = 30
+
+_HEADER = struct.Struct("!I")
+
+_WORKER: "Optional[PrivilegedWorker]" = None
+_WORKER_FAILED = False
+
+
+def _send(sock: socket.socket, msg: Any, fds: Sequence[int] = ()) -> None:
+    data = json.dumps(msg).encode('utf-8')
+    payload = _HEADER.pack(len(data)) + data
+    if fds:
+        # the file descriptors travel with the first byte of the message
+        sent = socket.send_fds(sock, [payload[:1]], fds)
+        assert sent == 1
+        payload = payload[1:]
+    sock.sendall(payload)
+
+
+def _recv(sock: socket.socket) -> tuple[Any, list[int]]:
+    # returns (None, []) when the other end has closed the socket
+    header = b""
+    fds: list[int] = []
+    while len(header) < _HEADER.size:
+        data, newfds, _, _ = socket.recv_fds(sock, _HEADER.size - len(header),
+                                             3)
+        fds.extend(newfds)
+        if not data:
+            for fd in fds:
+                os.close(fd)
+            return None, []
+        header += data
+    (size, ) = _HEADER.unpack(header)
+    body = bytearray()
+    while len(body) < size:
+        data = sock.recv(size - len(body))
+        if not data:
+            raise EOFError("Privileged worker message was truncated")
+        body += data
+    return json.loads(body), fds
+
+
+class PrivilegedProcess:
+    """
+    The parts of subprocess.Popen's interface that homely._scheduler needs,
+    for a command being run by the privileged worker.
+    """
+    stdout: Optional[IO[bytes]] = None
+    stderr: Optional[IO[bytes]] = None
+    returncode: Optional[int] = None
+    rusage: Optional[SimpleNamespace] = None
+
+    def __init__(self, worker: "PrivilegedWorker", reqid: int) -> None:
+        self._worker = worker
+        self._reqid = reqid
+        self._error: Optional[OSError] = None
+        self._started = threading.Event()
+        self._finished = threading.Event()
+
+    def poll(self) -> Optional[int]:
+        return self.returncode
+
+    def wait(self, timeout: Optional[float] = None) -> int:
+        if not self._finished.wait(timeout):
+            raise subprocess.TimeoutExpired(str(self._reqid), timeout or 0)
+        assert self.returncode is not None
+        return self.returncode
+
+    def kill(self) -> None:
+        if self.returncode is None:
+            self._worker._kill(self._reqid)
+
+
+class PrivilegedWorker:
+    def __init__(self, launcher: Sequence[str] = ('sudo', '-n')) -> None:
+        ours, theirs = socket.socketpair()
+        self._sock = ours
+        self._sendlock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._running: dict[int, PrivilegedProcess] = {}
+
+        # make sure the worker can import the same copy of homely as us
+        # without relying on the environment, which sudo will clean out
+        homelyparent = os.path.dirname(os.path.dirname(__file__))
+        code = ('import sys; sys.path.insert(0, {!r}); '
+                'from homely._privileged import serve; serve()'
+                .format(homelyparent))
+        try:
+            self._proc = subprocess.Popen(
+                [*launcher, sys.executable, '-c', code],
+                stdin=theirs.fileno(),
+                stdout=subprocess.DEVNULL,
+            )
+        finally:
+            theirs.close()
+
+        try:
+            self._sock.settimeout(STARTUP_TIMEOUT)
+            hello = _recv(self._sock)[0]
+            self._sock.settimeout(None)
+        except (OSError, EOFError, ValueError):
+            hello = None
+        if hello != {"ready": True}:
+            self.close()
+            raise OSError("Privileged worker did not start")
+
+        self._reader = threading.Thread(target=self._readreplies, daemon=True)
+        self._reader.start()
+
+    def _readreplies(self) -> None:
+        while True:
+            try:
+                msg = _recv(self._sock)[0]
+            except (OSError, EOFError, ValueError):
+                msg = None
+            if msg is None:
+                break
+            proc = self._running.get(msg["id"])
+            if proc is None:
+                continue
+            if "error" in msg:
+                proc._error = OSError(*msg["error"])
+                proc._started.set()
+                self._running.pop(msg["id"], None)
+            elif "started" in msg:
+                proc._started.set()
+            else:
+                if msg["rusage"] is not None:
+                    utime, stime, maxrss = msg["rusage"]
+                    proc.rusage = SimpleNamespace(
+                        ru_utime=utime, ru_stime=stime, ru_maxrss=maxrss)
+                proc.returncode = msg["returncode"]
+                self._running.pop(msg["id"], None)
+                proc._finished.set()
+
+        # the worker has gone away, so nothing still running can finish
+        for proc in list(self._running.values()):
+            proc._error = OSError("Privileged worker exited unexpectedly")
+            proc.returncode = -1
+            proc._started.set()
+            proc._finished.set()
+        self._running.clear()
+
+    def _kill(self, reqid: int) -> None:
+        with self._sendlock:
+            _send(self._sock, {"op": "kill", "id": reqid})
+
+    def spawn(
+        self,
+        cmd: Sequence[Any],
+        stdout: Any = None,
+        stderr: Any = None,
+        cwd: Optional[str] = None,
+        stdin: Any = None,
+        env: Optional[dict[str, str]] = None,
+    ) -> PrivilegedProcess:
+        """
+        Start `cmd` as root. `stdout` and `stderr` may be None, an open file,
+        subprocess.PIPE, subprocess.DEVNULL, or subprocess.STDOUT for
+        `stderr`. `stdin` may be None, an open file or subprocess.DEVNULL.
+        """
+        assert stdin != subprocess.PIPE, "stdin=PIPE is not supported"
+        proc = PrivilegedProcess(self, next(self._ids))
+        toclose: list[int] = []
+
+        def getfd(value: Any, inherit: int) -> int:
+            if value is None:
+                return inherit
+            if value == subprocess.PIPE:
+                r, w = os.pipe()
+                toclose.append(w)
+                if inherit == 1:
+                    proc.stdout = open(r, 'rb', buffering=0)
+                else:
+                    proc.stderr = open(r, 'rb', buffering=0)
+                return w
+            if value == subprocess.DEVNULL:
+                fd = os.open(os.devnull, os.O_RDWR)
+                toclose.append(fd)
+                return fd
+            if isinstance(value, int):
+                return value
+            return value.fileno()
+
+        try:
+            if stdin is not None:
+                infd = getfd(stdin, 0)
+            else:
+                try:
+                    os.fstat(0)
+                    infd = 0
+                except OSError:
+                    infd = getfd(subprocess.DEVNULL, 0)
+            outfd = getfd(stdout, 1)
+            if stderr == subprocess.STDOUT:
+                errfd = outfd
+            else:
+                errfd = getfd(stderr, 2)
+
+            self._running[proc._reqid] = proc
+            msg = {
+                "op": "run",
+                "id": proc._reqid,
+                "cmd": [str(arg) for arg in cmd],
+                "cwd": None if cwd is None else str(cwd),
+                "env": env,
+            }
+            with self._sendlock:
+                _send(self._sock, msg, [infd, outfd, errfd])
+        finally:
+            for fd in toclose:
+                os.close(fd)
+
+        proc._started.wait()
+        if proc._error is not None:
+            for pipe in (proc.stdout, proc.stderr):
+                if pipe is not None:
+                    pipe.close()
+            raise proc._error
+        return proc
+
+    def close(self) -> None:
+        # closing the socket tells the worker to kill anything it is still
+        # running and exit
+        try:
+            self._sock.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+        try:
+            self._proc.wait(timeout=STARTUP_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            self._proc.kill()
+            self._proc.wait()
+        self._sock.close()
+
+
+def _authenticate() -> bool:
+    # NOTE: homely._ui can't be imported at the top of this module
+    from homely._ui import allowinteractive, flushlog
+
+    check = ['sudo', '-n', 'true']
+    if subprocess.call(check, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL) == 0:
+        return True
+    if not allowinteractive():
+        return False
+    # ask the user for their password on the TTY
+    flushlog()
+    return subprocess.call(['sudo', '-v']) == 0
+
+
+def getworker() -> Optional[PrivilegedWorker]:
+    """
+    Return the privileged worker, starting it if necessary. Returns None if
+    the worker can't be started, in which case root commands should be run
+    using `sudo` directly.
+    """
+    global _WORKER, _WORKER_FAILED
+    if _WORKER is None and not _WORKER_FAILED:
+        try:
+            if _authenticate():
+                _WORKER = PrivilegedWorker()
+            else:
+                _WORKER_FAILED = True
+        except OSError:
+            _WORKER_FAILED = True
+    return _WORKER
+
+
+def closeworker() -> None:
+    global _WORKER, _WORKER_FAILED
+    _WORKER_FAILED = False
+    if _WORKER is not None:
+        worker, _WORKER = _WORKER, None
+        worker.close()
+
+
+atexit.register(closeworker)
+
+
+def serve() -> None:
+    """
+    The main loop of the privileged worker process.
+    """
+    from homely._scheduler import AccountedPopen
+
+    sock = socket.socket(fileno=0)
+    sendlock = threading.Lock()
+    running: dict[int, AccountedPopen] = {}
+
+    def reply(msg: Any) -> None:
+        with sendlock:
+            _send(sock, msg)
+
+    def reap(reqid: int, proc: AccountedPopen) -> None:
+        proc.wait()
+        running.pop(reqid, None)
+        rusage = None
+        if proc.rusage is not None:
+            rusage = [proc.rusage.ru_utime,
+                      proc.rusage.ru_stime,
+                      proc.rusage.ru_maxrss]
+        reply({"id": reqid, "returncode": proc.returncode, "rusage": rusage})
+
+    reply({"ready": True})
+    try:
+        while True:
+            msg, fds = _recv(sock)
+            if msg is None:
+                break
+            if msg["op"] == "kill":
+                killme = running.get(msg["id"])
+                if killme is not None:
+                    killme.kill()
+                continue
+
+            assert msg["op"] == "run"
+            try:
+                proc = AccountedPopen(msg["cmd"],
+                                      stdin=fds[0],
+                                      stdout=fds[1],
+                                      stderr=fds[2],
+                                      cwd=msg["cwd"],
+                                      env=msg.get("env"))
+            except OSError as err:
+                reply({"id": msg["id"],
+                       "error": [err.errno, err.strerror, err.filename]})
+                continue
+            finally:
+                for fd in fds:
+                    os.close(fd)
+            running[msg["id"]] = proc
+            reply({"id": msg["id"], "started": True})
+            threading.Thread(target=reap,
+                             args=(msg["id"], proc),
+                             daemon=True).start()
+    finally:
+        for proc in list(running.values()):
+            proc.kill()
@@ -0,0 +1,99 @@
+"""
+Profiling for HOMELY.py scripts, used by 'homely update --profile DIR' and
+'homely update --profile-memory'.
+
+Each HOMELY.py script and each @section function is profiled separately. When
+they are nested, the outer profile is paused while the inner one runs, so the
+time spent in a section isn't counted again in the profile of the HOMELY.py
+script that contains it.
+"""
+import cProfile
+import os
+import re
+import tracemalloc
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+# how many of the lines which allocated the most memory are reported for each
+# script or section
+TOP_ALLOCATIONS = 10
+
+_PROFILEDIR: Optional[str] = None
+_MEMORY = False
+_ACTIVE: list[cProfile.Profile] = []
+_ALLOCATIONS: list[tuple[str, int, list[tracemalloc.StatisticDiff]]] = []
+
+
+def setprofiling(directory: Optional[str], memory: bool) -> None:
+    """
+    Write a .prof file for each HOMELY.py script and @section into
+    `directory`, and/or record memory allocations if `memory` is True.
+    """
+    global _PROFILEDIR, _MEMORY
+    _PROFILEDIR = directory
+    _MEMORY = memory
+    if directory is not None:
+        os.makedirs(directory, exist_ok=True)
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    _ALLOCATIONS.clear()
+
+
+def _snapshot() -> tracemalloc.Snapshot:
+    # leave out the memory used by tracemalloc itself
+    return tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+    ])
+
+
+def _filename(name: str) -> str:
+    return re.sub(r'[^\w.()-]+', '_', name).strip('_') + '.prof'
+
+
+@contextmanager
+def profiled(name: str) -> Iterator[None]:
+    """
+    Profile the block of code as `name`.
+    """
+    if _PROFILEDIR is None and not _MEMORY:
+        yield
+        return
+
+    before = _snapshot() if _MEMORY else None
+    profile = None
+    if _PROFILEDIR is not None:
+        profile = cProfile.Profile()
+        if _ACTIVE:
+            _ACTIVE[-1].disable()
+        _ACTIVE.append(profile)
+        profile.enable()
+    try:
+        yield
+    finally:
+        if profile is not None:
+            profile.disable()
+            _ACTIVE.pop()
+            if _ACTIVE:
+                _ACTIVE[-1].enable()
+            assert _PROFILEDIR is not None
+            profile.dump_stats(os.path.join(_PROFILEDIR, _filename(name)))
+        if before is not None:
+            stats = _snapshot().compare_to(before, 'lineno')
+            total = sum(stat.size_diff for stat in stats)
+            _ALLOCATIONS.append((name, total, stats[:TOP_ALLOCATIONS]))
+
+
+def allocationsummary() -> list[str]:
+    """
+    Return lines describing where each script and section allocated the most
+    memory.
+    """
+    lines = []
+    for name, total, stats in _ALLOCATIONS:
+        lines.append("{}: {:+.1f} KiB".format(name, total / 1024))
+        for stat in stats:
+            frame = stat.traceback[0]
+            lines.append("    {:+9.1f} KiB {:>7} blocks  {}:{}".format(
+                stat.size_diff / 1024, stat.count_diff, frame.filename,
+                frame.lineno))
+    return lines
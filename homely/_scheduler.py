@@ -0,0 +1,343 @@
+"""
+Every subprocess started by homely._utils.run() or runasync() goes through
+the Scheduler, which limits how many commands of each category can run at
+once, enforces per-command timeouts, and keeps an account of how much time
+each category of command has cost.
+"""
+import asyncio
+import os
+import resource
+import subprocess
+import sys
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Optional, Sequence
+
+from homely._errors import CommandTimeout, HelperError
+from homely._events import span
+from homely._privileged import PrivilegedProcess, getworker
+
+CAT_GIT = "git"
+CAT_NETWORK = "network"
+CAT_PACKAGES = "package-manager"
+CAT_COMPILE = "compile"
+CAT_OTHER = "other"
+
+# how many commands from each category may run at the same time. Package
+# managers tend to hold a global lock, and compilers usually run their own
+# parallel jobs, so those are run one at a time.
+DEFAULT_LIMITS: dict[str, Optional[int]] = {
+    CAT_GIT: 4,
+    CAT_NETWORK: 4,
+    CAT_PACKAGES: 1,
+    CAT_COMPILE: 1,
+    CAT_OTHER: None,
+}
+
+_COMMANDS = {
+    'git': CAT_GIT,
+    'curl': CAT_NETWORK,
+    'wget': CAT_NETWORK,
+    'apt': CAT_PACKAGES,
+    'apt-get': CAT_PACKAGES,
+    'brew': CAT_PACKAGES,
+    'cargo': CAT_PACKAGES,
+    'dnf': CAT_PACKAGES,
+    'gem': CAT_PACKAGES,
+    'npm': CAT_PACKAGES,
+    'pacman': CAT_PACKAGES,
+    'pip': CAT_PACKAGES,
+    'pip3': CAT_PACKAGES,
+    'port': CAT_PACKAGES,
+    'yum': CAT_PACKAGES,
+    'cc': CAT_COMPILE,
+    'clang': CAT_COMPILE,
+    'cmake': CAT_COMPILE,
+    'gcc': CAT_COMPILE,
+    'make': CAT_COMPILE,
+    'ninja': CAT_COMPILE,
+}
+
+# the Popen() arguments which the privileged worker can pass on
+_PRIVILEGED_KWARGS = {'cwd', 'stdin', 'env'}
+
+Filter = Callable[[bytes, bool], Any]
+
+
+def categorize(cmd: Sequence[Any]) -> str:
+    """
+    Guess the category of a command from the name of its executable.
+    """
+    name = os.path.basename(str(cmd[0]))
+    if name.startswith('python') and len(cmd) > 2 and cmd[1] == '-m':
+        # e.g. "python3 -m pip ..."
+        name = str(cmd[2])
+    return _COMMANDS.get(name, CAT_OTHER)
+
+
+class AccountedPopen(subprocess.Popen):
+    """
+    A Popen which reaps its child using os.wait4() so that the child's
+    resource usage can be recorded.
+    """
+    rusage: Optional[resource.struct_rusage] = None
+
+    def _try_wait(self, wait_flags: int) -> tuple[int, int]:
+        # NOTE: this mirrors subprocess.Popen._try_wait()
+        try:
+            pid, sts, rusage = os.wait4(self.pid, wait_flags)
+        except ChildProcessError:
+            # the child has already been reaped and we can't get its status
+            return self.pid, 0
+        if pid == self.pid:
+            self.rusage = rusage
+        return pid, sts
+
+
+@dataclass
+class Account:
+    count: int = 0
+    failed: int = 0
+    timeouts: int = 0
+    wall: float = 0.0
+    utime: float = 0.0
+    stime: float = 0.0
+    # peak resident set size of the largest child, in KiB
+    maxrss: int = 0
+
+
+class _PipeProtocol(asyncio.Protocol):
+    def __init__(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        filter: Optional[Filter],
+    ) -> None:
+        self._filter = filter
+        self._chunks: list[bytes] = []
+        self.done: asyncio.Future[bytes] = loop.create_future()
+
+    def data_received(self, data: bytes) -> None:
+        if self._filter:
+            self._filter(data, False)
+        else:
+            self._chunks.append(data)
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        if self._filter:
+            self._filter(b"", True)
+        if not self.done.done():
+            self.done.set_result(b"".join(self._chunks))
+
+
+class Scheduler:
+    def __init__(self) -> None:
+        self.limits = dict(DEFAULT_LIMITS)
+        self.accounts: dict[str, Account] = {}
+        self._semaphores: dict[str, asyncio.Semaphore] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def setlimit(self, category: str, limit: Optional[int]) -> None:
+        assert limit is None or limit > 0
+        self.limits[category] = limit
+        self._semaphores.pop(category, None)
+
+    def _semaphore(self, category: str) -> Optional[asyncio.Semaphore]:
+        limit = self.limits.get(category)
+        if not limit:
+            return None
+        # semaphores belong to a single event loop
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._semaphores = {}
+        try:
+            return self._semaphores[category]
+        except KeyError:
+            semaphore = self._semaphores[category] = asyncio.Semaphore(limit)
+            return semaphore
+
+    def _record(
+        self,
+        category: str,
+        proc: "AccountedPopen | PrivilegedProcess",
+        started: float,
+        timedout: bool,
+        result: dict[str, Any],
+    ) -> None:
+        # `result` receives the outcome for the "process.end" event
+        result["returncode"] = proc.returncode
+        result["timedout"] = timedout
+        if proc.rusage is not None:
+            result["utime"] = proc.rusage.ru_utime
+            result["stime"] = proc.rusage.ru_stime
+        account = self.accounts.setdefault(category, Account())
+        account.count += 1
+        account.wall += time.monotonic() - started
+        if timedout:
+            account.timeouts += 1
+        elif proc.returncode:
+            account.failed += 1
+        if proc.rusage is not None:
+            account.utime += proc.rusage.ru_utime
+            account.stime += proc.rusage.ru_stime
+            maxrss = proc.rusage.ru_maxrss
+            if sys.platform == 'darwin':
+                # macOS reports bytes rather than KiB
+                maxrss //= 1024
+            account.maxrss = max(account.maxrss, maxrss)
+
+    def _spawn(
+        self,
+        cmd: Sequence[Any],
+        stdout: Any,
+        stderr: Any,
+        kwargs: dict[str, Any],
+    ) -> "AccountedPopen | PrivilegedProcess":
+        kwargs = dict(kwargs)
+        if kwargs.pop('privileged', False):
+            for name in kwargs:
+                if name not in _PRIVILEGED_KWARGS:
+                    raise HelperError(
+                        "privileged commands don't support %s=" % name)
+            if kwargs.get('stdin') == subprocess.PIPE:
+                raise HelperError(
+                    "privileged commands don't support stdin=PIPE")
+            worker = getworker()
+            if worker is not None:
+                return worker.spawn(cmd, stdout, stderr, **kwargs)
+            # fall back to running sudo for each command
+            cmd = ['sudo', *cmd]
+        return AccountedPopen(cmd, stdout=stdout, stderr=stderr, **kwargs)
+
+    def run(
+        self,
+        cmd: Sequence[Any],
+        stdout: Any,
+        stderr: Any,
+        timeout: Optional[float],
+        category: Optional[str],
+        kwargs: dict[str, Any],
+    ) -> tuple[int, Any, Any]:
+        """
+        Run a command to completion and return (returncode, stdout, stderr).
+        """
+        assert not kwargs.get('privileged'), "Use runasync() instead"
+        category = category or categorize(cmd)
+        with span("process", cmd=[str(arg) for arg in cmd],
+                  category=category) as result:
+            started = time.monotonic()
+            proc = AccountedPopen(cmd, stdout=stdout, stderr=stderr, **kwargs)
+            timedout = False
+            try:
+                try:
+                    out, err = proc.communicate(timeout=timeout)
+                except subprocess.TimeoutExpired:
+                    timedout = True
+                    proc.kill()
+                    proc.communicate()
+                    raise CommandTimeout(cmd, timeout)
+            finally:
+                if proc.returncode is None:
+                    proc.kill()
+                    proc.wait()
+                self._record(category, proc, started, timedout, result)
+        return proc.returncode, out, err
+
+    async def runasync(
+        self,
+        cmd: Sequence[Any],
+        stdout: Any,
+        stderr: Any,
+        stdoutfilter: Optional[Filter],
+        stderrfilter: Optional[Filter],
+        timeout: Optional[float],
+        category: Optional[str],
+        kwargs: dict[str, Any],
+    ) -> tuple[int, Any, Any]:
+        """
+        A coroutine version of run(). Any output from the command is passed to
+        stdoutfilter/stderrfilter one chunk at a time as it arrives.
+        """
+        category = category or categorize(cmd)
+        semaphore = self._semaphore(category)
+        if semaphore is None:
+            return await self._runasync(cmd, stdout, stderr, stdoutfilter,
+                                        stderrfilter, timeout, category,
+                                        kwargs)
+        async with semaphore:
+            return await self._runasync(cmd, stdout, stderr, stdoutfilter,
+                                        stderrfilter, timeout, category,
+                                        kwargs)
+
+    async def _runasync(
+        self,
+        cmd: Sequence[Any],
+        stdout: Any,
+        stderr: Any,
+        stdoutfilter: Optional[Filter],
+        stderrfilter: Optional[Filter],
+        timeout: Optional[float],
+        category: str,
+        kwargs: dict[str, Any],
+    ) -> tuple[int, Any, Any]:
+        with span("process", cmd=[str(arg) for arg in cmd],
+                  category=category) as result:
+            loop = asyncio.get_running_loop()
+            started = time.monotonic()
+            proc = self._spawn(cmd, stdout, stderr, kwargs)
+            timedout = False
+            transports = []
+            try:
+                # NOTE: we read the pipes ourselves instead of using
+                # loop.subprocess_exec(), because asyncio's child watcher would
+                # reap the process before we could get its resource usage
+                protocols: list[Optional[_PipeProtocol]] = []
+                for pipe, filter in ((proc.stdout, stdoutfilter),
+                                     (proc.stderr, stderrfilter)):
+                    if pipe is None:
+                        protocols.append(None)
+                        continue
+                    protocol = _PipeProtocol(loop, filter)
+                    transport, _ = await loop.connect_read_pipe(
+                        lambda: protocol, pipe)
+                    transports.append(transport)
+                    protocols.append(protocol)
+                waiting = [p.done for p in protocols if p is not None]
+                try:
+                    await asyncio.wait_for(
+                        asyncio.gather(loop.run_in_executor(None, proc.wait),
+                                       *waiting),
+                        timeout)
+                except asyncio.TimeoutError:
+                    timedout = True
+                    raise CommandTimeout(cmd, timeout)
+                out, err = [None if p is None else p.done.result()
+                            for p in protocols]
+            finally:
+                if proc.returncode is None:
+                    proc.kill()
+                    await loop.run_in_executor(None, proc.wait)
+                for transport in transports:
+                    transport.close()
+                self._record(category, proc, started, timedout, result)
+            assert proc.returncode is not None
+            return proc.returncode, out, err
+
+    def summary(self) -> list[str]:
+        lines = ["{:<16} {:>6} {:>6} {:>8} {:>9} {:>8} {:>8} {:>10}".format(
+            "category", "count", "failed", "timeouts",
+            "wall(s)", "user(s)", "sys(s)", "maxrss(MB)")]
+        for category, account in sorted(self.accounts.items()):
+            lines.append(
+                "{:<16} {:>6} {:>6} {:>8} {:>9.2f} {:>8.2f} {:>8.2f} {:>10.1f}"
+                .format(category, account.count, account.failed,
+                        account.timeouts, account.wall, account.utime,
+                        account.stime, account.maxrss / 1024))
+        return lines
+
+
+_SCHEDULER = Scheduler()
+
+
+def getscheduler() -> Scheduler:
+    return _SCHEDULER
@@ -0,0 +1,401 @@
+"""
+The state of 'homely update' as recorded in ~/.homely.
+
+Shell prompts query this on every render, so this module must only import
+from the standard library (see test_status_imports). It also provides a fast
+path for the 'homely updatestatus' command which avoids loading click and the
+rest of homely.
+"""
+import json
+import math
+import os
+import sys
+import time
+from contextlib import contextmanager
+from enum import Enum
+from os.path import exists, join
+from typing import Any, Iterator, Optional
+
+ROOT = join(os.environ['HOME'], '.homely')
+
+# contains the PID of the currently running homely process
+RUNFILE = join(ROOT, "update-running")
+# written to when a complete update is finished successfully
+TIMEFILE = join(ROOT, "update-time")
+# contains the name of the section currently being executed by 'homely update'
+SECTIONFILE = join(ROOT, "update-section")
+# this file is touched when a 'homely update' of using all sections is
+# unsuccessful
+FAILFILE = join(ROOT, "update-failed")
+# this file is used to control the pause/unpause state
+PAUSEFILE = join(ROOT, "update-paused")
+# contains the output of the last 'homely autoupdate' run
+OUTFILE = join(ROOT, "autoupdate-output.txt")
+# the status record which combines all of the information above; the files
+# above are still written for the benefit of older versions of homely
+STATUSFILE = join(ROOT, "status.json")
+
+# 'homely autoupdate' won't start an update if the previous one finished less
+# than this many seconds ago
+AUTOUPDATE_INTERVAL = 20 * 60 * 60
+
+# while an update is running, the status record is rewritten at most this
+# many seconds apart
+DEFAULT_PROGRESS_INTERVAL = 0.5
+
+
+def _progressinterval() -> float:
+    # a bad $HOMELY_PROGRESS_INTERVAL mustn't stop homely from working, not
+    # even the 'updatestatus' fast path which imports this module
+    try:
+        interval = float(os.environ.get("HOMELY_PROGRESS_INTERVAL",
+                                        DEFAULT_PROGRESS_INTERVAL))
+    except ValueError:
+        return DEFAULT_PROGRESS_INTERVAL
+    if not math.isfinite(interval):
+        return DEFAULT_PROGRESS_INTERVAL
+    return max(interval, 0.0)
+
+
+PROGRESS_INTERVAL = _progressinterval()
+
+
+class UpdateStatus(Enum):
+    OK = "ok"
+    NEVER = "never"
+    RUNNING = "running"
+    FAILED = "failed"
+    NOCONN = "noconn"
+    DIRTY = "dirty"
+    PAUSED = "paused"
+
+
+STATUSCODES = {
+    UpdateStatus.OK: 0,
+    UpdateStatus.NEVER: 2,
+    UpdateStatus.RUNNING: 3,
+    UpdateStatus.FAILED: 4,
+    UpdateStatus.NOCONN: 5,
+    UpdateStatus.DIRTY: 6,
+    UpdateStatus.PAUSED: 7,
+}
+
+
+def _legacyrecord() -> dict:
+    # build a status record from the individual files written by older
+    # versions of homely
+    mtime = None
+    if exists(TIMEFILE):
+        mtime = os.stat(TIMEFILE).st_mtime
+    state = UpdateStatus.NEVER if mtime is None else UpdateStatus.OK
+
+    if exists(FAILFILE):
+        if not mtime:
+            mtime = os.stat(FAILFILE).st_mtime
+        with open(FAILFILE) as f:
+            content = f.read().strip()
+        if content == UpdateStatus.NOCONN.value:
+            state = UpdateStatus.NOCONN
+        elif content == UpdateStatus.DIRTY.value:
+            state = UpdateStatus.DIRTY
+        else:
+            state = UpdateStatus.FAILED
+
+    running = None
+    if exists(RUNFILE):
+        section = ""
+        if exists(SECTIONFILE):
+            with open(SECTIONFILE) as f:
+                section = f.read().strip()
+        running = {
+            "pid": None,
+            "started": os.stat(RUNFILE).st_mtime,
+            "section": section,
+            "done": 0,
+            "total": 0,
+        }
+
+    return {
+        "state": state.value,
+        "time": mtime,
+        "paused": exists(PAUSEFILE),
+        "running": running,
+        "warnings": 0,
+    }
+
+
+def readrecord() -> dict:
+    """
+    Return the status record, which is a dict containing:
+
+    state
+        The UpdateStatus value of the last complete update.
+    time
+        The time when the last complete update finished, or None.
+    paused
+        True when automatic updates have been paused.
+    running
+        None, or a dict describing the update currently in progress: its
+        "pid", the time it "started", the "section" it is up to, how many of
+        the "total" repos it has "done", the number of the "helper" it is
+        running out of the "helpers" run last time, and the "eta" when it is
+        expected to finish (or None).
+    warnings
+        The number of warnings raised by the last complete update.
+    lastrun
+        None, or the "duration" of the last complete update and the number of
+        "helpers" it ran. This is used to estimate the "eta" of the next
+        update.
+    """
+    try:
+        with open(STATUSFILE) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return _legacyrecord()
+
+
+@contextmanager
+def editrecord() -> Iterator[dict]:
+    """
+    Modify the status record. The record is replaced atomically so that
+    readers never see a partially written record, and writers are serialised
+    using a lock file so that concurrent changes aren't lost.
+    """
+    import fcntl
+
+    with open(STATUSFILE + ".lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        record = readrecord()
+        yield record
+        tmp = "{}.{}.new".format(STATUSFILE, os.getpid())
+        with open(tmp, "w") as f:
+            json.dump(record, f)
+        os.replace(tmp, STATUSFILE)
+
+
+def _replace(path: str, content: str) -> None:
+    with open(path + ".new", 'w') as f:
+        f.write(content)
+    os.replace(path + ".new", path)
+
+
+class ProgressReporter:
+    """
+    Publishes the progress of a running 'homely update' in the status record.
+
+    Changes which arrive less than `interval` seconds after the record was
+    last written are held back and merged with any changes that follow them,
+    then written together once the interval has passed.
+    """
+
+    def __init__(self, total: int, interval: float = PROGRESS_INTERVAL) -> None:
+        import threading
+
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._timer: Optional[threading.Timer] = None
+        self._pending: dict[str, Any] = {}
+        self._lastwrite = float("-inf")
+        self._started = time.time()
+        self.helper = 0
+        self.done = 0
+
+        with editrecord() as record:
+            self._lastrun = record.get("lastrun")
+            record["running"] = {
+                "pid": os.getpid(),
+                "started": self._started,
+                "section": "<preparing>",
+                "done": 0,
+                "total": total,
+                "helper": 0,
+                "helpers": self._lastrun["helpers"] if self._lastrun else 0,
+                "eta": self._eta(self._started),
+            }
+        _replace(SECTIONFILE, "<preparing>")
+        self._lastwrite = time.monotonic()
+
+    def _eta(self, now: float) -> Optional[float]:
+        if not self._lastrun:
+            return None
+        duration = self._lastrun["duration"]
+        helpers = self._lastrun["helpers"]
+        if helpers and self.helper:
+            remaining = duration * max(0.0, 1 - self.helper / helpers)
+        else:
+            remaining = max(0.0, duration - (now - self._started))
+        return now + remaining
+
+    def setsection(self, section: str) -> None:
+        self._update(section=section)
+
+    def helperstarted(self) -> None:
+        self.helper += 1
+        self._update(helper=self.helper)
+
+    def repodone(self) -> None:
+        self.done += 1
+        self._update(done=self.done)
+
+    def _update(self, **changes: Any) -> None:
+        import threading
+
+        with self._lock:
+            self._pending.update(changes)
+            wait = self._lastwrite + self._interval - time.monotonic()
+            if wait <= 0:
+                self._write()
+            elif self._timer is None:
+                self._timer = threading.Timer(wait, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _write(self) -> None:
+        # NOTE: self._lock must be held
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        with editrecord() as record:
+            running = record.get("running")
+            if running is None or running["pid"] != os.getpid():
+                return
+            running.update(pending)
+            running["eta"] = self._eta(time.time())
+        if "section" in pending:
+            _replace(SECTIONFILE, pending["section"])
+        self._lastwrite = time.monotonic()
+
+    def flush(self) -> None:
+        """
+        Write any changes which are still being held back.
+        """
+        with self._lock:
+            self._write()
+
+    def finish(self, record: dict, complete: bool) -> None:
+        """
+        Remove the running update from `record`, which must come from
+        editrecord(). If the update was `complete` its duration is kept for
+        estimating the duration of the next update.
+        """
+        # NOTE: the caller already holds the lock on the status record, so
+        # this mustn't write the record again, and it mustn't wait for
+        # self._lock either because a timer may be holding it while it waits
+        # for the record. Any changes still being held back are dropped along
+        # with the running update, and a timer which fires later will find
+        # that there's no running update left to write to.
+        timer = self._timer
+        if timer is not None:
+            timer.cancel()
+        self._pending = {}
+        record["running"] = None
+        if complete:
+            record["lastrun"] = {
+                "duration": time.time() - self._started,
+                "helpers": self.helper,
+            }
+
+
+def describeprogress(running: dict) -> str:
+    """
+    Return a short description of the progress of the running update
+    described by `running`, such as "2/3 ETA 10:45".
+    """
+    parts = []
+    helpers = running.get("helpers") or 0
+    if running.get("helper"):
+        if helpers >= running["helper"]:
+            parts.append("{}/{}".format(running["helper"], helpers))
+        else:
+            parts.append("{}".format(running["helper"]))
+    if running.get("eta"):
+        parts.append(time.strftime("ETA %H:%M",
+                                   time.localtime(running["eta"])))
+    return " ".join(parts)
+
+
+def recordstatus(record: dict) -> tuple[UpdateStatus, float | None, str | None]:
+    """
+    Return the (status, timestamp, section) described by a status record.
+    """
+    running = record.get("running")
+    if running:
+        return UpdateStatus.RUNNING, running["started"], running["section"]
+    if record.get("paused"):
+        return UpdateStatus.PAUSED, None, None
+    state = UpdateStatus(record["state"])
+    if state == UpdateStatus.NEVER:
+        return state, None, None
+    return state, record["time"], None
+
+
+def getstatus() -> tuple[UpdateStatus, float | None, str | None]:
+    """Get the status of the previous 'homely update', or any 'homely update'
+    that may be running in another process.
+    """
+    return recordstatus(readrecord())
+
+
+def updateblocked(status: UpdateStatus,
+                  mtime: float | None,
+                  interval: float = AUTOUPDATE_INTERVAL) -> str | None:
+    """
+    Return the reason why an automatic update can't be started given the
+    `status` and `mtime` returned by getstatus(), or None if it can.
+    """
+    if status == UpdateStatus.FAILED:
+        return "previous update failed"
+    if status == UpdateStatus.PAUSED:
+        return "updates are paused"
+    if status == UpdateStatus.RUNNING:
+        return "an update is already running"
+    if mtime is not None and (time.time() - mtime) < interval:
+        return "too soon to start another update"
+    return None
+
+
+def setpaused(paused: bool) -> None:
+    with editrecord() as record:
+        record["paused"] = paused
+        if paused:
+            with open(PAUSEFILE, 'w'):
+                pass
+        elif exists(PAUSEFILE):
+            os.unlink(PAUSEFILE)
+
+
+def main(progress: bool = False) -> None:
+    """
+    Exit with the same exit code as 'homely updatestatus'. When `progress` is
+    True, also print the progress of a running update.
+    """
+    try:
+        record = readrecord()
+        status = recordstatus(record)[0]
+        if progress and record.get("running"):
+            running = record["running"]
+            print(" ".join(filter(None, [running["section"],
+                                         describeprogress(running)])))
+    except Exception:
+        sys.exit(1)
+    sys.exit(STATUSCODES[status])
+
+
+def entrypoint() -> None:
+    """
+    The 'homely' console script. 'homely updatestatus' is answered here
+    directly; every other command is handed to homely._cli.
+    """
+    if sys.argv[1:] == ['updatestatus']:
+        main()
+    if sys.argv[1:] == ['updatestatus', '--progress']:
+        main(progress=True)
+    from homely._cli import main as climain
+    climain()
+
+
+if __name__ == '__main__':
+    main()
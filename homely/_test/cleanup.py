@@ -0,0 +1,220 @@
+"""
+A stress harness for Engine.cleanup(). It generates an engine2.json state
+describing a deep tree of directories, files, lines and symlinks plus package
+cleaners, then runs a new Engine which still wants part of that tree and a
+few of the packages, and checks what cleanup() leaves behind.
+
+The unit tests use it at a small scale, and benchmarks/bench_cleanup.py uses
+it to time cleanup() at a large one.
+"""
+import json
+import os
+import time
+from dataclasses import dataclass, field
+from typing import Iterator, Optional
+
+from homely._engine2 import Engine, Helper
+from homely._utils import FactConfig, mkcfgdir
+from homely.files import LineInFile, MakeDir, MakeSymlink
+from homely.install import PackageCleaner
+
+
+class Claim(Helper):
+    """
+    A helper which claims a package the way InstallPackage does, without
+    installing anything.
+    """
+
+    def __init__(self, name: str) -> None:
+        super().__init__()
+        self._name = name
+
+    @property
+    def description(self) -> str:
+        return "Claim package %s" % self._name
+
+    def getcleaner(self) -> None:
+        return None
+
+    def getclaims(self) -> Iterator[str]:
+        yield "package:%s" % self._name
+
+    def isdone(self) -> bool:
+        return True
+
+    def makechanges(self) -> None:
+        raise AssertionError("Claim.makechanges() should never be needed")
+
+    def pathsownable(self) -> dict[str, str]:
+        return {}
+
+    def affectspath(self, path: str) -> bool:
+        return False
+
+
+@dataclass
+class CleanupState:
+    cfgpath: str
+    # helpers which the new Engine still runs
+    wanted: list[Helper] = field(default_factory=list)
+    # paths which must survive the cleanup
+    keep: set[str] = field(default_factory=set)
+    # every path which the old state created
+    created: set[str] = field(default_factory=set)
+    # directories which were only kept because things inside them are still
+    # wanted, so they must be postponed rather than forgotten
+    parents: set[str] = field(default_factory=set)
+    packages: list[str] = field(default_factory=list)
+    claimed: set[str] = field(default_factory=set)
+
+
+def generate(root: str,
+             depth: int,
+             fanout: int,
+             files: int,
+             packages: int,
+             keepevery: int) -> CleanupState:
+    """
+    Create a tree of directories under `root` which is `depth` levels deep
+    with `fanout` subdirectories in each directory, and `files` files and
+    symlinks in each of the deepest directories. Every `keepevery`th of the
+    deepest directories, and every `keepevery`th package, is still wanted by
+    the new Engine. Half of the parent directories which are still needed
+    were already postponed by an earlier cleanup.
+
+    $HOME must not have a homely config of its own, because the facts saying
+    that the packages are installed are written there.
+    """
+    state = CleanupState(cfgpath=os.path.join(root, 'engine2.json'))
+    helpers: list[Helper] = []
+    leaves = 0
+
+    def walk(path: str, level: int, ancestors: list[str]) -> None:
+        nonlocal leaves
+        helpers.append(MakeDir(path))
+        if level < depth:
+            for i in range(fanout):
+                walk(os.path.join(path, 'd%d' % i), level + 1,
+                     ancestors + [path])
+            return
+
+        leaves += 1
+        for i in range(files):
+            filename = os.path.join(path, 'file%d.txt' % i)
+            helpers.append(LineInFile(filename, 'line %d' % i))
+            helpers.append(MakeSymlink(filename,
+                                       os.path.join(path, 'link%d' % i)))
+        if leaves % keepevery == 0:
+            state.wanted.append(MakeDir(path))
+            state.keep.add(path)
+            state.keep.update(ancestors)
+            state.parents.update(ancestors)
+
+    walk(os.path.join(root, 'tree'), 0, [])
+
+    cleaners = []
+    paths_owned: dict[str, str] = {}
+    for helper in helpers:
+        for path in helper.pathsownable():
+            if not os.path.lexists(path):
+                state.created.add(path)
+        helper.makechanges()
+        paths_owned.update(helper.pathsownable())
+        cleaner = helper.getcleaner()
+        if cleaner is not None:
+            cleaners.append(cleaner.fulldict())
+
+    mkcfgdir()
+    facts = FactConfig()
+    for i in range(packages):
+        name = 'stress-package-%d' % i
+        state.packages.append(name)
+        cleaners.append(PackageCleaner(name, {}).fulldict())
+        # only claimed packages are recorded as installed, so that the
+        # harness never tries to uninstall anything
+        if i % keepevery == 0:
+            state.claimed.add(name)
+            state.wanted.append(Claim(name))
+            facts.jsondata['InstalledPackage:apt:%s' % name] = True
+    facts.writejson()
+
+    postponed = sorted(state.parents)[::2]
+    with open(state.cfgpath, 'w') as f:
+        json.dump({
+            "cleaners": cleaners,
+            "paths_owned": paths_owned,
+            "paths_postponed": postponed,
+            "paths_created": sorted(state.created),
+        }, f)
+    return state
+
+
+def runcleanup(state: CleanupState,
+               conflicts: str = Engine.POSTPONE) -> tuple[Engine, float]:
+    """
+    Run the wanted helpers on a new Engine, then clean up. Returns the Engine
+    and how long cleanup() took.
+    """
+    engine = Engine(state.cfgpath)
+    for helper in state.wanted:
+        engine.run(helper)
+    started = time.perf_counter()
+    engine.cleanup(conflicts)
+    return engine, time.perf_counter() - started
+
+
+def checkinvariants(state: CleanupState,
+                    engine: Optional[Engine] = None) -> list[str]:
+    """
+    Return a description of each way the cleanup went wrong.
+    """
+    problems = []
+
+    if engine is not None:
+        # the cleaner stack and the paths loop must have converged
+        if engine._old_cleaners:
+            problems.append("{} old cleaners were not finished".format(
+                len(engine._old_cleaners)))
+        if engine._old_paths_owned:
+            problems.append("{} old paths were not cleaned".format(
+                len(engine._old_paths_owned)))
+        owned = set(engine._new_paths_owned)
+        for path in engine._postponed - owned:
+            problems.append("postponed path is not owned: " + path)
+        for path in state.parents - engine._postponed:
+            problems.append("needed parent was not postponed: " + path)
+
+    for path in state.keep:
+        if not os.path.isdir(path):
+            problems.append("wanted path was removed: " + path)
+    for path in state.created - state.keep:
+        if os.path.lexists(path):
+            problems.append("unwanted path was not removed: " + path)
+
+    # the saved config must describe the same state, and only keep the
+    # cleaners for claimed packages
+    with open(state.cfgpath) as f:
+        saved = json.load(f)
+    packages = {c["params"]["name"] for c in saved["cleaners"]
+                if c["class"] == PackageCleaner.__name__}
+    if packages != state.claimed:
+        problems.append("package cleaners kept for {}, expected {}".format(
+            sorted(packages), sorted(state.claimed)))
+    for path in saved["paths_postponed"]:
+        if path not in saved["paths_owned"]:
+            problems.append("saved postponed path is not owned: " + path)
+    if set(saved["paths_owned"]) != state.keep:
+        problems.append("{} paths are owned, expected {}".format(
+            len(saved["paths_owned"]), len(state.keep)))
+    return problems
+
+
+def forget(state: CleanupState) -> None:
+    """
+    Stop wanting the tree, so that the next cleanup removes everything that is
+    left of it.
+    """
+    state.wanted = [helper for helper in state.wanted
+                    if isinstance(helper, Claim)]
+    state.keep = set()
+    state.parents = set()
@@ -1,24 +1,130 @@
+import io
 import os
 import os.path
 import re
 import sys
-from contextlib import contextmanager
+import traceback
+from contextlib import contextmanager, redirect_stderr, redirect_stdout
 from subprocess import STDOUT, Popen, TimeoutExpired
 
 from homely._test import withtmpdir
 
+# the start of every command built by HOMELY()
+_HOMELY_CMD = ['python', '-m', 'homely._cli']
+
+# Commands built by HOMELY() are run inside the test's own process, because
+# starting a new python interpreter for each one is much slower. Set
+# HOMELY_TEST_SUBPROCESS=1 to run them in a subprocess the way users run them.
+INPROCESS = os.environ.get("HOMELY_TEST_SUBPROCESS", "0") != "1"
+
+# commands with these options fork a daemon, so they always need a subprocess
+_FORKING_OPTIONS = ('--daemon', '--listen')
+
 
 def HOMELY(command):
-    return [
-        'python',
-        '-m',
-        'homely._cli',
+    return _HOMELY_CMD + [
         command,
         '--neverprompt',
         '--verbose',
     ]
 
 
+def _inprocessargs(cmd):
+    """
+    Return homely's arguments if <cmd> can be run using runhomely(), or None
+    if it needs a subprocess.
+    """
+    if cmd[:len(_HOMELY_CMD)] != _HOMELY_CMD:
+        return None
+    args = cmd[len(_HOMELY_CMD):]
+    if any(option in args for option in _FORKING_OPTIONS):
+        return None
+    return args
+
+
+def _importhomely(homedir):
+    """
+    Make sure homely's modules were imported with $HOME set to <homedir>,
+    because some of them work out their paths when they are imported.
+    """
+    os.environ["HOME"] = homedir
+    status = sys.modules.get('homely._status')
+    if status is not None and status.ROOT != os.path.join(homedir, '.homely'):
+        for name in list(sys.modules):
+            if name.startswith('homely.') and name != __name__:
+                sys.modules.pop(name, None)
+
+
+def resetglobals():
+    """
+    Reset the global state that one homely command leaves behind, so that
+    the next command starts the same way it would in a new process.
+    """
+    import homely._engine2
+    import homely._ui
+    import homely.pipinstall
+    from homely._scheduler import getscheduler
+
+    homely._engine2.resetengine()
+    homely._engine2.setrepoinfo(None)
+    homely._engine2._FACTS = None
+    homely._ui._NOTECOUNT.clear()
+    homely._ui._CURRENT_REPO = None
+    homely._ui._CURRENT_SECTION = ""
+    homely._ui._PREV_SECTION.clear()
+    homely._ui._INDENT = 0
+    homely._ui._PROGRESS = None
+    homely._ui._WANTPROMPT = None
+    homely._ui._ALLOW_INTERACTIVE = None
+    homely._ui.setverbose(False)
+    homely._ui.setallowpull(True)
+    homely.pipinstall._known_pips.clear()
+    getscheduler().accounts.clear()
+
+
+def runhomely(args, homedir, cwd=None):
+    """
+    Run homely's command line interface with <args> inside this process,
+    with $HOME set to <homedir>. Returns the exit code and everything that
+    was written to stdout and stderr.
+    """
+    oldhome = os.environ.get("HOME")
+    oldcwd = os.getcwd()
+    output = io.StringIO()
+    _importhomely(homedir)
+    import homely._cli
+    import homely._ui
+    resetglobals()
+    oldstreams = (homely._ui._OUTSTREAM, homely._ui._ERRSTREAM)
+    homely._ui.setstreams(output, output)
+    try:
+        if cwd is not None:
+            os.chdir(cwd)
+        with redirect_stdout(output), redirect_stderr(output):
+            try:
+                homely._cli.main(args)
+                returncode = 0
+            except SystemExit as err:
+                if err.code is None or isinstance(err.code, int):
+                    returncode = err.code or 0
+                else:
+                    print(err.code, file=sys.stderr)
+                    returncode = 1
+            except Exception:
+                traceback.print_exc()
+                returncode = 1
+    finally:
+        homely._ui.setbuffered(False)
+        homely._ui.setstreams(*oldstreams)
+        resetglobals()
+        os.chdir(oldcwd)
+        if oldhome is None:
+            os.environ.pop("HOME", None)
+        else:
+            os.environ["HOME"] = oldhome
+    return returncode, output.getvalue()
+
+
 NEXT_ID = 1
 
 
@@ -70,47 +176,61 @@ def _getfakeenv(homedir):
     return env
 
 
+def _spawn(cmd, cwd, env, tmpdir):
+    stdoutpath = tmpdir + '/stdout'
+    with open(stdoutpath, 'w') as stdout:
+        sub = Popen(cmd,
+                    cwd=cwd,
+                    env=env,
+                    stdout=stdout,
+                    stderr=STDOUT)
+        try:
+            returncode = sub.wait(1)
+        except TimeoutExpired:
+            returncode = '<KILLED>'
+            sub.kill()
+    with open(stdoutpath, 'r') as f:
+        return returncode, f.read()
+
+
 def getsystemfn(homedir):
     """
     Returns a sytem() function which has some special behaviours:
     - it sets env's $HOME to the specified dir
     - it modifies $PYTHONPATH to include this version of the homely source code
     - it raises an exception if the command takes longer than 1 second to
-      complete
+      complete (except for homely commands which run in-process)
     - it raises an exception if the command doesn't exit(0) or
       exit(expecterror)
+    - homely commands built by HOMELY() are run using runhomely() unless
+      INPROCESS is False or they would fork a daemon
     """
     env = _getfakeenv(homedir)
 
     @withtmpdir
     def system(cmd, cwd=None, expecterror=False, tmpdir=None):
         returncode = '<NOT SPAWNED>'
+        output = ''
         try:
-            stdoutpath = tmpdir + '/stdout'
-            with open(stdoutpath, 'w') as stdout:
-                sub = Popen(cmd,
-                            cwd=cwd,
-                            env=env,
-                            stdout=stdout,
-                            stderr=STDOUT)
-                try:
-                    returncode = sub.wait(1)
-                except TimeoutExpired:
-                    returncode = '<KILLED>'
-                    sub.kill()
+            args = _inprocessargs(cmd) if INPROCESS else None
+            if args is not None:
+                returncode, output = runhomely(args, homedir, cwd=cwd)
+            else:
+                returncode, output = _spawn(cmd, cwd, env, tmpdir)
+                if returncode == '<KILLED>':
                     raise Exception("Command did not finish quickly enough")
 
-                if returncode == 0:
-                    if expecterror:
-                        raise Exception("Expected exit(%d) but got clean exit"
-                                        % expecterror)
-                elif expecterror:
-                    assert type(expecterror) is int
-                    assert returncode == expecterror, (
-                        "Expected exit(%d) but got exit(%d)"
-                        % (expecterror, returncode))
-                else:
-                    raise Exception("Program did not exit cleanly")
+            if returncode == 0:
+                if expecterror:
+                    raise Exception("Expected exit(%d) but got clean exit"
+                                    % expecterror)
+            elif expecterror:
+                assert type(expecterror) is int
+                assert returncode == expecterror, (
+                    "Expected exit(%d) but got exit(%d)"
+                    % (expecterror, returncode))
+            else:
+                raise Exception("Program did not exit cleanly")
         except Exception:
             if cwd is not None:
                 print('$ cd %s' % cwd)
@@ -120,11 +240,10 @@ def getsystemfn(homedir):
                     else arg)
                 for arg in cmd
             ]))
-            print(open(stdoutpath).read())
+            print(output)
             raise
 
-        with open(stdoutpath, 'r') as f:
-            return f.read()
+        return output
 
     return system
 
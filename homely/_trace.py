@@ -0,0 +1,131 @@
+"""
+Convert homely's events into Chrome's Trace Event Format, so that a
+'homely update --trace FILE' can be opened in Perfetto or chrome://tracing.
+"""
+import json
+import os
+import threading
+from typing import Any, Optional
+
+# the thread id used for everything except subprocesses
+_MAIN_TID = 0
+
+
+def _label(kind: str, fields: dict) -> str:
+    if kind == "repo":
+        return os.path.basename(fields["repo"])
+    if kind == "pull":
+        return "pull " + os.path.basename(fields["repo"])
+    if kind == "section":
+        return fields["section"]
+    if kind == "include":
+        return "include " + fields["script"]
+    if kind == "helper.isdone":
+        return "isdone: " + fields["helper"]
+    if kind == "helper.makechanges":
+        return "makechanges: " + fields["helper"]
+    if kind == "cleaner":
+        return "clean: " + fields["cleaner"]
+    if kind == "process":
+        return " ".join(fields["cmd"])
+    return kind
+
+
+class TraceSink:
+    """
+    An event sink which writes a trace of the update to `path` when it is
+    closed.
+
+    Subprocesses can run concurrently, so each one that is running at the
+    same time as another is shown on its own track.
+    """
+
+    def __init__(self, path: str) -> None:
+        self._path = path
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._t0: Optional[float] = None
+        self._runstart: Optional[float] = None
+        self._starts: dict[int, float] = {}
+        self._lanes: dict[int, int] = {}
+        self._busy: set[int] = set()
+        self._events: list[dict[str, Any]] = []
+
+    def _us(self, ts: float) -> float:
+        assert self._t0 is not None
+        return round((ts - self._t0) * 1e6, 3)
+
+    def _complete(self, name: str, cat: str, start: float, duration: float,
+                  tid: int, args: dict) -> None:
+        self._events.append({
+            "name": name,
+            "cat": cat,
+            "ph": "X",
+            "ts": self._us(start),
+            "dur": round(duration * 1e6, 3),
+            "pid": self._pid,
+            "tid": tid,
+            "args": args,
+        })
+
+    def __call__(self, record: dict) -> None:
+        with self._lock:
+            self._add(record)
+
+    def _add(self, record: dict) -> None:
+        event = record["event"]
+        if self._t0 is None:
+            self._t0 = record["ts"]
+
+        if event == "run.start":
+            self._runstart = record["ts"]
+            return
+        if event == "run.end":
+            if self._runstart is not None:
+                args = {k: v for k, v in record.items()
+                        if k not in ("event", "ts", "duration")}
+                self._complete("homely update", "run", self._runstart,
+                               record["duration"], _MAIN_TID, args)
+            return
+
+        spanid = record.get("span")
+        if spanid is None:
+            return
+        kind, _, phase = event.rpartition(".")
+        if phase == "start":
+            self._starts[spanid] = record["ts"]
+            if kind == "process":
+                # use the first track that isn't busy with another process
+                lane = 1
+                while lane in self._busy:
+                    lane += 1
+                self._busy.add(lane)
+                self._lanes[spanid] = lane
+            return
+
+        start = self._starts.pop(spanid, None)
+        if phase != "end" or start is None:
+            return
+        tid = _MAIN_TID
+        if kind == "process":
+            tid = self._lanes.pop(spanid)
+            self._busy.discard(tid)
+        args = {k: v for k, v in record.items()
+                if k not in ("event", "ts", "span", "duration")}
+        self._complete(_label(kind, record), kind, start, record["duration"],
+                       tid, args)
+
+    def close(self) -> None:
+        with self._lock:
+            tids = {e["tid"] for e in self._events}
+            names = [{
+                "name": "thread_name",
+                "ph": "M",
+                "pid": self._pid,
+                "tid": tid,
+                "args": {"name": ("homely" if tid == _MAIN_TID
+                                  else "subprocesses #{}".format(tid))},
+            } for tid in sorted(tids)]
+            with open(self._path, 'w') as f:
+                json.dump({"traceEvents": names + self._events,
+                           "displayTimeUnit": "ms"}, f, default=str)
@@ -1,15 +1,24 @@
+import atexit
 import os
+import queue
 import shutil
 import sys
+import threading
 import time
 from contextlib import contextmanager
 from datetime import datetime
 
 import homely._utils
 from homely._errors import ERR_NO_SCRIPT, ConnectionError, InputError
-from homely._utils import (FAILFILE, RUNFILE, SECTIONFILE, TIMEFILE, RepoInfo,
-                           RepoListConfig, RepoScriptConfig, UpdateStatus,
-                           tmpdir)
+from homely._events import (EVENTFILE, JsonLinesSink, addsink, emit,
+                            removesink, span)
+from homely._history import HistorySink, saverun
+from homely._hooks import loadentrypoints, loadplugin, pyprojecthooks
+from homely._metrics import MetricsSink, metricsfile
+from homely._profile import profiled
+from homely._utils import (FAILFILE, RUNFILE, SECTIONFILE, TIMEFILE,
+                           ProgressReporter, RepoInfo, RepoListConfig,
+                           RepoScriptConfig, UpdateStatus, editrecord, tmpdir)
 from homely._vcs import Repo
 
 _VERBOSE = False
@@ -28,6 +37,7 @@ _ERRSTREAM = sys.stderr
 
 def setstreams(outstream, errstream):
     global _OUTSTREAM, _ERRSTREAM
+    flushlog()
     _OUTSTREAM = outstream
     _ERRSTREAM = errstream
 
@@ -48,6 +58,119 @@ def setallowpull(value):
     _ALLOWPULL = bool(value)
 
 
+# log levels
+LEVEL_NOTE = 20
+LEVEL_WARN = 30
+_LEVELS = {"note": LEVEL_NOTE, "warn": LEVEL_WARN}
+
+# messages below this level aren't written, but are still counted. An unknown
+# $HOMELY_LOGLEVEL is reported by the CLI, see badloglevel()
+_LOGLEVEL = _LEVELS.get(os.environ.get("HOMELY_LOGLEVEL", "note"), LEVEL_NOTE)
+
+
+def badloglevel():
+    """
+    Return the value of $HOMELY_LOGLEVEL if it isn't the name of a log level,
+    or None if it is.
+    """
+    value = os.environ.get("HOMELY_LOGLEVEL", "note")
+    return None if value in _LEVELS else value
+
+
+def setloglevel(level):
+    global _LOGLEVEL
+    assert level in _LEVELS.values()
+    _LOGLEVEL = level
+
+
+class _LogWriter:
+    """
+    Writes log messages to their streams from a background thread, so that
+    each message doesn't have to wait for a write() and flush(). Messages
+    which are queued together are written together, and each stream is only
+    flushed once per batch.
+    """
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def put(self, stream, text):
+        self._queue.put((stream, text))
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            streams = []
+            try:
+                for stream, text in batch:
+                    stream.write(text)
+                    if stream not in streams:
+                        streams.append(stream)
+                for stream in streams:
+                    stream.flush()
+            except (OSError, ValueError):
+                # the stream was closed or went away; there is nowhere left
+                # to report the problem
+                pass
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def join(self):
+        self._queue.join()
+
+
+# whether log messages should be written by a _LogWriter
+_BUFFERED = False
+_WRITER = None
+
+
+def setbuffered(value):
+    global _BUFFERED
+    flushlog()
+    _BUFFERED = bool(value)
+
+
+def flushlog():
+    """
+    Wait until all log messages have been written to their streams. This must
+    be done before anything else writes to the terminal.
+    """
+    if _WRITER is not None and _WRITER.pid == os.getpid():
+        _WRITER.join()
+
+
+atexit.register(flushlog)
+
+
+def _getwriter():
+    global _WRITER
+    # threads don't survive a fork(), so a daemon process needs its own writer
+    if _WRITER is None or _WRITER.pid != os.getpid():
+        _WRITER = _LogWriter()
+    return _WRITER
+
+
+_TIMESTAMP = (None, '')
+
+
+def _timestamp():
+    # formatting the time is relatively slow, so only do it once per second
+    global _TIMESTAMP
+    now = int(time.time())
+    if _TIMESTAMP[0] != now:
+        _TIMESTAMP = (now, datetime.fromtimestamp(now).strftime('%c'))
+    return _TIMESTAMP[1]
+
+
 _INDENT = 0
 _NOTECOUNT: dict[str, int] = {}
 
@@ -55,6 +178,7 @@ _NOTECOUNT: dict[str, int] = {}
 class note:
     sep = '   '
     dash = '- '
+    level = LEVEL_NOTE
 
     def __init__(self, message, dash=None):
         super(note, self).__init__()
@@ -64,11 +188,16 @@ class note:
         return _OUTSTREAM
 
     def _unicodelog(self, stream, message, dash=None):
-        indent = ('  ' * (_INDENT - 1)) if _INDENT > 0 else ''
-        dash = dash or (self.dash if _INDENT > 0 else '')
-        stream.write('[{}] {} {}{}{}\n'.format(
-            datetime.now().strftime('%c'), self.sep, indent, dash, message))
-        stream.flush()
+        if self.level >= _LOGLEVEL:
+            indent = ('  ' * (_INDENT - 1)) if _INDENT > 0 else ''
+            dash = dash or (self.dash if _INDENT > 0 else '')
+            text = '[{}] {} {}{}{}\n'.format(
+                _timestamp(), self.sep, indent, dash, message)
+            if _BUFFERED:
+                _getwriter().put(stream, text)
+            else:
+                stream.write(text)
+                stream.flush()
         try:
             _NOTECOUNT[self.__class__.__name__] += 1
         except KeyError:
@@ -90,6 +219,7 @@ class head(note):
 class warn(note):
     sep = 'ERR'
     dash = '  '
+    level = LEVEL_WARN
 
     def _getstream(self):
         return _ERRSTREAM
@@ -116,6 +246,26 @@ def _writepidfile():
         return False
 
 
+def _loadhooks(repopath=None):
+    """
+    Load the lifecycle hook plugins from installed packages, or from the
+    pyproject.toml of the repo at `repopath`.
+    """
+    try:
+        if repopath is None:
+            loadentrypoints()
+            return
+        specs = pyprojecthooks(repopath)
+    except Exception as err:
+        warn("Could not load hooks: {}".format(err))
+        return
+    for spec in specs:
+        try:
+            loadplugin(spec, repopath)
+        except Exception as err:
+            warn("Could not load hook {}: {!r}".format(spec, err))
+
+
 def run_update(infos, pullfirst, only=None, cancleanup=None, quick=None):
     from homely._engine2 import initengine, resetengine, setrepoinfo
 
@@ -124,61 +274,94 @@ def run_update(infos, pullfirst, only=None, cancleanup=None, quick=None):
         only = []
     elif len(only):
         assert len(infos) <= 1
-    global _CURRENT_REPO
+    global _CURRENT_REPO, _PROGRESS
     errors = False
 
     if not _writepidfile():
         return False
 
-    isfullupdate = False
-    if (cancleanup and
-            (not len(only)) and
-            len(infos) == RepoListConfig().repo_count()):
-        isfullupdate = True
-
-        # remove the fail file if it is still hanging around
-        if os.path.exists(FAILFILE):
-            os.unlink(FAILFILE)
-
     must_abort_when_dirty = os.getenv("HOMELY_PULL_WHEN_DIRTY", "0") != "1"
 
+    # everything from here on happens inside the try block so that the
+    # RUNFILE is always removed again
+    isfullupdate = False
+    eventsink = None
+    history = None
+    metrics = None
+    started = time.perf_counter()
+
     try:
-        # write the section file with the current section name
-        _write(SECTIONFILE, "<preparing>")
+        _PROGRESS = ProgressReporter(len(infos))
+
+        if (cancleanup and
+                (not len(only)) and
+                len(infos) == RepoListConfig().repo_count()):
+            isfullupdate = True
+
+            # remove the fail file if it is still hanging around
+            if os.path.exists(FAILFILE):
+                os.unlink(FAILFILE)
+            with editrecord() as record:
+                if record["state"] != UpdateStatus.NEVER.value:
+                    record["state"] = UpdateStatus.OK.value
+
+        # record what happens during this update in the event file
+        eventsink = JsonLinesSink(EVENTFILE)
+        addsink(eventsink)
+        history = HistorySink()
+        addsink(history)
+        metricspath = metricsfile()
+        if metricspath is not None:
+            metrics = MetricsSink()
+            addsink(metrics)
+        emit("run.start",
+             repos=[info.localrepo.repo_path for info in infos],
+             full=isfullupdate,
+             pullfirst=pullfirst)
 
         engine = initengine(quick=quick)
+        _loadhooks()
 
         for info in infos:
             setrepoinfo(info)
             assert isinstance(info, RepoInfo)
             _CURRENT_REPO = info
             localrepo = info.localrepo
-            with entersection(os.path.basename(localrepo.repo_path)), \
+            with span("repo", repo=localrepo.repo_path), \
+                    entersection(os.path.basename(localrepo.repo_path)), \
                     head("Updating from {} [{}]".format(
                         localrepo.repo_path, info.shortid())):
                 if pullfirst:
                     with note("Pulling changes for {}".format(
-                            localrepo.repo_path)):
+                            localrepo.repo_path)), \
+                            span("pull", repo=localrepo.repo_path) as pull:
                         if must_abort_when_dirty and localrepo.isdirty():
                             dirty("Aborting - uncommitted changes")
                             dirty("(use HOMELY_PULL_WHEN_DIRTY=1 to override)")
+                            pull["result"] = UpdateStatus.DIRTY.value
                         else:
                             try:
                                 localrepo.pullchanges()
+                                pull["result"] = UpdateStatus.OK.value
                             except ConnectionError:
                                 noconn("Could not connect to remote server")
+                                pull["result"] = UpdateStatus.NOCONN.value
 
                 # make sure the HOMELY.py script exists
                 pyscript = os.path.join(localrepo.repo_path, 'HOMELY.py')
                 if not os.path.exists(pyscript):
                     warn("{}: {}".format(ERR_NO_SCRIPT, localrepo.repo_path))
+                    _PROGRESS.repodone()
                     continue
 
+                _loadhooks(localrepo.repo_path)
+
                 if len(only):
                     engine.onlysections(only)
 
                 try:
-                    homely._utils._loadmodule('HOMELY', pyscript)
+                    with profiled(_CURRENT_SECTION + "/HOMELY.py"):
+                        homely._utils._loadmodule('HOMELY', pyscript)
                 except Exception as err:
                     import traceback
                     tb = traceback.format_exc()
@@ -191,16 +374,19 @@ def run_update(infos, pullfirst, only=None, cancleanup=None, quick=None):
                 # HOMELY module might not be present.
                 sys.modules.pop('HOMELY', None)
 
+            _PROGRESS.repodone()
+
         setrepoinfo(None)
 
         if isfullupdate:
             if _NOTECOUNT.get('warn'):
                 note("Automatic Cleanup not possible due to previous warnings")
             else:
-                _write(SECTIONFILE, "<cleaning up>")
+                _PROGRESS.setsection("<cleaning up>")
                 engine.cleanup(engine.WARN)
 
         resetengine()
+        _PROGRESS.flush()
         os.unlink(SECTIONFILE)
     except KeyboardInterrupt:
         errors = True
@@ -216,20 +402,60 @@ def run_update(infos, pullfirst, only=None, cancleanup=None, quick=None):
         warncount = _NOTECOUNT.get('warn')
         noconncount = _NOTECOUNT.get('noconn')
         dirtycount = _NOTECOUNT.get('dirty')
-        if isfullupdate:
-            if errors or warncount:
-                # touch the FAILFILE if there were errors or warnings
-                with open(FAILFILE, 'w') as f:
-                    pass
-            elif noconncount:
-                with open(FAILFILE, 'w') as f:
-                    f.write(UpdateStatus.NOCONN.value)
-            elif dirtycount:
-                with open(FAILFILE, 'w') as f:
-                    f.write(UpdateStatus.DIRTY.value)
-            _write(TIMEFILE, time.strftime("%H:%M"))
-        if os.path.exists(RUNFILE):
-            os.unlink(RUNFILE)
+        state = UpdateStatus.OK
+        if errors or warncount:
+            state = UpdateStatus.FAILED
+        elif noconncount:
+            state = UpdateStatus.NOCONN
+        elif dirtycount:
+            state = UpdateStatus.DIRTY
+        emit("run.end",
+             result=state.value,
+             duration=time.perf_counter() - started,
+             warnings=warncount or 0,
+             noconn=noconncount or 0,
+             dirty=dirtycount or 0)
+        if eventsink is not None:
+            removesink(eventsink)
+            eventsink.close()
+        if history is not None:
+            removesink(history)
+            try:
+                saverun(history.finish())
+            except OSError as err:
+                warn("Could not save update history: {}".format(err))
+        if metrics is not None:
+            removesink(metrics)
+            try:
+                metrics.write(metricspath)
+            except OSError as err:
+                warn("Could not write {}: {}".format(metricspath, err))
+        try:
+            with editrecord() as record:
+                if _PROGRESS is not None:
+                    _PROGRESS.finish(record,
+                                     complete=isfullupdate and not errors)
+                    _PROGRESS = None
+                if isfullupdate:
+                    record["state"] = state.value
+                    record["time"] = time.time()
+                    record["warnings"] = warncount or 0
+                    # keep the old status files up to date for older versions
+                    # of homely
+                    if state == UpdateStatus.FAILED:
+                        with open(FAILFILE, 'w') as f:
+                            pass
+                    elif state != UpdateStatus.OK:
+                        with open(FAILFILE, 'w') as f:
+                            f.write(state.value)
+                    _write(TIMEFILE, time.strftime("%H:%M"))
+        finally:
+            # the status record must be updated before the RUNFILE is removed
+            # so that nobody sees a finished update which is still marked as
+            # running
+            if os.path.exists(RUNFILE):
+                os.unlink(RUNFILE)
+            flushlog()
 
     return not (errors or warncount or noconncount or dirtycount)
 
@@ -359,6 +585,7 @@ def yesno(name, prompt, default=None, recommended=None, noprompt=None):
     if recommended is not None:
         rec = "[recommended={}] ".format("Y" if recommended else "N")
 
+    flushlog()
     while True:
         answer = input("{} {} {} : ".format(prompt, rec, options))
         if answer == "" and default is not None:
@@ -399,8 +626,19 @@ def _write(path, content):
     os.replace(path + ".new", path)
 
 
+def helperstarted():
+    if _PROGRESS is not None:
+        _PROGRESS.helperstarted()
+
+
 _PREV_SECTION = []
 _CURRENT_SECTION = ""
+# publishes the progress of the current 'homely update'
+_PROGRESS = None
+
+
+def currentsection():
+    return _CURRENT_SECTION
 
 
 @contextmanager
@@ -410,9 +648,12 @@ def entersection(name):
     try:
         # update the section name and put it in the file
         _CURRENT_SECTION = _CURRENT_SECTION + name
-        _write(SECTIONFILE, _CURRENT_SECTION)
-        yield
+        if _PROGRESS is not None:
+            _PROGRESS.setsection(_CURRENT_SECTION)
+        with span("section", section=_CURRENT_SECTION):
+            yield
     finally:
         # restore the previous section name
         _CURRENT_SECTION = _PREV_SECTION.pop()
-        _write(SECTIONFILE, _CURRENT_SECTION)
+        if _PROGRESS is not None:
+            _PROGRESS.setsection(_CURRENT_SECTION)
@@ -1,6 +1,9 @@
 import contextlib
+import errno
+import hashlib
 import importlib.util
 import json
+import mmap
 import os
 import re
 import shutil
@@ -8,16 +11,21 @@ import subprocess
 import sys
 import tempfile
 from datetime import timedelta
-from enum import Enum
 from functools import partial
 from io import TextIOWrapper
 from itertools import chain
 from os.path import exists, join
-from typing import (IO, TYPE_CHECKING, Any, Generic, Iterable, Iterator,
-                    Literal, Optional, Sequence, TypedDict, TypeVar, Union)
+from typing import (IO, TYPE_CHECKING, Any, Callable, Generic, Iterable,
+                    Iterator, Literal, Optional, Sequence, TypedDict, TypeVar,
+                    Union)
 
-from homely._asyncioutils import _runasync
+from homely._asyncioutils import runcoroutine
 from homely._errors import JsonError
+from homely._scheduler import getscheduler
+from homely._status import (FAILFILE, OUTFILE, PAUSEFILE, ROOT, RUNFILE,
+                            SECTIONFILE, STATUSCODES, STATUSFILE, TIMEFILE,
+                            ProgressReporter, UpdateStatus, editrecord,
+                            getstatus, readrecord)
 from homely._vcs import Repo, fromdict
 
 if TYPE_CHECKING:
@@ -48,28 +56,28 @@ def _loadmodule(name: str, file_path: str) -> object:
     return module
 
 
+def loadtoml(path: str | os.PathLike) -> dict[str, Any]:
+    """
+    Return the contents of the TOML file at `path`.
+    """
+    try:
+        # we need a type-ignore here because tomllib is only in Python
+        # 3.11+ and mypy is configured to check against 3.10 stdlib.
+        import tomllib  # type: ignore
+    except ImportError:
+        # NOTE: this needs a type-ignore for mypy checking against python3.14 which won't have tomli
+        import tomli as tomllib  # type: ignore
+    with open(path, 'rb') as f:
+        return tomllib.load(f)
+
+
 # for python3, we open text files with universal newline support
 opentext = partial(open, newline="")
 
-ROOT = join(os.environ['HOME'], '.homely')
 REPO_CONFIG_PATH = join(ROOT, 'repos.json')
 ENGINE2_CONFIG_PATH = join(ROOT, 'engine2.json')
 FACT_CONFIG_PATH = join(ROOT, 'facts.json')
 
-# contains the PID of the currently running homely process
-RUNFILE = join(ROOT, "update-running")
-# written to when a complete update is finished successfully
-TIMEFILE = join(ROOT, "update-time")
-# contains the name of the section currently being executed by 'homely update'
-SECTIONFILE = join(ROOT, "update-section")
-# this file is touched when a 'homely update' of using all sections is
-# unsuccessful
-FAILFILE = join(ROOT, "update-failed")
-# this file is used to control the pause/unpause state
-PAUSEFILE = join(ROOT, "update-paused")
-# contains the output of the last 'homely autoupdate' run
-OUTFILE = join(ROOT, "autoupdate-output.txt")
-
 
 _urlregex = re.compile(r"^[a-zA-Z0-9+\-.]{2,20}://")
 
@@ -116,34 +124,72 @@ def _homepath2real(path: str) -> str:
     return path
 
 
-def run(
-    cmd: Sequence[str | os.PathLike],
-    stdout: int | bool | IO | None = None,
-    stderr: int | bool | Literal["STDOUT"] | TextIOWrapper | None = None,
-    **kwargs: Any,
-) -> tuple[int, Optional[list[str]], Optional[list[str]]]:
+class LineSplitter:
+    """
+    An output filter for run() which splits a stream of bytes into lines of
+    text and passes each line to `online`.
+
+    Chunks are appended to a single bytearray and only the newly arrived bytes
+    are searched for line endings, so the cost of splitting stays linear in
+    the size of the output no matter how the chunks arrive. Lines are only
+    ever cut at a b"\n", which can never fall inside a multi-byte utf-8
+    character, so characters that straddle two chunks are decoded intact.
     """
-    A blocking wrapper around subprocess.Popen(), but with a simpler interface
-    for the stdout/stderr arguments:
 
-    stdout=False / stderr=False
-        stdout/stderr will be redirected to /dev/null (or discarded in some
-        other suitable manner)
-    stdout=True / stderr=True
-        stdout/stderr will be captured and returned as a list of lines.
-    stdout=None
-        stdout will be redirected to the python process's stdout, which may be
-        a tty (same as using stdout=subprocess.None)
-    stderr=None:
-        stderr will be redirected to the python process's stderr, which may be
-        a tty (same as using stderr=subprocess.None)
-    stderr="STDOUT"
-        Same as using stderr=subprocess.STDOUT
+    def __init__(
+        self,
+        online: Callable[[str], Any],
+        encoding: str = 'utf-8',
+    ) -> None:
+        self._online = online
+        self._encoding = encoding
+        self._buf = bytearray()
+
+    def __call__(self, data: bytes | None, isend: bool) -> None:
+        if data:
+            self.feed(data)
+        if isend:
+            self.close()
+
+    def feed(self, data: bytes) -> None:
+        buf = self._buf
+        # anything already in the buffer is known not to contain a newline
+        pos = len(buf)
+        buf += data
+        pos = buf.find(b"\n", pos)
+        if pos < 0:
+            return
+        start = 0
+        with memoryview(buf) as view:
+            while pos >= 0:
+                self._emit(view[start:pos])
+                start = pos + 1
+                pos = buf.find(b"\n", start)
+        del buf[:start]
+
+    def close(self) -> None:
+        if self._buf:
+            with memoryview(self._buf) as view:
+                self._emit(view)
+            self._buf.clear()
+
+    def _emit(self, line: memoryview) -> None:
+        self._online(str(line, self._encoding, 'replace'))
+
+
+_Redirects = tuple[
+    Any,                 # stdout
+    Any,                 # stderr
+    Optional[Callable],  # stdoutfilter
+    Optional[Callable],  # stderrfilter
+    bool,                # wantstdout
+    bool,                # wantstderr
+]
 
-    The return value will be a tuple of (exitcode, stdout, stderr)
 
-    If stdout and/or stderr were not captured, they will be None instead.
-    """
+@contextlib.contextmanager
+def _redirects(stdout: Any, stderr: Any) -> Iterator[_Redirects]:
+    # translate run()'s stdout/stderr arguments into arguments for Popen()
     devnull = None
     try:
         stdoutfilter = None
@@ -178,37 +224,180 @@ def run(
         else:
             assert stderr is None, "Invalid stderr %r" % stderr
 
-        if (stdoutfilter or stderrfilter):
-            # run background process asynchronously and filter output as
-            # it is running
-            exitcode, out, err, = _runasync(stdoutfilter,
-                                            stderrfilter,
-                                            cmd,
-                                            stdout=stdout,
-                                            stderr=stderr,
-                                            **kwargs)
-            if not wantstdout:
-                out = None
-            if not wantstderr:
-                err = None
-            return exitcode, out, err
-
-        proc = subprocess.Popen(cmd, stdout=stdout, stderr=stderr, **kwargs)
-        out, err = proc.communicate()
-        if not wantstdout:
-            if stdoutfilter:
-                stdoutfilter(out, True)
-            out = None
-        if not wantstderr:
-            if stderrfilter:
-                stderrfilter(err, True)
-            err = None
-        return proc.returncode, out, err
+        yield (stdout, stderr, stdoutfilter, stderrfilter,
+               wantstdout, wantstderr)
     finally:
         if devnull is not None:
             devnull.close()
 
 
+# how much output run(stdout="SPOOL") keeps in memory before moving it to a
+# temporary file
+SPOOL_MAXSIZE = 1024 * 1024
+
+
+class CapturedOutput:
+    """
+    Output captured from a subprocess using run(stdout="SPOOL"). Up to
+    `maxsize` bytes are kept in memory, after which the output is moved to an
+    anonymous temporary file so that large outputs don't need to be held in
+    memory all at once.
+
+    Use lines() or chunks() to scan the output, or mmap() to get a read-only
+    buffer of the whole output. Call close() (or use a with statement) to
+    discard the output when it is no longer needed.
+    """
+
+    def __init__(self, maxsize: int = SPOOL_MAXSIZE) -> None:
+        self._file = tempfile.SpooledTemporaryFile(max_size=maxsize)
+        self.size = 0
+
+    def __call__(self, data: bytes | None, isend: bool) -> None:
+        # CapturedOutput can be used as an output filter for run()
+        if data:
+            self._file.write(data)
+            self.size += len(data)
+
+    def __enter__(self) -> "CapturedOutput":
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._file.close()
+
+    def chunks(self, size: int = 64 * 1024) -> Iterator[bytes]:
+        self._file.seek(0)
+        while True:
+            chunk = self._file.read(size)
+            if not chunk:
+                return
+            yield chunk
+
+    def lines(self, encoding: str = 'utf-8') -> Iterator[str]:
+        """
+        Yield each line of output as a str, without its line ending.
+        """
+        self._file.seek(0)
+        for line in self._file:
+            if line.endswith(b"\n"):
+                line = line[:-1]
+            yield str(line, encoding, 'replace')
+
+    def read(self) -> bytes:
+        self._file.seek(0)
+        return self._file.read()
+
+    def mmap(self) -> "mmap.mmap | bytes":
+        if not self.size:
+            # an empty file can't be mapped
+            return b""
+        # NOTE: asking for the fileno() will move the output to disk if it is
+        # still in memory
+        return mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def run(
+    cmd: Sequence[str | os.PathLike],
+    stdout: int | bool | Literal["SPOOL"] | IO | Callable | None = None,
+    stderr: (int | bool | Literal["STDOUT", "SPOOL"] | TextIOWrapper |
+             Callable | None) = None,
+    timeout: Optional[float] = None,
+    category: Optional[str] = None,
+    **kwargs: Any,
+) -> tuple[int, Any, Any]:
+    """
+    A blocking wrapper around subprocess.Popen(), but with a simpler interface
+    for the stdout/stderr arguments:
+
+    stdout=False / stderr=False
+        stdout/stderr will be redirected to /dev/null (or discarded in some
+        other suitable manner)
+    stdout=True / stderr=True
+        stdout/stderr will be captured and returned as a list of lines.
+    stdout=None
+        stdout will be redirected to the python process's stdout, which may be
+        a tty (same as using stdout=subprocess.None)
+    stderr=None:
+        stderr will be redirected to the python process's stderr, which may be
+        a tty (same as using stderr=subprocess.None)
+    stderr="STDOUT"
+        Same as using stderr=subprocess.STDOUT
+    stdout=<callable> / stderr=<callable>
+        Output will be passed to the callable one chunk at a time as it
+        arrives, as callable(chunk, False). Once the stream has ended the
+        callable will receive callable(remainder, True). The callable is
+        responsible for buffering any partial lines (see LineSplitter).
+
+    stdout="SPOOL" / stderr="SPOOL"
+        stdout/stderr will be captured and returned as a CapturedOutput, which
+        only holds a limited amount of the output in memory.
+
+    If the process is still running after `timeout` seconds it will be killed
+    and a CommandTimeout raised. `category` is one of the CAT_* constants from
+    homely._scheduler, and is otherwise guessed from the command's name.
+
+    Use privileged=True to run the command as root using homely's privileged
+    worker (see homely._privileged).
+
+    The return value will be a tuple of (exitcode, stdout, stderr), where
+    stdout/stderr are bytes, or a CapturedOutput when "SPOOL" was used.
+
+    If stdout and/or stderr were not captured, they will be None instead.
+    """
+    if (callable(stdout) or callable(stderr) or "SPOOL" in (stdout, stderr)
+            or kwargs.get('privileged')):
+        # run background process asynchronously and filter output as it is
+        # running
+        return runcoroutine(runasync(cmd, stdout, stderr, timeout, category,
+                                     **kwargs))
+
+    with _redirects(stdout, stderr) as redirects:
+        outarg, errarg, _, _, wantstdout, wantstderr = redirects
+        exitcode, out, err = getscheduler().run(
+            cmd, outarg, errarg, timeout, category, kwargs)
+        return (exitcode,
+                out if wantstdout else None,
+                err if wantstderr else None)
+
+
+async def runasync(
+    cmd: Sequence[str | os.PathLike],
+    stdout: int | bool | Literal["SPOOL"] | IO | Callable | None = None,
+    stderr: (int | bool | Literal["STDOUT", "SPOOL"] | TextIOWrapper |
+             Callable | None) = None,
+    timeout: Optional[float] = None,
+    category: Optional[str] = None,
+    **kwargs: Any,
+) -> tuple[int, Any, Any]:
+    """
+    A coroutine version of run() which takes the same arguments. Several
+    processes can be run at once by awaiting more than one runasync() on
+    homely's event loop (see homely._asyncioutils.runcoroutine()).
+    """
+    spoolout = spoolerr = None
+    if stdout == "SPOOL":
+        spoolout = CapturedOutput()
+    if stderr == "SPOOL":
+        spoolerr = CapturedOutput()
+    try:
+        with _redirects(spoolout or stdout, spoolerr or stderr) as redirects:
+            (outarg, errarg, stdoutfilter, stderrfilter,
+             wantstdout, wantstderr) = redirects
+            exitcode, out, err = await getscheduler().runasync(
+                cmd, outarg, errarg, stdoutfilter, stderrfilter, timeout,
+                category, kwargs)
+    except BaseException:
+        for spool in (spoolout, spoolerr):
+            if spool is not None:
+                spool.close()
+        raise
+    return (exitcode,
+            spoolout or (out if wantstdout else None),
+            spoolerr or (err if wantstderr else None))
+
+
 def haveexecutable(name: str) -> bool:
     exitcode = run(['which', name], stdout=False, stderr=False)[0]
     if exitcode == 0:
@@ -464,8 +653,83 @@ class NoChangesNeeded(Exception):
     """See filereplacer() for more info"""
 
 
+# Possible values for the durability policy used by filereplacer():
+# - FSYNC_NONE: leave it to the OS to write the new file to disk
+# - FSYNC_FILE: fsync() the new file before it replaces the original
+# - FSYNC_DIR: also fsync() the parent dir after the file is replaced
+FSYNC_NONE = "none"
+FSYNC_FILE = "file"
+FSYNC_DIR = "file+dir"
+
+_DURABILITY: Optional[str] = None
+
+
+def setdurability(value: Optional[str]) -> None:
+    """
+    Set the durability policy used by filereplacer(). When set to None (the
+    default) the policy is taken from the $HOMELY_FSYNC environment variable,
+    or FSYNC_FILE if that isn't set.
+    """
+    assert value in (None, FSYNC_NONE, FSYNC_FILE, FSYNC_DIR)
+    global _DURABILITY
+    _DURABILITY = value
+
+
+def getdurability() -> str:
+    if _DURABILITY is not None:
+        return _DURABILITY
+    # an unknown $HOMELY_FSYNC is reported by the CLI, see badfsync()
+    if badfsync() is not None:
+        return FSYNC_FILE
+    return os.getenv("HOMELY_FSYNC", FSYNC_FILE)
+
+
+def badfsync() -> Optional[str]:
+    """
+    Return the value of $HOMELY_FSYNC if it isn't a durability policy, or
+    None if it is.
+    """
+    value = os.getenv("HOMELY_FSYNC", FSYNC_FILE)
+    return None if value in (FSYNC_NONE, FSYNC_FILE, FSYNC_DIR) else value
+
+
+def _fsyncdir(dirname: str) -> None:
+    dirfd = os.open(dirname, os.O_RDONLY)
+    try:
+        os.fsync(dirfd)
+    finally:
+        os.close(dirfd)
+
+
+def _readumask() -> int:
+    # os.umask() can only read the umask by changing it, which would affect
+    # files created by other threads in the meantime, so this is only done
+    # while homely is being imported
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+
+_UMASK = _readumask()
+
+
+def _getumask() -> int:
+    # linux shows the current umask without needing to change it
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('Umask:'):
+                    return int(line.split()[1], 8)
+    except OSError:
+        pass
+    return _UMASK
+
+
 @contextlib.contextmanager
-def filereplacer(filepath: str) -> Iterator[tuple[TextIOWrapper, Optional[Iterable[str]], str]]:
+def filereplacer(
+    filepath: str,
+    durability: Optional[str] = None,
+) -> Iterator[tuple[TextIOWrapper, Optional[Iterable[str]], str]]:
     """
     This context manager yields two file pointers:
 
@@ -477,9 +741,14 @@ def filereplacer(filepath: str) -> Iterator[tuple[TextIOWrapper, Optional[Iterab
         one of "\n", "\r\n" or "\r" depending on what is encountered first in
         orig. If orig is empty or doesn't exist, then "\n" is used.
 
-    Note that upon successful exiting of the context manager, the file
-    nominated by filepath will be replaced by the temp file. This will be done
-    using file renames, so it is as close to atomic as we can get it.
+    The temp file is created with a unique name in the same directory as
+    filepath, and is given the same permissions as the original file. Upon
+    successful exiting of the context manager, the file nominated by filepath
+    will be replaced by the temp file using os.replace(), so the change is
+    atomic.
+
+    The durability argument is one of FSYNC_NONE, FSYNC_FILE or FSYNC_DIR. If
+    omitted, the policy from getdurability() is used.
 
     If the context block raises an exception, the original file is not changed,
     and the temp file is deleted.
@@ -487,16 +756,17 @@ def filereplacer(filepath: str) -> Iterator[tuple[TextIOWrapper, Optional[Iterab
     If the context block raises a NoChangesNeeded exception, then any changes
     to tmpfile are discarded.
     """
-    # create the tmp dir if it doesn't exist yet
-    tmpdir = join(ROOT, 'tmp')
-    if not os.path.exists(tmpdir):
-        os.makedirs(tmpdir, mode=0o700)
-    tmpname = join(tmpdir, os.path.basename(filepath))
+    if durability is None:
+        durability = getdurability()
+    assert durability in (FSYNC_NONE, FSYNC_FILE, FSYNC_DIR)
+    dirname, basename = os.path.split(filepath)
+    fd, tmpname = tempfile.mkstemp(prefix='.%s.' % basename,
+                                   suffix='.homely-tmp',
+                                   dir=dirname)
     try:
-        if exists(filepath):
-            shutil.copy2(filepath, tmpname)
-        with opentext(tmpname, 'w') as tmp:
-            if os.path.exists(filepath):
+        with opentext(fd, 'w') as tmp:
+            if exists(filepath):
+                shutil.copymode(filepath, tmpname)
                 with opentext(filepath, 'r') as orig:
                     NL = "\n"
                     origlines: Iterable[str] = []
@@ -505,7 +775,7 @@ def filereplacer(filepath: str) -> Iterator[tuple[TextIOWrapper, Optional[Iterab
                         break
                     if firstline is not None:
                         stripped = firstline.rstrip('\r\n')
-                        NL = firstline[len(stripped):]
+                        NL = firstline[len(stripped):] or "\n"
                         assert NL in ("\r", "\n", "\r\n"), "Bad NL %r" % NL
                         origlines = chain(
                             [stripped],
@@ -513,17 +783,323 @@ def filereplacer(filepath: str) -> Iterator[tuple[TextIOWrapper, Optional[Iterab
                         )
                     yield tmp, origlines, NL
             else:
+                # mkstemp() creates files that only we can read, so give the
+                # new file the permissions that open() would have
+                os.chmod(tmpname, 0o666 & ~_getumask())
                 yield tmp, None, "\n"
+            if durability != FSYNC_NONE:
+                tmp.flush()
+                os.fsync(tmp.fileno())
     except NoChangesNeeded:
-        if os.path.exists(tmpname):
-            os.unlink(tmpname)
-    except Exception:
-        if os.path.exists(tmpname):
-            os.unlink(tmpname)
+        os.unlink(tmpname)
+        return
+    except BaseException:
+        os.unlink(tmpname)
         raise
-    if os.path.exists(filepath):
-        os.unlink(filepath)
-    shutil.move(tmpname, filepath)
+    os.replace(tmpname, filepath)
+    _PARSED.pop(filepath, None)
+    if durability == FSYNC_DIR:
+        _fsyncdir(dirname)
+
+
+class TextFile:
+    """
+    The contents of a text file, split into lines with their line endings
+    removed.
+
+    lines:
+        a list of the lines in the file, or None if the file doesn't exist.
+    NL:
+        one of "\n", "\r\n" or "\r", detected the same way as in
+        filereplacer().
+
+    TextFile objects returned by readtext() may be shared with other helpers,
+    so use copy() before modifying one.
+    """
+
+    def __init__(self, filepath: str, lines: Optional[list[str]], NL: str) -> None:
+        self.filepath = filepath
+        self.NL = NL
+        self._lines = lines
+        self._index: Optional[dict[str, list[int]]] = None
+
+    @property
+    def lines(self) -> Optional[list[str]]:
+        return self._lines
+
+    @lines.setter
+    def lines(self, lines: Optional[list[str]]) -> None:
+        self._lines = lines
+        self._index = None
+
+    def positions(self, line: str) -> list[int]:
+        """
+        Returns the (0-based) positions at which <line> appears in the file.
+        """
+        if self._lines is None:
+            return []
+        if self._index is None:
+            index: dict[str, list[int]] = {}
+            for pos, each in enumerate(self._lines):
+                try:
+                    index[each].append(pos)
+                except KeyError:
+                    index[each] = [pos]
+            self._index = index
+        return self._index.get(line, [])
+
+    def copy(self) -> "TextFile":
+        lines = None if self._lines is None else list(self._lines)
+        return TextFile(self.filepath, lines, self.NL)
+
+    @classmethod
+    def load(class_, filepath: str) -> "TextFile":
+        """
+        Returns a TextFile for <filepath>. Files are only parsed again if
+        their inode, mtime or size has changed since they were last loaded.
+        """
+        try:
+            st = os.stat(filepath)
+        except FileNotFoundError:
+            _PARSED.pop(filepath, None)
+            return class_(filepath, None, "\n")
+        key = (st.st_ino, st.st_mtime_ns, st.st_size)
+        cached = _PARSED.get(filepath)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        lines: list[str] = []
+        NL = "\n"
+        with opentext(filepath, 'r') as f:
+            for line in f:
+                stripped = line.rstrip('\r\n')
+                if not lines:
+                    NL = line[len(stripped):] or "\n"
+                    assert NL in ("\r", "\n", "\r\n"), "Bad NL %r" % NL
+                lines.append(stripped)
+        textfile = class_(filepath, lines, NL)
+        _PARSED[filepath] = (key, textfile)
+        return textfile
+
+    def save(self) -> None:
+        assert self._lines is not None
+        with filereplacer(self.filepath) as (tmp, origlines, NL):
+            for line in self._lines:
+                tmp.write(line)
+                tmp.write(self.NL)
+
+
+# cache of files parsed by TextFile.load() during this run, keyed by path.
+# Each entry also holds the (inode, mtime_ns, size) of the file when it was
+# parsed so that stale entries are never used.
+_PARSED: dict[str, tuple[tuple[int, int, int], TextFile]] = {}
+
+
+def forgetparsed() -> None:
+    """Empty the cache of files parsed by TextFile.load()."""
+    _PARSED.clear()
+
+
+class EditBatch:
+    """
+    Holds the TextFiles modified by helpers while batchedits() is active, so
+    that each file is only read once and written once.
+    """
+
+    def __init__(self) -> None:
+        self._files: dict[str, TextFile] = {}
+        self._modified: list[str] = []
+
+    def get(self, filepath: str) -> TextFile:
+        try:
+            return self._files[filepath]
+        except KeyError:
+            textfile = self._files[filepath] = TextFile.load(filepath).copy()
+            return textfile
+
+    def setmodified(self, textfile: TextFile) -> None:
+        assert self._files.get(textfile.filepath) is textfile
+        if textfile.filepath not in self._modified:
+            self._modified.append(textfile.filepath)
+
+    def commit(self) -> None:
+        # write out modified files in the order they were first modified, and
+        # forget everything we've read so that the next read goes to disk
+        modified, self._modified = self._modified, []
+        files, self._files = self._files, {}
+        for filepath in modified:
+            files[filepath].save()
+
+
+_EDITBATCH: Optional[EditBatch] = None
+
+
+@contextlib.contextmanager
+def batchedits() -> Iterator[None]:
+    """
+    While this context manager is active, text files modified by lineinfile()
+    and blockinfile() are read once and held in memory, and all the changes to
+    each file are written back in a single atomic rewrite when the block
+    exits. Nested batches become part of the outermost batch.
+
+    The Engine commits the batch early before running any helper that doesn't
+    work with batches, so files are never stale when other helpers look at
+    them. However, your own code shouldn't read or modify the affected files
+    directly inside the block.
+    """
+    global _EDITBATCH
+    if _EDITBATCH is not None:
+        yield
+        return
+    _EDITBATCH = EditBatch()
+    try:
+        yield
+    finally:
+        # the changes are committed even if there was an exception, because
+        # the Engine has already recorded cleaners for them
+        batch, _EDITBATCH = _EDITBATCH, None
+        batch.commit()
+
+
+def commitedits() -> None:
+    """Write out any changes being held by batchedits()."""
+    if _EDITBATCH is not None:
+        _EDITBATCH.commit()
+
+
+def readtext(filepath: str) -> TextFile:
+    """
+    Returns a TextFile for <filepath>. When batchedits() is active this will
+    include any changes that haven't been written to disk yet.
+    """
+    if _EDITBATCH is not None:
+        return _EDITBATCH.get(filepath)
+    return TextFile.load(filepath)
+
+
+@contextlib.contextmanager
+def modifytext(filepath: str) -> Iterator[TextFile]:
+    """
+    This context manager yields a TextFile for <filepath>. The context block
+    should assign a new list to its .lines attribute, which will be written
+    to <filepath> when the block exits successfully. If batchedits() is
+    active, the write is deferred until the batch is committed.
+
+    If the context block raises an exception, the file is not changed.
+    """
+    if _EDITBATCH is not None:
+        textfile = _EDITBATCH.get(filepath)
+        yield textfile
+        _EDITBATCH.setmodified(textfile)
+        return
+    textfile = TextFile.load(filepath).copy()
+    yield textfile
+    textfile.save()
+
+
+def filedigest(filepath: str) -> str:
+    """
+    Returns the sha256 hexdigest of the contents of <filepath>.
+    """
+    h = hashlib.sha256()
+    buf = bytearray(1024 * 1024)
+    view = memoryview(buf)
+    with open(filepath, 'rb', buffering=0) as f:
+        while True:
+            size = f.readinto(buf)
+            if not size:
+                break
+            h.update(view[:size])
+    return h.hexdigest()
+
+
+# from <linux/fs.h>
+FICLONE = 0x40049409
+
+# errors that mean a fast copy method isn't supported for this pair of files
+_NOFASTCOPY = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP,
+               errno.ENOTSUP, errno.EBADF, errno.EPERM, errno.ENOTTY)
+
+
+def _copydata(infd: int, outfd: int) -> None:
+    # try a reflink first so the copy shares its blocks with the original
+    if sys.platform.startswith('linux'):
+        import fcntl
+        try:
+            fcntl.ioctl(outfd, FICLONE, infd)
+            return
+        except OSError as err:
+            if err.errno not in _NOFASTCOPY:
+                raise
+
+    # copy_file_range() and sendfile() both copy the data inside the kernel.
+    # If either of them fails before copying anything we can try the next
+    # method.
+    size = os.fstat(infd).st_size
+    copied = 0
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while True:
+                sent = os.copy_file_range(infd, outfd, max(size - copied, 1024 * 1024))
+                if sent == 0:
+                    return
+                copied += sent
+        except OSError as err:
+            if copied or err.errno not in _NOFASTCOPY:
+                raise
+
+    try:
+        while True:
+            sent = os.sendfile(outfd, infd, copied, max(size - copied, 1024 * 1024))
+            if sent == 0:
+                return
+            copied += sent
+    except OSError as err:
+        if copied or err.errno not in _NOFASTCOPY:
+            raise
+
+    while True:
+        chunk = os.read(infd, 1024 * 1024)
+        if not chunk:
+            return
+        os.write(outfd, chunk)
+
+
+def copyfilefast(src: str, dst: str, durability: Optional[str] = None) -> None:
+    """
+    Atomically replace <dst> with a copy of <src>, using a reflink if the
+    filesystem supports it, otherwise copy_file_range(), sendfile(), or plain
+    reads and writes, in that order of preference. The file contents never pass
+    through python objects except in the last case.
+
+    The new file gets the permissions of <src>. See filereplacer() for the
+    meaning of <durability>.
+    """
+    if durability is None:
+        durability = getdurability()
+    assert durability in (FSYNC_NONE, FSYNC_FILE, FSYNC_DIR)
+    dirname, basename = os.path.split(dst)
+    outfd, tmpname = tempfile.mkstemp(prefix='.%s.' % basename,
+                                      suffix='.homely-tmp',
+                                      dir=dirname)
+    try:
+        try:
+            infd = os.open(src, os.O_RDONLY)
+            try:
+                _copydata(infd, outfd)
+            finally:
+                os.close(infd)
+            if durability != FSYNC_NONE:
+                os.fsync(outfd)
+        finally:
+            os.close(outfd)
+        shutil.copymode(src, tmpname)
+    except BaseException:
+        os.unlink(tmpname)
+        raise
+    os.replace(tmpname, dst)
+    _PARSED.pop(dst, None)
+    if durability == FSYNC_DIR:
+        _fsyncdir(dirname)
 
 
 def isnecessarypath(parent: str, child: str) -> bool:
@@ -556,7 +1132,6 @@ def isnecessarypath(parent: str, child: str) -> bool:
     parts = child.split('/')
     while len(parts):
         prefix = os.path.realpath(join(prefix, parts.pop(0)))
-        common = os.path.commonprefix([prefix, head])
 
         # if at any time we stumble upon the parent as we are reconstructing
         # the path, then we are dependent on the parent
@@ -565,7 +1140,7 @@ def isnecessarypath(parent: str, child: str) -> bool:
 
         # if they refer to the same thing up to this point, check to see if the
         # next parts are also the same
-        if len(common) == len(head):
+        if prefix == head:
             # if the next item of child's path is the tail of parent, then they
             # must refer to the same thing
             if len(parts) and tail == parts[0]:
@@ -586,62 +1161,6 @@ def tmpdir(name: str) -> Iterator[str]:
             shutil.rmtree(tmp)
 
 
-class UpdateStatus(Enum):
-    OK = "ok"
-    NEVER = "never"
-    RUNNING = "running"
-    FAILED = "failed"
-    NOCONN = "noconn"
-    DIRTY = "dirty"
-    PAUSED = "paused"
-
-
-STATUSCODES = {
-    UpdateStatus.OK: 0,
-    UpdateStatus.NEVER: 2,
-    UpdateStatus.RUNNING: 3,
-    UpdateStatus.FAILED: 4,
-    UpdateStatus.NOCONN: 5,
-    UpdateStatus.DIRTY: 6,
-    UpdateStatus.PAUSED: 7,
-}
-
-
-def getstatus() -> tuple[UpdateStatus, Optional[float], Optional[str]]:
-    """Get the status of the previous 'homely update', or any 'homely update'
-    that may be running in another process.
-    """
-    if exists(RUNFILE):
-        with open(SECTIONFILE) as f:
-            section = f.read().strip()
-        # what section?
-        return UpdateStatus.RUNNING, os.stat(RUNFILE).st_mtime, section
-    if exists(PAUSEFILE):
-        return UpdateStatus.PAUSED, None, None
-
-    mtime = None
-    if exists(TIMEFILE):
-        mtime = os.stat(TIMEFILE).st_mtime
-
-    if exists(FAILFILE):
-        if not mtime:
-            mtime = os.stat(FAILFILE).st_mtime
-        # TODO: return a different error code when the error was inability to
-        # contact one or more remote servers
-        with open(FAILFILE) as f:
-            content = f.read().strip()
-            if content == UpdateStatus.NOCONN.value:
-                return UpdateStatus.NOCONN, mtime, None
-            elif content == UpdateStatus.DIRTY.value:
-                return UpdateStatus.DIRTY, mtime, None
-        return UpdateStatus.FAILED, mtime, None
-
-    if mtime is None:
-        return UpdateStatus.NEVER, None, None
-
-    return UpdateStatus.OK, mtime, None
-
-
 def _time_interval_to_delta(input: Union[str, timedelta]) -> timedelta:
     if isinstance(input, timedelta):
         return input
@@ -137,9 +137,8 @@ class Repo(homely._vcs.Repo):
 
     def isdirty(self) -> bool:
         cmd = ['git', 'status', '--porcelain']
-        out = execute(cmd, cwd=self.repo_path, stdout=True)[1]
-        assert isinstance(out, bytes)  # TODO: replace this with a type check
-        for line in out.split(b'\n'):
-            if len(line) and not line.startswith(b'?? '):
-                return True
+        with execute(cmd, cwd=self.repo_path, stdout="SPOOL")[1] as out:
+            for line in out.lines():
+                if len(line) and not line.startswith('?? '):
+                    return True
         return False
@@ -1,6 +1,7 @@
+import filecmp
 import os
 import shutil
-from typing import Optional
+from typing import Iterable, Optional
 
 import homely._vcs
 from homely._ui import note
@@ -12,6 +13,64 @@ ORIGINFILE = '.origin'
 DIRTYFILE = '.dirty'
 
 
+def _unchanged(src: "os.DirEntry[str]", dst: "os.DirEntry[str]") -> bool:
+    if dst.is_symlink() or dst.is_dir():
+        return False
+    a = src.stat()
+    b = dst.stat()
+    if a.st_size != b.st_size or a.st_mtime_ns != b.st_mtime_ns:
+        return False
+    # Timestamps are only as precise as the kernel's clock tick, so a file
+    # which was changed in the same tick as it was last copied could have the
+    # same size and mtime as the old copy. Like git's "racily clean" files,
+    # these have to be compared byte by byte.
+    if a.st_mtime_ns >= b.st_ctime_ns:
+        return filecmp.cmp(src.path, dst.path, shallow=False)
+    return True
+
+
+def _sync(origin: str,
+          local: str,
+          ignore: Iterable[str] = (),
+          protect: Iterable[str] = ()) -> None:
+    """
+    Make <local> a copy of <origin> the way rsync would: only files whose size
+    or modification time differ are copied, and only things which are no
+    longer in <origin> are removed. Names in <ignore> are never copied from
+    <origin>, and names in <protect> are never removed from <local>.
+    """
+    with os.scandir(origin) as it:
+        wanted = {e.name: e for e in it if e.name not in ignore}
+    with os.scandir(local) as it:
+        existing = {e.name: e for e in it}
+
+    for name, entry in list(existing.items()):
+        src = wanted.get(name)
+        if src is None:
+            if name in protect:
+                continue
+        elif src.is_dir() == entry.is_dir() and not entry.is_symlink():
+            continue
+        del existing[name]
+        if entry.is_dir(follow_symlinks=False):
+            note('rmtree %s' % entry.path)
+            shutil.rmtree(entry.path)
+        else:
+            note('rm -f %s' % entry.path)
+            os.unlink(entry.path)
+
+    for name, src in wanted.items():
+        dst = existing.get(name)
+        dstpath = os.path.join(local, name)
+        if src.is_dir():
+            if dst is None:
+                shutil.copytree(src.path, dstpath)
+            else:
+                _sync(src.path, dstpath)
+        elif dst is None or not _unchanged(src, dst):
+            shutil.copy2(src.path, dstpath)
+
+
 class Repo(homely._vcs.Repo):
     type_ = homely._vcs.RepoType.HANDLER_TESTHANDLER_v1
     pulldesc = 'fake repo pull'
@@ -48,27 +107,10 @@ class Repo(homely._vcs.Repo):
         self._pull(origin, dest_path)
 
     def _pull(self, origin: str, local: str) -> None:
-        # delete every local file except the special ones
-        for thing in os.listdir(local):
-            if thing not in (ORIGINFILE, MARKERFILE, DIRTYFILE):
-                destroyme = os.path.join(local, thing)
-                if os.path.isdir(destroyme):
-                    note('rmtree %s' % destroyme)
-                    shutil.rmtree(destroyme)
-                else:
-                    note('rm -f %s' % destroyme)
-                    os.unlink(destroyme)
-
-        # now copy stuff across
-        for thing in os.listdir(origin):
-            if thing in (ORIGINFILE, DIRTYFILE):
-                continue
-            src = os.path.join(origin, thing)
-            dst = os.path.join(local, thing)
-            if os.path.isdir(src):
-                shutil.copytree(src, dst)
-            else:
-                shutil.copy2(src, dst)
+        _sync(origin,
+              local,
+              ignore=(ORIGINFILE, DIRTYFILE),
+              protect=(ORIGINFILE, MARKERFILE, DIRTYFILE))
 
     def pullchanges(self) -> None:
         assert not self.isdirty()
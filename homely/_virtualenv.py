@@ -3,6 +3,8 @@ from enum import Enum
 from pathlib import Path
 from typing import Optional
 
+from homely._utils import loadtoml
+
 
 class PythonManager(Enum):
     UV = "uv"
@@ -20,20 +22,8 @@ class RepoVirtualenvConfig:
 
     @classmethod
     def from_pyproject_toml(cls, pyproject_path: Path) -> "RepoVirtualenvConfig":
-        try:
-            # we need a type-ignore here because tomllib is only in Python
-            # 3.11+ and mypy is configured to check against 3.10 stdlib.
-            import tomllib  # type: ignore
-        except ImportError:
-            # NOTE: this needs a type-ignore for mypy checking against python3.14 which won't have tomli
-            import tomli as tomllib  # type: ignore
-
-        with pyproject_path.open('rb') as f:
-            try:
-                toml_dict = tomllib.load(f)
-            except tomllib.TOMLDecodeError:
-                # FIXME: raise a better exception here
-                raise
+        # FIXME: raise a better exception when the file isn't valid TOML
+        toml_dict = loadtoml(pyproject_path)
 
         try:
             venv_table = toml_dict['tool']['homely']['virtualenv']
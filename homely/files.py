@@ -1,17 +1,23 @@
+import hashlib
+import locale
 import os
 import time
 from contextlib import contextmanager
-from copy import copy
 from io import StringIO
 
 from homely._engine2 import Cleaner, Engine, Helper, getengine, getrepoinfo
 from homely._errors import HelperError
+from homely._ui import note, warn
 from homely._utils import (NoChangesNeeded, _homepath2real, _repopath2real,
-                           filereplacer, isnecessarypath)
+                           batchedits, copyfilefast, filedigest, filereplacer,
+                           isnecessarypath, modifytext, readtext)
 
 __all__ = [
+    "batchedits",
+    "copyfile",
     "mkdir",
     "symlink",
+    "symlinkdir",
     "lineinfile",
     "blockinfile",
     "WHERE_TOP",
@@ -27,6 +33,12 @@ WHERE_ANY = "__ANY__"
 WHERE_END = WHERE_BOT  # TODO: remove this deprecated alias
 
 
+def copyfile(source, dest):
+    # expand <source> to a path relative to the current repo
+    source = _repopath2real(source, getrepoinfo().localrepo)
+    getengine().run(CopyFile(source, _homepath2real(dest)))
+
+
 def download(url, dest, expiry=None):
     # possible values of expiry:
     # 0:     always download again
@@ -56,14 +68,25 @@ def symlink(target, linkname=None):
     getengine().run(MakeSymlink(target, linkname))
 
 
+def symlinkdir(target, linkdir=None):
+    # expand <target> to a path relative to the current repo
+    target = _repopath2real(target, getrepoinfo().localrepo)
+
+    # if [linkdir] is omitted, the symlinks go into $HOME/
+    if linkdir is None:
+        linkdir = os.environ.get('HOME')
+    else:
+        linkdir = _homepath2real(linkdir)
+    getengine().run(MakeSymlinkDir(target, linkdir))
+
+
 @contextmanager
 def writefile(filename):
     stream = None
     try:
         stream = StringIO()
         yield stream
-        stream.seek(0)
-        getengine().run(WriteFile(_homepath2real(filename), stream.read()))
+        getengine().run(WriteFile(_homepath2real(filename), stream.getvalue()))
     finally:
         if stream:
             stream.close()
@@ -204,7 +227,194 @@ class MakeSymlink(Helper):
         return {self._linkname: Engine.TYPE_LINK}
 
 
+class MakeSymlinkDir(Helper):
+    """
+    Creates a symlink in <linkdir> for every entry in the directory <target>.
+
+    A manifest of the symlinks we created is stored as a fact, recording the
+    inode and mtime of each one. Symlinks can't be modified in place, so if
+    lstat() still reports the same inode and mtime then the symlink is still
+    the one we made and there's no need to readlink() it. Symlinks which
+    already existed aren't in the manifest, so they are never removed.
+    """
+
+    def __init__(self, target, linkdir):
+        assert target.startswith('/')
+        assert linkdir.startswith('/')
+        self._target = target
+        self._linkdir = linkdir
+        assert self._target != self._linkdir
+        try:
+            with os.scandir(target) as it:
+                self._names = sorted(entry.name for entry in it)
+        except (FileNotFoundError, NotADirectoryError):
+            raise HelperError("Can't create symlinks for the entries in {}:"
+                              " it is not a directory".format(target))
+        self._factname = '{}:{}:{}'.format(self.__class__.__name__,
+                                           linkdir,
+                                           target)
+
+    def getclaims(self):
+        return []
+
+    def getcleaner(self):
+        return CleanSymlinkDir(self._target, self._linkdir, self._names)
+
+    def _conflict(self, name):
+        # returns a description of what is in the way of the symlink for
+        # <name>, if anything
+        source = os.path.join(self._target, name)
+        linkname = os.path.join(self._linkdir, name)
+        if os.path.islink(linkname):
+            if os.readlink(linkname) != source:
+                return ("Symlink %s is not pointing at %s"
+                        % (linkname, source))
+        elif os.path.exists(linkname):
+            return "%s already exists" % linkname
+        return None
+
+    def isdone(self):
+        manifest = self._getfact(self._factname, {})
+        if not set(manifest) <= set(self._names):
+            # there are symlinks to remove
+            return False
+        conflicts = []
+        for name in self._names:
+            linkname = os.path.join(self._linkdir, name)
+            if name in manifest:
+                try:
+                    st = os.lstat(linkname)
+                except FileNotFoundError:
+                    return False
+                if [st.st_ino, st.st_mtime_ns] == manifest[name]:
+                    continue
+            if not os.path.lexists(linkname):
+                return False
+            conflict = self._conflict(name)
+            if conflict is not None:
+                conflicts.append(conflict)
+            elif name in manifest:
+                # our symlink was replaced by an identical one
+                return False
+        # things which are in the way won't go away by trying again
+        for conflict in conflicts:
+            warn(conflict)
+        return True
+
+    @property
+    def description(self):
+        return "Create symlinks in %s for %d entries in %s" % (
+            self._linkdir, len(self._names), self._target)
+
+    def makechanges(self):
+        old = self._getfact(self._factname, {})
+        manifest = {}
+        problems = []
+
+        # remove the symlinks we made for entries which have gone from the
+        # target dir
+        for name in sorted(set(old) - set(self._names)):
+            linkname = os.path.join(self._linkdir, name)
+            if (os.path.islink(linkname) and
+                    os.readlink(linkname) == os.path.join(self._target, name)):
+                note("Removing symlink %s" % linkname)
+                os.unlink(linkname)
+
+        for name in self._names:
+            source = os.path.join(self._target, name)
+            linkname = os.path.join(self._linkdir, name)
+            if os.path.lexists(linkname):
+                conflict = self._conflict(name)
+                if conflict is not None:
+                    problems.append(conflict)
+                    continue
+                if name not in old:
+                    # the symlink was already there, so it isn't ours
+                    continue
+            else:
+                os.symlink(source, linkname)
+            st = os.lstat(linkname)
+            manifest[name] = [st.st_ino, st.st_mtime_ns]
+
+        self._setfact(self._factname, manifest)
+
+        if len(problems):
+            raise HelperError("; ".join(problems))
+
+    def affectspath(self, path):
+        return (os.path.dirname(path) == self._linkdir and
+                os.path.basename(path) in self._names)
+
+    def pathsownable(self):
+        # the symlinks are cleaned up by CleanSymlinkDir rather than being
+        # recorded individually
+        return {}
+
+
+class CleanSymlinkDir(Cleaner):
+    def __init__(self, target, linkdir, names):
+        self._target = target
+        self._linkdir = linkdir
+        self._names = names
+        self._factname = '{}:{}:{}'.format(MakeSymlinkDir.__name__,
+                                           linkdir,
+                                           target)
+
+    @property
+    def description(self):
+        return "Remove symlinks in %s for entries in %s" % (self._linkdir,
+                                                            self._target)
+
+    def asdict(self):
+        return dict(target=self._target,
+                    linkdir=self._linkdir,
+                    names=self._names)
+
+    @classmethod
+    def fromdict(class_, data):
+        return class_(data["target"], data["linkdir"], data["names"])
+
+    def __eq__(self, other):
+        # NOTE: the list of names isn't compared, so that the Engine replaces
+        # the old record with one holding the current list of names
+        return (other._target == self._target and
+                other._linkdir == self._linkdir)
+
+    def _ourlinks(self):
+        # only the symlinks in the manifest were created by MakeSymlinkDir
+        for name in self._getfact(self._factname, {}):
+            linkname = os.path.join(self._linkdir, name)
+            if (os.path.islink(linkname) and
+                    os.readlink(linkname) == os.path.join(self._target, name)):
+                yield linkname
+
+    def isneeded(self):
+        for linkname in self._ourlinks():
+            return True
+        return False
+
+    def wantspath(self, path):
+        for name in self._names:
+            linkname = os.path.join(self._linkdir, name)
+            if path == linkname or isnecessarypath(path, linkname):
+                return True
+        return False
+
+    def makechanges(self):
+        removed = []
+        for linkname in list(self._ourlinks()):
+            os.unlink(linkname)
+            removed.append(linkname)
+        self._clearfact(self._factname)
+        return removed
+
+    def needsclaims(self):
+        return []
+
+
 class LineInFile(Helper):
+    batchable = True
+
     def __init__(self, filename, contents, where=None):
         super(LineInFile, self).__init__()
         self._filename = filename
@@ -233,48 +443,41 @@ class LineInFile(Helper):
         return CleanLineInFile(self._filename, self._contents)
 
     def isdone(self):
-        if not os.path.exists(self._filename):
+        text = readtext(self._filename)
+        if text.lines is None:
             return False
-        foundat = []
-        linecount = 0
-        with open(self._filename) as f:
-            for line in f.readlines():
-                linecount += 1
-                if line.rstrip('\r\n') == self._contents:
-                    foundat.append(linecount)
+        foundat = text.positions(self._contents)
         # if the line appears multiple times, we count it as NOT done
         if len(foundat) != 1:
             return False
         if self._where == WHERE_TOP:
-            return foundat[0] == 1
+            return foundat[0] == 0
         if self._where == WHERE_END:
-            return foundat[0] == linecount
+            return foundat[0] == len(text.lines) - 1
         return True
 
     def makechanges(self):
         # the content wasn't found in the file, so we'll have to add it
-        with filereplacer(self._filename) as (tmp, origlines, NL):
+        with modifytext(self._filename) as text:
+            newlines = []
             seen = False
             # if the new line goes at the top, write it out first
             if self._where == WHERE_TOP:
-                tmp.write(self._contents)
-                tmp.write(NL)
+                newlines.append(self._contents)
                 seen = True
             # read through the original file and look for a line to replace
-            if origlines is not None:
-                for line in origlines:
-                    if line == self._contents:
-                        # skip the line if it's already been seen before, or it
-                        # needs to move to the end of the file
-                        if seen or self._where == WHERE_END:
-                            continue
-                        seen = True
-                    tmp.write(line)
-                    tmp.write(NL)
+            for line in text.lines or []:
+                if line == self._contents:
+                    # skip the line if it's already been seen before, or it
+                    # needs to move to the end of the file
+                    if seen or self._where == WHERE_END:
+                        continue
+                    seen = True
+                newlines.append(line)
             if not seen:
                 assert self._where in (WHERE_END, WHERE_ANY)
-                tmp.write(self._contents)
-                tmp.write(NL)
+                newlines.append(self._contents)
+            text.lines = newlines
 
     def pathsownable(self):
         return {self._filename: Engine.TYPE_FILE_PART}
@@ -307,13 +510,7 @@ class CleanLineInFile(Cleaner):
                 other._contents == self._contents)
 
     def isneeded(self):
-        if not os.path.exists(self._filename):
-            return False
-        with open(self._filename) as f:
-            for line in f:
-                if line.rstrip("\r\n") == self._contents:
-                    return True
-        return False
+        return len(readtext(self._filename).positions(self._contents)) > 0
 
     def wantspath(self, path):
         return path == self._filename or isnecessarypath(path, self._filename)
@@ -342,6 +539,8 @@ class CleanLineInFile(Cleaner):
 
 
 class BlockInFile(Helper):
+    batchable = True
+
     def __init__(self, filename, lines, where, prefix, suffix):
         if os.path.basename(filename) == '.vimrc' or filename.endswith('.vim'):
             commentstart = '"'
@@ -380,79 +579,63 @@ class BlockInFile(Helper):
                                 )
 
     def isdone(self):
-        if not os.path.exists(self._filename):
+        text = readtext(self._filename)
+        if text.lines is None:
             return False
 
         # look to see if our contents appear in the file
-        with open(self._filename) as f:
-            firstline = True
-            count = 0
-            expect = None
-            prev = None
-            for line in f:
-                stripped = line.rstrip('\r\n')
-                if firstline and self._where == WHERE_TOP:
-                    if stripped != self._prefix:
-                        return False
-                if expect is not None:
-                    if stripped != expect.pop(0):
-                        return False
-                    if len(expect):
-                        prev = "INNER"
-                    else:
-                        prev = "SUFFIX"
-                        count += 1
-                elif stripped == self._prefix:
-                    expect = copy(self._lines)
-                    expect.extend(self._suffix)
-                    prev = "PREFIX"
-                else:
-                    prev = "OTHER"
-        if self._where == WHERE_END and prev != "SUFFIX":
+        starts = text.positions(self._prefix)
+        if not len(starts):
+            return False
+        start = starts[0]
+        end = start + len(self._lines) + 1
+        expect = [self._prefix] + list(self._lines) + [self._suffix]
+        if text.lines[start:end + 1] != expect:
+            return False
+        # the prefix must not appear again after the block
+        if starts[-1] > end:
             return False
-        return count == 1
+        if self._where == WHERE_TOP:
+            return start == 0
+        if self._where == WHERE_END:
+            return end == len(text.lines) - 1
+        return True
 
     def makechanges(self):
-        with filereplacer(self._filename) as (tmp, origlines, NL):
+        with modifytext(self._filename) as text:
+            newlines = []
             findsuffix = False
             found = False
 
             def _writeall():
-                tmp.write(self._prefix)
-                tmp.write(NL)
-                for line in self._lines:
-                    tmp.write(line)
-                    tmp.write(NL)
-                tmp.write(self._suffix)
-                tmp.write(NL)
+                newlines.append(self._prefix)
+                newlines.extend(self._lines)
+                newlines.append(self._suffix)
 
             if self._where == WHERE_TOP:
                 _writeall()
                 found = True
-            if origlines is not None:
-                for line in origlines:
-                    if findsuffix:
-                        # while we're looking for the suffix, discard any other
-                        # lines we encounter
-                        # encountered into a temporary holding area
-                        if line != self._suffix:
-                            continue
-
-                        # We've found the suffix! If we're allowed to write the
-                        # block out anywhere, and we haven't written it out
-                        # yet write it out here, now
-                        if self._where == WHERE_ANY and not found:
-                            _writeall()
-                            found = True
-                        findsuffix = False
+            for line in text.lines or []:
+                if findsuffix:
+                    # while we're looking for the suffix, discard any other
+                    # lines we encounter
+                    if line != self._suffix:
                         continue
 
-                    if line == self._prefix:
-                        findsuffix = True
-                        continue
+                    # We've found the suffix! If we're allowed to write the
+                    # block out anywhere, and we haven't written it out
+                    # yet write it out here, now
+                    if self._where == WHERE_ANY and not found:
+                        _writeall()
+                        found = True
+                    findsuffix = False
+                    continue
 
-                    tmp.write(line)
-                    tmp.write(NL)
+                if line == self._prefix:
+                    findsuffix = True
+                    continue
+
+                newlines.append(line)
 
             if findsuffix:
                 # FIXME: some sort of exception that we can handle nicely
@@ -467,6 +650,8 @@ class BlockInFile(Helper):
             if not found:
                 _writeall()
 
+            text.lines = newlines
+
     def affectspath(self, path):
         return path == self._filename
 
@@ -508,19 +693,11 @@ class CleanBlockInFile(Cleaner):
     def isneeded(self):
         # the cleaner is needed if both the prefix and the suffix are found in
         # the file, in the correct order
-        if not os.path.exists(self._filename):
-            return False
-
-        haveprefix = False
-
-        with open(self._filename) as f:
-            for line in [l.rstrip("\r\n") for l in f]:  # noqa: E741
-                if line == self._prefix:
-                    haveprefix = True
-                elif line == self._suffix and haveprefix:
-                    return True
-
-        return False
+        text = readtext(self._filename)
+        prefixes = text.positions(self._prefix)
+        suffixes = text.positions(self._suffix)
+        return (len(prefixes) > 0 and len(suffixes) > 0 and
+                suffixes[-1] > prefixes[0])
 
     def wantspath(self, path):
         return path == self._filename or isnecessarypath(path, self._filename)
@@ -551,34 +728,92 @@ class CleanBlockInFile(Cleaner):
         return []
 
 
+def _fingerprint(path):
+    st = os.stat(path)
+    return [st.st_ino, st.st_size, st.st_mtime_ns]
+
+
+class CleanFingerprint(Cleaner):
+    """
+    Forgets the fingerprint which WriteFile or CopyFile recorded for a file.
+    The file itself is cleaned up by the Engine, if homely created it.
+    """
+
+    def __init__(self, factname, filename):
+        self._factname = factname
+        self._filename = filename
+
+    @property
+    def description(self):
+        return "Forget fingerprint of %s" % self._filename
+
+    def asdict(self):
+        return dict(factname=self._factname, filename=self._filename)
+
+    @classmethod
+    def fromdict(class_, data):
+        return class_(data["factname"], data["filename"])
+
+    def __eq__(self, other):
+        return other._factname == self._factname
+
+    def isneeded(self):
+        return self._getfact(self._factname, None) is not None
+
+    def wantspath(self, path):
+        return False
+
+    def makechanges(self):
+        self._clearfact(self._factname)
+        return []
+
+    def needsclaims(self):
+        return []
+
+
 class WriteFile(Helper):
     def __init__(self, filename, contents):
         self._filename = filename
         self._contents = contents
+        # encode the contents the same way open(filename, 'w') would
+        self._data = contents.encode(locale.getpreferredencoding(False))
+        self._digest = hashlib.sha256(self._data).hexdigest()
+        self._factname = '{}:{}'.format(self.__class__.__name__, filename)
 
     @property
     def description(self):
         return "Write file %s" % self._filename
 
     def getcleaner(self):
-        # no cleaner needed
-        pass
+        return CleanFingerprint(self._factname, self._filename)
 
     def isdone(self):
         if os.path.islink(self._filename):
             return False
-        if os.path.exists(self._filename):
-            with open(self._filename, 'r') as f:
-                if f.read() == self._contents:
-                    return True
-        return False
+        try:
+            fingerprint = _fingerprint(self._filename)
+        except FileNotFoundError:
+            return False
+        # if the file hasn't been touched since we last wrote or checked it,
+        # we can trust the digest we recorded at that time
+        prev = self._getfact(self._factname, None)
+        if prev is not None and prev == [fingerprint, self._digest]:
+            return True
+        if fingerprint[1] != len(self._data):
+            return False
+        if filedigest(self._filename) != self._digest:
+            return False
+        self._setfact(self._factname, [fingerprint, self._digest])
+        return True
 
     def makechanges(self):
         if os.path.islink(self._filename):
             raise HelperError("{} is already a symlink"
                               .format(self._filename))
-        with open(self._filename, 'w') as f:
-            f.write(self._contents)
+        with open(self._filename, 'wb') as f:
+            f.write(self._data)
+        self._setfact(self._factname,
+                      [_fingerprint(self._filename), self._digest])
 
     def pathsownable(self):
         return {self._filename: Engine.TYPE_FILE_ALL}
@@ -588,3 +823,56 @@ class WriteFile(Helper):
 
     def getclaims(self):
         return []
+
+
+class CopyFile(Helper):
+    def __init__(self, source, dest):
+        assert source.startswith('/')
+        assert dest.startswith('/')
+        self._source = source
+        self._dest = dest
+        self._factname = '{}:{}'.format(self.__class__.__name__, dest)
+
+    @property
+    def description(self):
+        return "Copy file %s to %s" % (self._source, self._dest)
+
+    def getcleaner(self):
+        return CleanFingerprint(self._factname, self._dest)
+
+    def isdone(self):
+        if os.path.islink(self._dest):
+            return False
+        try:
+            destprint = _fingerprint(self._dest)
+        except FileNotFoundError:
+            return False
+        sourceprint = _fingerprint(self._source)
+        # if neither file has been touched since we last copied or checked
+        # them, then they must still be the same
+        prev = self._getfact(self._factname, None)
+        if prev is not None and prev == [self._source, sourceprint, destprint]:
+            return True
+        if sourceprint[1] != destprint[1]:
+            return False
+        if filedigest(self._source) != filedigest(self._dest):
+            return False
+        self._setfact(self._factname, [self._source, sourceprint, destprint])
+        return True
+
+    def makechanges(self):
+        if os.path.islink(self._dest):
+            raise HelperError("{} is already a symlink".format(self._dest))
+        copyfilefast(self._source, self._dest)
+        self._setfact(self._factname, [self._source,
+                                       _fingerprint(self._source),
+                                       _fingerprint(self._dest)])
+
+    def pathsownable(self):
+        return {self._dest: Engine.TYPE_FILE_ALL}
+
+    def affectspath(self, path):
+        return path == self._dest
+
+    def getclaims(self):
+        return []
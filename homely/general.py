@@ -3,7 +3,9 @@ from datetime import datetime, timedelta
 from typing import Optional
 
 from homely._engine2 import getengine, getrepoinfo
-from homely._ui import entersection, head, note, warn
+from homely._events import span
+from homely._profile import profiled
+from homely._ui import currentsection, entersection, head, note, warn
 # allow importing from outside
 from homely._utils import haveexecutable  # noqa
 from homely._utils import _loadmodule, _repopath2real, _time_interval_to_delta
@@ -34,7 +36,8 @@ def include(pyscript):
 
     name = '__imported_by_homely_{}'.format(_include_num)
     try:
-        with entersection("/" + pyscript):
+        with span("include", script=pyscript), \
+                entersection("/" + pyscript):
             return _loadmodule(name, path)
     except Exception:
         import traceback
@@ -96,7 +99,8 @@ def _execute_section(func, is_quick, is_enabled, interval: Optional[timedelta] =
         with entersection(":" + name + "()"):
             if engine.pushsection(name):
                 head("Executing @section {}()".format(name))
-                func()
+                with profiled(currentsection()):
+                    func()
                 if interval:
                     engine._setfact(last_run_fact_name, datetime.now().strftime(timeformat))
             else:
@@ -200,11 +200,16 @@ class InstallFromSource(Helper):
             # compilation has failed ...
             stdout = "TTY" if self._needs_tty else None
             for cmd in self._compile:
-                if cmd[0] == "sudo" and not _ALLOW_INSTALL:
-                    raise HelperError(
-                        "%s is not allowed to run commands as root"
-                        ", as per setallowinstall()")
-                execute(cmd, cwd=self._real_clone_to, stdout=stdout)
+                privileged = cmd[0] == "sudo"
+                if privileged:
+                    if not _ALLOW_INSTALL:
+                        raise HelperError(
+                            "%s is not allowed to run commands as root"
+                            ", as per setallowinstall()")
+                    # send the command to homely's privileged worker
+                    cmd = cmd[1:]
+                execute(cmd, cwd=self._real_clone_to, stdout=stdout,
+                        privileged=privileged)
 
             self._setfact(factname, (time.time(), self._compile))
 
@@ -290,8 +295,7 @@ class InstallPackage(Helper):
             if method in _ASROOT:
                 if not allowinteractive():
                     raise HelperError("Need to be able to escalate to root")
-                cmd.insert(0, 'sudo')
-            execute(cmd)
+            execute(cmd, privileged=method in _ASROOT)
             # record the fact that we installed this thing ourselves
             factname = 'InstalledPackage:%s:%s' % (method, localname)
             self._setfact(factname, True)
@@ -346,9 +350,8 @@ class PackageCleaner(Cleaner):
             if method in _ASROOT:
                 if not allowinteractive():
                     raise HelperError("Need to be able to escalate to root")
-                cmd.insert(0, 'sudo')
             try:
-                execute(cmd)
+                execute(cmd, privileged=method in _ASROOT)
                 return
             finally:
                 # always clear the fact
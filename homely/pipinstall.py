@@ -69,11 +69,11 @@ def _haspkg(pipcmd, name):
         '--disable-pip-version-check',
         '--format=freeze',
     ]
-    output = execute(cmd, stdout=True)[1]
     find = '%s==' % name
-    for line in output.decode('utf-8').split("\n"):
-        if line.startswith(find):
-            return True
+    with execute(cmd, stdout="SPOOL")[1] as output:
+        for line in output.lines():
+            if line.startswith(find):
+                return True
     return False
 
 
@@ -3,7 +3,9 @@ import time
 from datetime import datetime
 from subprocess import STDOUT, Popen
 
-from homely._utils import OUTFILE, UpdateStatus, getstatus
+from homely._control import request
+from homely._status import (OUTFILE, UpdateStatus, describeprogress,
+                            readrecord, recordstatus)
 
 _defaultcolors = {
     UpdateStatus.PAUSED: "information:priority",
@@ -22,7 +24,7 @@ _house = os.getenv("HOMELY_POWERLINE_HOUSE", "\U0001F3E0")
 
 _defaulttxt = {
     UpdateStatus.PAUSED: _house + "  ||",
-    UpdateStatus.RUNNING: _house + '  {time} {section}',
+    UpdateStatus.RUNNING: _house + '  {time} {section} {progress}',
     UpdateStatus.FAILED: _house + '  {time}',
     UpdateStatus.NOCONN: _house + "  {time} N/C",
     UpdateStatus.DIRTY: _house + "  {time} [dirty]",
@@ -33,6 +35,10 @@ _defaulttxt = {
 
 SUB = None
 
+# how long to wait for the daemon, since the prompt can't render until it
+# answers
+DAEMON_TIMEOUT = 0.2
+
 
 def shortstatus(pl,
                 colors={},
@@ -40,7 +46,10 @@ def shortstatus(pl,
                 autoupdate=None,
                 interval=60*60*20,
                 reattach_to_user_namespace=False):
-    status, timestamp, section = getstatus()
+    # ask the 'homely autoupdate --listen' daemon if there is one
+    reply = request("status", timeout=DAEMON_TIMEOUT)
+    record = readrecord() if reply is None else reply["record"]
+    status, timestamp, section = recordstatus(record)
 
     doupdate = False
     if autoupdate:
@@ -53,7 +62,11 @@ def shortstatus(pl,
 
     global SUB
 
-    if doupdate:
+    if doupdate and reply is not None:
+        # the daemon will only start one update no matter how many prompts
+        # ask for it
+        request("update", timeout=DAEMON_TIMEOUT)
+    elif doupdate:
         # NOTE: make use of reattach-to-user-namespace from homebrew if it is
         # present
         cmd = []
@@ -77,8 +90,13 @@ def shortstatus(pl,
     else:
         time_ = ""
 
+    progress = ""
+    if record.get("running"):
+        progress = describeprogress(record["running"])
+
     info = {
-        'contents': txt.format(section=section, time=time_),
+        'contents': txt.format(section=section, time=time_,
+                               progress=progress).rstrip(),
         'highlight_groups': [color],
     }
     return [info]
@@ -1,60 +1,42 @@
+import asyncio
 import shlex
 from functools import partial
+from itertools import count
 
-from homely._ui import allowinteractive, note, warn
-from homely._utils import haveexecutable, run
+from homely._asyncioutils import runcoroutine
+from homely._errors import CommandTimeout
+from homely._ui import allowinteractive, flushlog, note, warn
+from homely._utils import (CapturedOutput, LineSplitter, haveexecutable, run,
+                           runasync)
 
-__all__ = ["haveexecutable", "execute"]
+__all__ = ["haveexecutable", "execute", "execute_async", "execute_many"]
 
+# used to tell apart the output of subprocesses that are running concurrently
+_TAGS = count(1)
 
-def execute(cmd, stdout=None, stderr=None, expectexit=0, **kwargs):
-    # Executes `cmd` in a subprocess. Raises a SystemError if the exit code
-    # is different to `expecterror`.
-    #
-    # The stdout and stderr arguments for the most part work just like
-    # homely._ui.run(), with the main difference being that when stdout=None or
-    # stderr=None, these two streams will be filtered through the homely's
-    # logging functions instead of being sent directly to the python process's
-    # stdout/stderr. Also, the stderr argument will default to "STDOUT" so that
-    # the timing of the two streams is recorded more accurately.
-    #
-    # If the process absolutely _must_ talk to a TTY, you can use stdout="TTY",
-    # and a SystemError will be raised if homely is being run in
-    # non-interactive mode. When using stdout="TTY", you should omit the stderr
-    # argument.
-    def outputhandler(data, isend, prefix):
-        # FIXME: if we only get part of a stream, then we have a potential bug
-        # where we only get part of a multi-byte utf-8 character.
-        while len(data):
-            pos = data.find(b"\n")
-            if pos < 0:
-                break
-            # write out the line
-            note(data[0:pos].decode('utf-8'), dash=prefix)
-            data = data[pos+1:]
-
-        if isend:
-            if len(data):
-                note(data.decode('utf-8'), dash=prefix)
-        else:
-            # return any remaining data so it can be included at the start of
-            # the next run
-            return data
+
+def _prepare(cmd, stdout, stderr, kwargs, tag=''):
+    # work out the stdout/stderr arguments for run() and the message used to
+    # announce the command in the log
+    def outputhandler(prefix):
+        return LineSplitter(partial(note, dash=tag + prefix))
 
     if stdout == "TTY":
         if not allowinteractive():
             raise SystemError("cmd wants interactive mode")
+        # the command's output must come after everything we've logged
+        flushlog()
 
         assert stderr is None
         stdout = None
     else:
         if stdout is None:
             prefix = "1> " if stderr is False else "&> "
-            stdout = partial(outputhandler, prefix=prefix)
+            stdout = outputhandler(prefix)
 
         if stderr is None:
-            if stdout in (False, True):
-                stderr = partial(outputhandler, prefix="2> ")
+            if stdout in (False, True, "SPOOL"):
+                stderr = outputhandler("2> ")
             else:
                 stderr = "STDOUT"
 
@@ -64,24 +46,108 @@ def execute(cmd, stdout=None, stderr=None, expectexit=0, **kwargs):
     else:
         errredir = ' 2> /dev/null' if stderr is False else ''
 
-    with note('{}$ {}{}{}'.format(kwargs.get('cwd', ''),
-                                  ' '.join(map(shlex.quote, cmd)),
-                                  outredir,
-                                  errredir)):
-        returncode, out, err = run(cmd, stdout=stdout, stderr=stderr, **kwargs)
-        if type(expectexit) is int:
-            exitok = returncode == expectexit
-        else:
-            exitok = returncode in expectexit
-        if exitok:
-            return returncode, out, err
-
-        # still need to dump the stdout/stderr if they were captured
-        if out is not None:
-            outputhandler(out, True, '1> ')
-        if err is not None:
-            outputhandler(err, True, '1> ')
-        message = "Unexpected exit code {}. Expected {}".format(
-            returncode, expectexit)
-        warn(message)
-        raise SystemError(message)
+    if kwargs.get('privileged'):
+        cmd = ['sudo'] + list(cmd)
+    message = '{}{}$ {}{}{}'.format(tag,
+                                    kwargs.get('cwd', ''),
+                                    ' '.join(map(shlex.quote, cmd)),
+                                    outredir,
+                                    errredir)
+    return message, stdout, stderr, outputhandler
+
+
+def _checkexit(result, expectexit, outputhandler):
+    returncode, out, err = result
+    if type(expectexit) is int:
+        exitok = returncode == expectexit
+    else:
+        exitok = returncode in expectexit
+    if exitok:
+        return result
+
+    # still need to dump the stdout/stderr if they were captured. Nobody
+    # else will get to see the spooled output, so it is closed here.
+    try:
+        for output in (out, err):
+            if isinstance(output, CapturedOutput):
+                splitter = outputhandler('1> ')
+                for chunk in output.chunks():
+                    splitter(chunk, False)
+                splitter(b"", True)
+            elif output is not None:
+                outputhandler('1> ')(output, True)
+    finally:
+        for output in (out, err):
+            if isinstance(output, CapturedOutput):
+                output.close()
+    _fail("Unexpected exit code {}. Expected {}".format(
+        returncode, expectexit))
+
+
+def _fail(message):
+    warn(message)
+    raise SystemError(message)
+
+
+def execute(cmd, stdout=None, stderr=None, expectexit=0, **kwargs):
+    # Executes `cmd` in a subprocess. Raises a SystemError if the exit code
+    # is different to `expecterror`, or if the subprocess is still running
+    # after `timeout` seconds.
+    #
+    # The stdout and stderr arguments for the most part work just like
+    # homely._ui.run(), with the main difference being that when stdout=None or
+    # stderr=None, these two streams will be filtered through the homely's
+    # logging functions instead of being sent directly to the python process's
+    # stdout/stderr. Also, the stderr argument will default to "STDOUT" so that
+    # the timing of the two streams is recorded more accurately.
+    #
+    # If the process absolutely _must_ talk to a TTY, you can use stdout="TTY",
+    # and a SystemError will be raised if homely is being run in
+    # non-interactive mode. When using stdout="TTY", you should omit the stderr
+    # argument.
+    message, stdout, stderr, outputhandler = _prepare(
+        cmd, stdout, stderr, kwargs)
+    with note(message):
+        try:
+            result = run(cmd, stdout=stdout, stderr=stderr, **kwargs)
+        except CommandTimeout as err:
+            _fail(str(err))
+        return _checkexit(result, expectexit, outputhandler)
+
+
+async def execute_async(cmd, stdout=None, stderr=None, expectexit=0,
+                        **kwargs):
+    # A coroutine version of execute() which accepts the same arguments.
+    # Because the output of several commands may be interleaved in the log,
+    # each line is tagged with a number which also appears next to the
+    # command.
+    tag = '[{}] '.format(next(_TAGS))
+    message, stdout, stderr, outputhandler = _prepare(
+        cmd, stdout, stderr, kwargs, tag)
+    note(message)
+    try:
+        result = await runasync(cmd, stdout=stdout, stderr=stderr, **kwargs)
+    except CommandTimeout as err:
+        _fail(tag + str(err))
+    return _checkexit(result, expectexit, outputhandler)
+
+
+def execute_many(cmds, stdout=None, stderr=None, expectexit=0, **kwargs):
+    # Executes each command in `cmds` concurrently and waits for them all to
+    # finish. The other arguments are passed to execute_async() for every
+    # command. Returns a list of (returncode, stdout, stderr) tuples in the
+    # same order as `cmds`, or raises the first error once all the commands
+    # have finished.
+    async def _gather():
+        return await asyncio.gather(
+            *[execute_async(cmd, stdout, stderr, expectexit, **kwargs)
+              for cmd in cmds],
+            return_exceptions=True,
+        )
+
+    with note("Running {} commands".format(len(cmds))):
+        results = runcoroutine(_gather())
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return results
@@ -0,0 +1,91 @@
+import json
+import os
+
+from homely._test import contents
+
+
+def test_update_writes_event_file(HOME, testrepo):
+    from homely._events import EVENTFILE, addsink, removesink
+    from homely._test import run_update_all
+
+    contents(
+        testrepo.remotepath + '/HOMELY.py',
+        """
+        from homely.files import lineinfile
+        from homely.general import section
+        from homely.system import execute
+
+        @section
+        def dirs():
+            lineinfile('~/eventfile.txt', 'hello')
+            execute(['true'])
+        """
+    )
+
+    seen = []
+    addsink(seen.append)
+    try:
+        run_update_all(pullfirst=True, cancleanup=True)
+    finally:
+        removesink(seen.append)
+
+    with open(EVENTFILE) as f:
+        events = [json.loads(line) for line in f]
+    assert [e["event"] for e in events] == [e["event"] for e in seen]
+
+    names = [e["event"] for e in events]
+    assert names[0] == "run.start"
+    assert names[-1] == "run.end"
+    assert events[-1]["result"] == "ok"
+    for name in ("repo", "pull", "section", "helper.isdone",
+                 "helper.makechanges", "process"):
+        assert name + ".start" in names
+        assert name + ".end" in names
+
+    # every span is closed with its duration
+    spans = [e for e in events if "span" in e]
+    starts = {e["span"]: e for e in spans if e["event"].endswith(".start")}
+    ends = {e["span"]: e for e in spans if e["event"].endswith(".end")}
+    assert starts.keys() == ends.keys()
+    assert all(e["duration"] >= 0 for e in ends.values())
+
+    (pull, ) = [e for e in events if e["event"] == "pull.end"]
+    assert pull["result"] == "ok"
+    (isdone, ) = [e for e in events if e["event"] == "helper.isdone.end"]
+    assert isdone["done"] is False
+    sections = [e["section"] for e in events if e["event"] == "section.end"]
+    assert "cool-testrepo:dirs()" in sections
+    processes = [e for e in events if e["event"] == "process.end"
+                 and e["cmd"] == ['true']]
+    assert processes[0]["returncode"] == 0
+
+    # the cleaner for ~/eventfile.txt runs when it is no longer wanted
+    contents(testrepo.remotepath + '/HOMELY.py', "")
+    run_update_all(pullfirst=True, cancleanup=True)
+    with open(EVENTFILE) as f:
+        events = [json.loads(line) for line in f]
+    outcomes = [e["outcome"] for e in events if e["event"] == "cleaner.end"]
+    assert outcomes == ["cleaned"]
+
+
+def test_update_cleans_up_when_event_file_fails(HOME, testrepo, monkeypatch):
+    import homely._ui
+    from homely._status import RUNFILE, readrecord
+    from homely._test import run_update_all
+    from homely._utils import RepoListConfig
+
+    def brokensink(path):
+        raise OSError("No space left on device")
+
+    contents(testrepo.remotepath + '/HOMELY.py', "")
+    monkeypatch.setattr(homely._ui, "JsonLinesSink", brokensink)
+    success = homely._ui.run_update(list(RepoListConfig().find_all()),
+                                    pullfirst=True, only=None, cancleanup=True)
+    assert not success
+    assert not os.path.exists(RUNFILE)
+    assert readrecord()["running"] is None
+
+    # the next update isn't blocked by the failed one
+    monkeypatch.undo()
+    homely._ui._NOTECOUNT.clear()
+    run_update_all(pullfirst=True, cancleanup=True)
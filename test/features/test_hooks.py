@@ -0,0 +1,80 @@
+import sys
+
+from homely._test import contents
+
+
+def test_lifecycle_hooks(HOME, testrepo):
+    from homely._hooks import register, unregister
+    from homely._test import run_update_all
+
+    contents(
+        testrepo.remotepath + '/HOMELY.py',
+        """
+        from homely.files import lineinfile
+
+        lineinfile('~/hooks.txt', 'hello')
+        """
+    )
+    contents(
+        testrepo.remotepath + '/pyproject.toml',
+        """
+        [tool.homely]
+        hooks = ["homelyhooks:Recorder"]
+        """
+    )
+    contents(
+        testrepo.remotepath + '/homelyhooks.py',
+        """
+        EVENTS = []
+
+        class Recorder:
+            def after_isdone(self, event):
+                EVENTS.append(event)
+
+            def cleaner_finish(self, event):
+                EVENTS.append(event)
+        """
+    )
+
+    class Counter:
+        def __init__(self):
+            self.events = []
+
+        def before_makechanges(self, event):
+            self.events.append(event)
+
+        def after_makechanges(self, event):
+            self.events.append(event)
+
+    counter = Counter()
+    register(counter)
+    syspath = list(sys.path)
+    try:
+        run_update_all(pullfirst=True, cancleanup=True)
+        recorded = sys.modules['homelyhooks'].EVENTS
+        # the repo is only on sys.path while the plugin is imported
+        assert sys.path == syspath
+
+        assert [e.hook for e in counter.events] == [
+            "before_makechanges", "after_makechanges"]
+        before, after = counter.events
+        assert before.duration is None
+        assert after.duration >= 0
+        assert after.outcome is True
+        assert after.description == before.description
+
+        (isdone, ) = recorded
+        assert isdone.hook == "after_isdone"
+        assert isdone.outcome is False
+        assert isdone.subject.description == isdone.description
+
+        # the cleaner's outcome is reported when ~/hooks.txt is cleaned up
+        contents(testrepo.remotepath + '/HOMELY.py', "")
+        run_update_all(pullfirst=True, cancleanup=True)
+        # the plugin is only loaded once
+        assert sys.modules['homelyhooks'].EVENTS is recorded
+        assert [(e.hook, e.outcome) for e in recorded[1:]] == [
+            ("cleaner_finish", "cleaned")]
+    finally:
+        unregister(counter)
+        sys.modules.pop('homelyhooks', None)
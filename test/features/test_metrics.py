@@ -0,0 +1,49 @@
+import os
+
+from homely._test import contents
+
+
+def test_update_writes_metrics(HOME, testrepo, tmpdir, monkeypatch):
+    from homely._test import run_update_all
+
+    promfile = os.path.join(tmpdir, 'homely.prom')
+    monkeypatch.setenv('HOMELY_METRICS_FILE', promfile)
+
+    contents(
+        testrepo.remotepath + '/HOMELY.py',
+        """
+        from homely.files import lineinfile, mkdir
+
+        mkdir('~/metrics')
+        lineinfile('~/metrics.txt', 'hello')
+        """
+    )
+    os.mkdir(os.path.join(HOME, 'metrics'))
+    run_update_all(pullfirst=True, cancleanup=True)
+
+    def samples():
+        with open(promfile) as f:
+            lines = f.read().splitlines()
+        assert all(line.startswith(('# ', 'homely_update_'))
+                   for line in lines)
+        return dict(line.rsplit(' ', 1) for line in lines
+                    if not line.startswith('#'))
+
+    metrics = samples()
+    assert float(metrics['homely_update_duration_seconds']) > 0
+    assert metrics['homely_update_status{status="ok"}'] == '1'
+    assert metrics['homely_update_status{status="failed"}'] == '0'
+    assert metrics['homely_update_helpers{result="executed"}'] == '1'
+    assert metrics['homely_update_helpers{result="done"}'] == '1'
+    assert metrics['homely_update_messages{kind="warn"}'] == '0'
+    (pull, ) = [name for name in metrics
+                if name.startswith('homely_update_pull_duration_seconds{')]
+    assert 'cool-testrepo' in pull
+    assert float(metrics[pull]) >= 0
+    assert not [name for name in os.listdir(tmpdir) if '.tmp' in name]
+
+    contents(testrepo.remotepath + '/HOMELY.py', "")
+    run_update_all(pullfirst=True, cancleanup=True)
+    metrics = samples()
+    assert metrics['homely_update_helpers{result="executed"}'] == '0'
+    assert metrics['homely_update_cleaners{outcome="cleaned"}'] == '1'
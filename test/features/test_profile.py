@@ -0,0 +1,51 @@
+import os
+import pstats
+import tracemalloc
+
+from homely._test import contents
+
+
+def test_update_profile(HOME, testrepo, tmpdir):
+    from homely._profile import allocationsummary, setprofiling
+    from homely._test import run_update_all
+
+    contents(
+        testrepo.remotepath + '/HOMELY.py',
+        """
+        from homely.general import section
+
+        def slowfunction():
+            return [str(i) for i in range(10000)]
+
+        @section
+        def busy():
+            global KEEP
+            KEEP = slowfunction()
+        """
+    )
+
+    profiledir = os.path.join(tmpdir, 'profiles')
+    setprofiling(profiledir, True)
+    try:
+        run_update_all(pullfirst=True)
+        summary = allocationsummary()
+    finally:
+        setprofiling(None, False)
+        tracemalloc.stop()
+
+    assert sorted(os.listdir(profiledir)) == [
+        'cool-testrepo_HOMELY.py.prof',
+        'cool-testrepo_busy().prof',
+    ]
+
+    # the section's time is only counted in the section's profile
+    def functions(name):
+        stats = pstats.Stats(os.path.join(profiledir, name))
+        return {func[2] for func in stats.stats}  # type: ignore
+    assert 'slowfunction' in functions('cool-testrepo_busy().prof')
+    assert 'slowfunction' not in functions('cool-testrepo_HOMELY.py.prof')
+
+    assert summary[0].startswith('cool-testrepo:busy(): +')
+    assert any(line.startswith('cool-testrepo/HOMELY.py: +')
+               for line in summary)
+    assert any('HOMELY.py:' in line for line in summary[1:])
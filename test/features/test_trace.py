@@ -0,0 +1,59 @@
+import json
+
+from homely._test import contents
+
+
+def test_update_trace(HOME, testrepo, tmpdir):
+    from homely._events import addsink, removesink
+    from homely._test import run_update_all
+    from homely._trace import TraceSink
+
+    contents(
+        testrepo.remotepath + '/HOMELY.py',
+        """
+        from homely.general import include
+        include("extra.py")
+        """
+    )
+    contents(
+        testrepo.remotepath + '/extra.py',
+        """
+        from homely.files import lineinfile
+        from homely.system import execute_many
+        lineinfile('~/tracefile.txt', 'hello')
+        execute_many([['sleep', '0.1'], ['sleep', '0.1']])
+        """
+    )
+
+    tracepath = tmpdir + '/trace.json'
+    tracer = TraceSink(tracepath)
+    addsink(tracer)
+    try:
+        run_update_all(pullfirst=True)
+    finally:
+        removesink(tracer)
+        tracer.close()
+
+    with open(tracepath) as f:
+        trace = json.load(f)
+    spans = [e for e in trace["traceEvents"] if e["ph"] == "X"]
+    bycat = {}
+    for e in spans:
+        bycat.setdefault(e["cat"], []).append(e)
+    assert set(bycat) == {"run", "repo", "pull", "section", "include",
+                          "helper.isdone", "helper.makechanges", "process"}
+    (run, ) = bycat["run"]
+    assert run["name"] == "homely update"
+    assert [e["name"] for e in bycat["include"]] == ["include extra.py"]
+
+    # everything happens inside the run
+    for e in spans:
+        assert run["ts"] <= e["ts"]
+        assert e["ts"] + e["dur"] <= run["ts"] + run["dur"] + 1000
+
+    # the concurrent subprocesses are on separate tracks
+    sleeps = [e for e in bycat["process"] if e["name"] == "sleep 0.1"]
+    assert sorted(e["tid"] for e in sleeps) == [1, 2]
+    assert all(e["args"]["returncode"] == 0 for e in sleeps)
+    tracks = [e for e in trace["traceEvents"] if e["ph"] == "M"]
+    assert {e["tid"] for e in tracks} == {e["tid"] for e in spans}
@@ -98,8 +98,10 @@ def test_homely_updatestatus(HOME, tmpdir):
     system(HOMELY('autoupdate') + ['--daemon'], expecterror=1)
 
     # remove the TIMEFILE so that homely thinks an update has never been run before
-    from homely._utils import TIMEFILE
+    # (and the status record, which will be rebuilt from the old status files)
+    from homely._utils import STATUSFILE, TIMEFILE
     os.unlink(TIMEFILE)
+    os.unlink(STATUSFILE)
 
     try:
         # we use the spinfile to make sure the next autoupdate is going to stall
@@ -133,6 +135,7 @@ def test_homely_updatestatus(HOME, tmpdir):
     system(HOMELY('autoupdate') + ['--clear'])
     # we also need to manually remove the timefile
     os.unlink(TIMEFILE)
+    os.unlink(STATUSFILE)
     try:
         contents(spinfile, "spin!")
         system(HOMELY('autoupdate') + ['--daemon'])
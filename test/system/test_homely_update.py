@@ -228,3 +228,24 @@ def test_homely_update_section_enabling(HOME, tmpdir):
     assert contents(HOME + '/file2.txt') == "two\n"
     assert not os.path.exists(HOME + '/file3.txt')  # section was not enabled
     assert contents(HOME + '/file4.txt') == "four\n"
+
+
+def test_homely_stats(HOME, tmpdir):
+    system = getsystemfn(HOME)
+
+    system(HOMELY('stats'), expecterror=1)
+
+    tr = TempRepo(tmpdir, 'stats-repo')
+    contents(tr.remotepath + '/HOMELY.py',
+             """
+             from homely.files import lineinfile
+             lineinfile('~/stats.txt', 'hello')
+             """)
+    system(HOMELY('add') + [tr.url])
+    # something else undoes the change between updates
+    os.unlink(os.path.join(HOME, 'stats.txt'))
+    system(HOMELY('update'))
+
+    output = system(HOMELY('stats'))
+    assert 'Slowest helpers' in output
+    assert '(2 runs)' in output
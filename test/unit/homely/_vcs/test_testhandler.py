@@ -0,0 +1,48 @@
+import os
+
+from homely._test import contents
+
+
+def test_testhandler_pull(tmpdir):
+    from homely._vcs.testhandler import MARKERFILE, ORIGINFILE, Repo
+
+    origin = os.path.join(tmpdir, 'origin')
+    local = os.path.join(tmpdir, 'local')
+    contents(os.path.join(origin, MARKERFILE), 'repoid', mkdir=True)
+    contents(os.path.join(origin, 'HOMELY.py'), 'print(1)\n')
+    contents(os.path.join(origin, 'same.txt'), 'unchanged\n')
+    contents(os.path.join(origin, 'gone.txt'), 'removed later\n')
+    contents(os.path.join(origin, 'sub', 'deep', 'file.txt'), 'deep\n',
+             mkdir=True)
+    contents(os.path.join(origin, 'becomesfile', 'x.txt'), 'x\n', mkdir=True)
+
+    remote = Repo.frompath('homely.test.repo://' + origin)
+    assert remote is not None
+    remote.clonetopath(local, submodules=False)
+    repo = Repo.frompath(local)
+    assert repo is not None
+    assert contents(os.path.join(local, 'sub', 'deep', 'file.txt')) == 'deep\n'
+    assert contents(os.path.join(local, ORIGINFILE)).startswith('homely.')
+
+    def ctime(*parts):
+        return os.stat(os.path.join(local, *parts)).st_ctime_ns
+
+    untouched = ctime('same.txt'), ctime('sub', 'deep', 'file.txt')
+
+    # the same size, and possibly the same mtime, but different contents
+    contents(os.path.join(origin, 'HOMELY.py'), 'print(2)\n')
+    os.unlink(os.path.join(origin, 'gone.txt'))
+    contents(os.path.join(origin, 'new.txt'), 'new\n')
+    os.unlink(os.path.join(origin, 'becomesfile', 'x.txt'))
+    os.rmdir(os.path.join(origin, 'becomesfile'))
+    contents(os.path.join(origin, 'becomesfile'), 'now a file\n')
+    repo.pullchanges()
+
+    assert sorted(os.listdir(local)) == sorted(
+        [MARKERFILE, ORIGINFILE, 'HOMELY.py', 'becomesfile', 'new.txt',
+         'same.txt', 'sub'])
+    assert contents(os.path.join(local, 'HOMELY.py')) == 'print(2)\n'
+    assert contents(os.path.join(local, 'becomesfile')) == 'now a file\n'
+    assert contents(os.path.join(local, 'new.txt')) == 'new\n'
+    # unchanged files aren't copied again
+    assert (ctime('same.txt'), ctime('sub', 'deep', 'file.txt')) == untouched
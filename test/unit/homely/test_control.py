@@ -0,0 +1,120 @@
+import os
+import stat
+import sys
+import threading
+
+from homely._test import waitfor
+
+
+def test_control_server(HOME, tmpdir):
+    from homely._control import ControlServer, request, subscribe
+    from homely._status import ROOT, UpdateStatus, editrecord
+
+    os.mkdir(ROOT)
+    path = os.path.join(tmpdir, 'control.sock')
+    startedfile = os.path.join(tmpdir, 'started')
+    stopfile = os.path.join(tmpdir, 'stop')
+    # a pretend update which keeps running until we create the stopfile
+    code = ('import os, time\n'
+            'open({0!r}, "a").write("x")\n'
+            'while not os.path.exists({1!r}):\n'
+            '    time.sleep(0.01)\n').format(startedfile, stopfile)
+    server = ControlServer(path, [sys.executable, '-c', code],
+                           pollinterval=0.01)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        # only we can connect to the socket
+        assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+
+        reply = request("status", path)
+        assert reply is not None
+        assert reply["status"] == UpdateStatus.NEVER.value
+
+        # a second daemon can't listen on the same socket
+        try:
+            ControlServer(path)
+        except OSError:
+            pass
+        else:
+            raise AssertionError("Second ControlServer should have failed")
+
+        events = subscribe(path)
+        assert next(events)["status"] == UpdateStatus.NEVER.value
+
+        # only one update is started no matter how many are requested
+        assert request("update", path) == {"ok": True, "reason": None}
+        assert request("update", path) == {
+            "ok": False, "reason": "an update is already running"}
+        for _ in waitfor("pretend update to start"):
+            if os.path.exists(startedfile):
+                break
+        with open(stopfile, 'w'):
+            pass
+        for _ in waitfor("pretend update to finish"):
+            if server._child is None:
+                break
+
+        # subscribers hear about changes to the status record
+        with editrecord() as record:
+            record["state"] = UpdateStatus.OK.value
+            record["time"] = 100.0
+        assert next(events)["status"] == UpdateStatus.OK.value
+
+        assert request("pause", path) == {"ok": True}
+        assert next(events)["status"] == UpdateStatus.PAUSED.value
+        assert request("update", path) == {
+            "ok": False, "reason": "updates are paused"}
+        assert request("unpause", path) == {"ok": True}
+        assert next(events)["status"] == UpdateStatus.OK.value
+
+        with open(startedfile) as f:
+            assert f.read() == "x"
+    finally:
+        assert request("shutdown", path) == {"ok": True}
+        thread.join()
+    assert not os.path.exists(path)
+    assert request("status", path) is None
+
+
+def test_control_server_slow_subscriber(HOME, tmpdir, monkeypatch):
+    import socket
+
+    import homely._control
+    from homely._control import ControlServer, request
+    from homely._status import ROOT
+
+    os.mkdir(ROOT)
+    path = os.path.join(tmpdir, 'control.sock')
+    monkeypatch.setattr(homely._control, 'SEND_TIMEOUT', 0.5)
+    server = ControlServer(path, [sys.executable, '-c', ''],
+                           pollinterval=0.01)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        # a subscriber which never reads what it is sent
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+        sock.sendall(b'{"op": "subscribe"}\n')
+        for _ in waitfor("subscriber to be added"):
+            if server._subscribers:
+                break
+
+        # fill up the subscriber's socket, which will hold up the broadcast
+        # until it gives up on the subscriber
+        big = {"padding": "x" * 10 * 1024 * 1024}
+        broadcast = threading.Thread(target=server._broadcast, args=(big, ))
+        broadcast.start()
+        try:
+            # the daemon still answers other clients in the meantime
+            assert request("status", path, timeout=0.25) is not None
+            assert request("ping", path, timeout=0.25) == {"ok": True}
+        finally:
+            broadcast.join()
+        for _ in waitfor("subscriber to be dropped"):
+            if not server._subscribers:
+                break
+        sock.close()
+    finally:
+        assert request("shutdown", path) == {"ok": True}
+        thread.join()
@@ -1,6 +1,8 @@
 import json
 import os
 
+import pytest
+
 from homely._test import contents, gettmpfilepath
 
 
@@ -589,3 +591,228 @@ def test_writefile_usage(tmpdir):
     e.cleanup(e.RAISE)
     del e
     assert not os.path.exists(f3)
+
+
+def test_batchedits(tmpdir):
+    from homely._engine2 import Engine
+    from homely.files import (WHERE_END, WHERE_TOP, BlockInFile, LineInFile,
+                              MakeDir, batchedits)
+
+    cfgpath = gettmpfilepath(tmpdir, '.json')
+    f1 = gettmpfilepath(tmpdir, '.txt')
+    f2 = gettmpfilepath(tmpdir, '.txt')
+    d1 = os.path.join(tmpdir, 'dir1')
+
+    def helpers(filename):
+        return [
+            LineInFile(filename, "BBB"),
+            LineInFile(filename, "CCC", WHERE_TOP),
+            BlockInFile(filename, ["DDD"], WHERE_END, "PRE", "POST"),
+            LineInFile(filename, "EEE"),
+            LineInFile(filename, "AAA"),
+        ]
+
+    # the batched edits must produce exactly the same file as running the
+    # helpers one at a time, but the file isn't touched until the batch ends
+    contents(f1, "AAA\r\n")
+    contents(f2, "AAA\r\n")
+    e = Engine(cfgpath)
+    for helper in helpers(f1):
+        e.run(helper)
+    with batchedits():
+        for helper in helpers(f2):
+            e.run(helper)
+        assert contents(f2) == "AAA\r\n"
+    assert contents(f2) == contents(f1)
+    assert contents(f2) == "CCC\r\nAAA\r\nBBB\r\nPRE\r\nDDD\r\nPOST\r\nEEE\r\n"
+    e.cleanup(e.RAISE)
+    del e
+
+    # running a helper that doesn't support batching writes out the changes
+    # first
+    e = Engine(cfgpath)
+    with batchedits():
+        for helper in helpers(f2):
+            e.run(helper)
+        e.run(LineInFile(f2, "FFF"))
+        assert contents(f2) == "CCC\r\nAAA\r\nBBB\r\nPRE\r\nDDD\r\nPOST\r\nEEE\r\n"
+        e.run(MakeDir(d1))
+        assert contents(f2) == ("CCC\r\nAAA\r\nBBB\r\nEEE\r\nPRE\r\nDDD\r\n"
+                                "POST\r\nFFF\r\n")
+    e.cleanup(e.RAISE)
+    del e
+
+    # the cleaners for the batched helpers were all recorded
+    e = Engine(cfgpath)
+    e.cleanup(e.RAISE)
+    del e
+    assert contents(f1) == "AAA\r\n"
+    assert contents(f2) == "AAA\r\n"
+    assert not os.path.exists(d1)
+
+
+def test_symlinkdir(tmpdir, HOME):
+    from homely._engine2 import Engine
+    from homely._errors import HelperError
+    from homely.files import MakeSymlinkDir
+
+    cfgpath = gettmpfilepath(tmpdir, '.json')
+    repodir = os.path.join(tmpdir, 'repo')
+    linkdir = os.path.join(tmpdir, 'links')
+    os.mkdir(repodir)
+    os.mkdir(linkdir)
+    for name in ('.aaa', '.bbb', 'ccc'):
+        contents(os.path.join(repodir, name), name)
+
+    def linkstate():
+        return {
+            name: os.readlink(os.path.join(linkdir, name))
+            for name in sorted(os.listdir(linkdir))
+        }
+
+    # a symlink the user made themselves is left alone
+    os.symlink(os.path.join(repodir, '.aaa'), os.path.join(linkdir, '.aaa'))
+
+    e = Engine(cfgpath)
+    helper = MakeSymlinkDir(repodir, linkdir)
+    assert not helper.isdone()
+    e.run(helper)
+    assert helper.isdone()
+    e.cleanup(e.RAISE)
+    del e
+    assert linkstate() == {
+        '.aaa': os.path.join(repodir, '.aaa'),
+        '.bbb': os.path.join(repodir, '.bbb'),
+        'ccc': os.path.join(repodir, 'ccc'),
+    }
+
+    # an entry removed from the repo has its symlink removed, and a new entry
+    # gets a new symlink
+    os.unlink(os.path.join(repodir, '.bbb'))
+    contents(os.path.join(repodir, 'ddd'), 'ddd')
+    e = Engine(cfgpath)
+    helper = MakeSymlinkDir(repodir, linkdir)
+    assert not helper.isdone()
+    e.run(helper)
+    e.cleanup(e.RAISE)
+    del e
+    assert sorted(linkstate()) == ['.aaa', 'ccc', 'ddd']
+
+    # symlinks that are replaced by something else are noticed
+    os.unlink(os.path.join(linkdir, 'ccc'))
+    os.symlink(os.path.join(repodir, 'ccc'), os.path.join(linkdir, 'ccc'))
+    assert not MakeSymlinkDir(repodir, linkdir).isdone()
+    os.unlink(os.path.join(linkdir, 'ccc'))
+    contents(os.path.join(linkdir, 'ccc'), 'not a symlink')
+    e = Engine(cfgpath)
+    e.run(MakeSymlinkDir(repodir, linkdir))
+    e.cleanup(e.RAISE)
+    del e
+    assert contents(os.path.join(linkdir, 'ccc')) == 'not a symlink'
+    # the file in the way is reported rather than trying again every time
+    assert MakeSymlinkDir(repodir, linkdir).isdone()
+
+    # the cleaner removes only our own symlinks
+    e = Engine(cfgpath)
+    e.cleanup(e.RAISE)
+    del e
+    assert sorted(os.listdir(linkdir)) == ['.aaa', 'ccc']
+
+    # a missing target dir gets a helpful error
+    with pytest.raises(HelperError, match="is not a directory"):
+        MakeSymlinkDir(os.path.join(tmpdir, 'missing'), linkdir)
+
+
+def test_writefile_and_copyfile(tmpdir, HOME, monkeypatch):
+    from homely._engine2 import Engine
+    from homely._utils import FactConfig
+    from homely.files import CopyFile, WriteFile
+
+    cfgpath = gettmpfilepath(tmpdir, '.json')
+    f1 = gettmpfilepath(tmpdir, '.txt')
+    src = gettmpfilepath(tmpdir, '.bin')
+    f2 = gettmpfilepath(tmpdir, '.bin')
+    with open(src, 'wb') as f:
+        f.write(bytes(range(256)) * 1000)
+
+    e = Engine(cfgpath)
+    wf = WriteFile(f1, "AAA\nBBB\n")
+    cf = CopyFile(src, f2)
+    assert not wf.isdone()
+    assert not cf.isdone()
+    e.run(wf)
+    e.run(cf)
+    assert wf.isdone()
+    assert cf.isdone()
+    e.cleanup(e.RAISE)
+    del e
+    assert contents(f1) == "AAA\nBBB\n"
+    with open(src, 'rb') as a, open(f2, 'rb') as b:
+        assert a.read() == b.read()
+
+    # a file with the same contents but a new fingerprint is still done
+    os.unlink(f1)
+    contents(f1, "AAA\nBBB\n")
+    assert WriteFile(f1, "AAA\nBBB\n").isdone()
+
+    # changes of the same size are noticed
+    contents(f1, "AAA\nCCC\n")
+    assert not WriteFile(f1, "AAA\nBBB\n").isdone()
+    with open(src, 'r+b') as f:
+        f.write(b'X')
+    assert not CopyFile(src, f2).isdone()
+    e = Engine(cfgpath)
+    e.run(WriteFile(f1, "AAA\nBBB\n"))
+    e.run(CopyFile(src, f2))
+    e.cleanup(e.RAISE)
+    del e
+    assert contents(f1) == "AAA\nBBB\n"
+    with open(f2, 'rb') as f:
+        assert f.read(2) == b'X\x01'
+
+    # the files homely created are removed when they are no longer wanted,
+    # and so are their fingerprints
+    assert set(FactConfig().jsondata) == {wf._factname, cf._factname}
+    e = Engine(cfgpath)
+    e.cleanup(e.RAISE)
+    del e
+    assert not os.path.exists(f1)
+    assert not os.path.exists(f2)
+    assert FactConfig().jsondata == {}
+
+    # facts.json is written once per cleanup, not once per helper
+    writes = []
+    monkeypatch.setattr(FactConfig, 'writejson',
+                        lambda self: writes.append(dict(self.jsondata)))
+    e = Engine(cfgpath)
+    for i in range(10):
+        e.run(WriteFile(os.path.join(tmpdir, 'many%d.txt' % i), "x"))
+    assert writes == []
+    e.cleanup(e.RAISE)
+    del e
+    assert len(writes) == 1
+    assert len(writes[0]) == 10
+
+
+def test_cleanup_stress(HOME):
+    from homely._test.cleanup import (checkinvariants, forget, generate,
+                                      runcleanup)
+
+    root = os.path.join(HOME, 'stress')
+    os.mkdir(root)
+    state = generate(root, depth=4, fanout=2, files=2, packages=6,
+                     keepevery=3)
+    assert state.parents and state.claimed
+
+    engine, _ = runcleanup(state)
+    assert checkinvariants(state, engine) == []
+
+    # cleaning up again changes nothing
+    engine, _ = runcleanup(state)
+    assert checkinvariants(state, engine) == []
+
+    # the postponed directories are removed once nothing wants them
+    forget(state)
+    engine, _ = runcleanup(state)
+    assert checkinvariants(state, engine) == []
+    assert os.listdir(root) == ['engine2.json']
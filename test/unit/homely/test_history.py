@@ -0,0 +1,124 @@
+import json
+import os
+
+from homely._test import contents
+
+
+def test_update_history(HOME, testrepo):
+    from homely._history import HISTORYFILE, neverdone, readhistory
+    from homely._test import run_update_all
+
+    contents(
+        testrepo.remotepath + '/HOMELY.py',
+        """
+        from homely.files import lineinfile
+        from homely.general import section
+        from homely.system import execute
+
+        @section
+        def first():
+            lineinfile('~/history.txt', 'hello')
+            execute(['true'])
+        """
+    )
+    run_update_all(pullfirst=True, cancleanup=True)
+    # something else undoes our change between updates
+    os.unlink(os.path.join(HOME, 'history.txt'))
+    run_update_all(pullfirst=True, cancleanup=True)
+
+    history = readhistory(HISTORYFILE)
+    assert len(history) == 2
+    record = history[-1]
+    assert record["result"] == "ok"
+    assert record["full"] is True
+    assert record["duration"] > 0
+    assert "cool-testrepo:first()" in record["sections"]
+    assert record["processes"]["other"] == 1
+    (helper, ) = record["notdone"]
+    assert [h for h, _ in record["slowest"]] == [helper]
+    assert neverdone(history) == [(helper, 2)]
+
+    # once the helper is done it is no longer reported
+    run_update_all(pullfirst=True, cancleanup=True)
+    assert neverdone(readhistory(HISTORYFILE)) == []
+
+
+def test_history_eviction(tmpdir):
+    from homely._history import readhistory, saverun
+
+    path = os.path.join(tmpdir, 'history.jsonl')
+    for i in range(5):
+        saverun({"n": i}, path, limit=3)
+    assert readhistory(path) == [{"n": 2}, {"n": 3}, {"n": 4}]
+
+    # a damaged line doesn't lose the rest of the history
+    with open(path, 'a') as f:
+        f.write('{"n": \n')
+    saverun({"n": 5}, path, limit=3)
+    assert readhistory(path) == [{"n": 3}, {"n": 4}, {"n": 5}]
+
+    saverun({"n": 6}, path, limit=0)
+    assert readhistory(path) == []
+
+
+def test_history_size(monkeypatch):
+    from homely._history import DEFAULT_HISTORY_SIZE, _historysize
+
+    for value, expected in [("10", 10),
+                            ("0", 1),
+                            ("-5", 1),
+                            ("abc", DEFAULT_HISTORY_SIZE)]:
+        monkeypatch.setenv("HOMELY_HISTORY_SIZE", value)
+        assert _historysize() == expected
+    monkeypatch.delenv("HOMELY_HISTORY_SIZE")
+    assert _historysize() == DEFAULT_HISTORY_SIZE
+
+
+def test_history_helpers():
+    from homely._history import (HISTORY_HELPERS, HistorySink, neverdone,
+                                 slowesthelpers)
+
+    # only a bounded number of helpers is kept, however many there are
+    sink = HistorySink()
+    for i in range(HISTORY_HELPERS * 10):
+        sink({"event": "helper.isdone.end", "helper": "helper %d" % i,
+              "duration": i / 1000, "done": i % 2 == 0})
+    record = sink.finish()
+    assert len(record["slowest"]) == HISTORY_HELPERS
+    assert record["slowest"][0] == ["helper %d" % (HISTORY_HELPERS * 10 - 1),
+                                    (HISTORY_HELPERS * 10 - 1) / 1000]
+    assert len(record["notdone"]) == HISTORY_HELPERS
+    assert all(int(h.split()[1]) % 2 == 1 for h in record["notdone"])
+    assert len(json.dumps(record)) < HISTORY_HELPERS * 100
+
+    # helpers are only reported while they keep needing changes
+    def run(*notdone):
+        return {"slowest": [[h, 1.0] for h in notdone],
+                "notdone": list(notdone)}
+
+    history = [run("a", "b"), run("a", "b", "c"), run("a", "c")]
+    assert neverdone(history) == [("a", 3), ("c", 2)]
+    history.append(run("b"))
+    assert neverdone(history) == []
+    assert slowesthelpers(history, 2) == [("a", 1.0), ("b", 1.0)]
+
+
+def test_history_stats():
+    from homely._history import regressions, slowestsections
+
+    def run(duration, **sections):
+        return {"duration": duration, "full": True, "sections": sections,
+                "slowest": [], "notdone": []}
+
+    history = [
+        run(2.0, a=1.0, b=0.1),
+        run(2.2, a=1.2, b=0.1),
+        run(1.8, a=0.8, b=0.1),
+    ]
+    assert slowestsections(history, 1) == [("a", 1.0)]
+    assert regressions(history) == []
+
+    # b is 50% slower, but by too little to matter
+    history.append(run(5.0, a=3.0, b=0.15))
+    assert regressions(history) == [("<update>", 5.0, 2.0), ("a", 3.0, 1.0)]
+    assert slowestsections(history, 5) == [("a", 1.1), ("b", 0.1)]
@@ -0,0 +1,193 @@
+import os
+import subprocess
+import sys
+
+
+def test_status_imports():
+    # homely._status must stay fast to import, so it must only use the
+    # standard library
+    code = '\n'.join([
+        'import sys',
+        'before = set(sys.modules)',
+        'import homely._status',
+        'new = set(sys.modules) - before',
+        'print(" ".join(sorted(new)))',
+    ])
+    out = subprocess.check_output([sys.executable, '-c', code], text=True)
+    new = out.split()
+    assert sorted(m for m in new if m.startswith('homely')) == [
+        'homely', 'homely._status']
+    thirdparty = [
+        m for m in new
+        if not m.startswith('homely')
+        and m.split('.')[0] not in sys.stdlib_module_names
+    ]
+    assert thirdparty == []
+
+
+def test_updatestatus_fastpath(HOME):
+    from homely._status import (FAILFILE, PAUSEFILE, ROOT, STATUSCODES,
+                                TIMEFILE, UpdateStatus)
+
+    def fastpath():
+        cmd = [sys.executable, '-c',
+               'from homely._status import entrypoint; entrypoint()',
+               'updatestatus']
+        return subprocess.call(cmd)
+
+    os.mkdir(ROOT)
+    assert fastpath() == STATUSCODES[UpdateStatus.NEVER]
+    with open(TIMEFILE, 'w') as f:
+        f.write('12:00')
+    assert fastpath() == STATUSCODES[UpdateStatus.OK]
+    with open(FAILFILE, 'w') as f:
+        f.write(UpdateStatus.NOCONN.value)
+    assert fastpath() == STATUSCODES[UpdateStatus.NOCONN]
+    with open(PAUSEFILE, 'w') as f:
+        pass
+    assert fastpath() == STATUSCODES[UpdateStatus.PAUSED]
+
+
+def test_progress_interval(HOME, monkeypatch):
+    from homely._status import (DEFAULT_PROGRESS_INTERVAL, ROOT, STATUSCODES,
+                                UpdateStatus, _progressinterval)
+
+    for value, expected in [("2", 2.0),
+                            ("0", 0.0),
+                            ("-1", 0.0),
+                            ("nan", DEFAULT_PROGRESS_INTERVAL),
+                            ("fast", DEFAULT_PROGRESS_INTERVAL)]:
+        monkeypatch.setenv("HOMELY_PROGRESS_INTERVAL", value)
+        assert _progressinterval() == expected
+
+    # the fast path still works
+    os.mkdir(ROOT)
+    cmd = [sys.executable, '-c',
+           'from homely._status import entrypoint; entrypoint()',
+           'updatestatus']
+    assert subprocess.call(cmd) == STATUSCODES[UpdateStatus.NEVER]
+
+
+def test_status_record(HOME):
+    from homely._status import (FAILFILE, ROOT, STATUSFILE, TIMEFILE,
+                                UpdateStatus, editrecord, getstatus,
+                                readrecord)
+
+    os.mkdir(ROOT)
+    assert getstatus() == (UpdateStatus.NEVER, None, None)
+
+    # without a status record, the old status files are used
+    with open(TIMEFILE, 'w') as f:
+        f.write('12:00')
+    with open(FAILFILE, 'w') as f:
+        f.write(UpdateStatus.DIRTY.value)
+    mtime = os.stat(TIMEFILE).st_mtime
+    assert getstatus() == (UpdateStatus.DIRTY, mtime, None)
+
+    # the first change to the record starts from the old status files
+    with editrecord() as record:
+        record["running"] = {"pid": os.getpid(), "started": 100.0,
+                             "section": "repo1", "done": 1, "total": 2}
+    assert os.path.exists(STATUSFILE)
+    assert getstatus() == (UpdateStatus.RUNNING, 100.0, "repo1")
+    assert readrecord()["running"]["done"] == 1
+
+    # after that the old status files are ignored
+    os.unlink(TIMEFILE)
+    os.unlink(FAILFILE)
+    with editrecord() as record:
+        record["running"] = None
+        record["paused"] = True
+    assert getstatus() == (UpdateStatus.PAUSED, None, None)
+    with editrecord() as record:
+        record["paused"] = False
+    assert getstatus() == (UpdateStatus.DIRTY, mtime, None)
+    assert not [n for n in os.listdir(ROOT) if n.endswith('.new')]
+
+
+def test_progress_reporter(HOME):
+    from homely._status import (ROOT, SECTIONFILE, STATUSCODES,
+                                ProgressReporter, UpdateStatus,
+                                describeprogress, editrecord, readrecord)
+
+    os.mkdir(ROOT)
+    progress = ProgressReporter(2, interval=60)
+    running = readrecord()["running"]
+    assert running["section"] == "<preparing>"
+    assert running["total"] == 2
+    assert running["eta"] is None
+
+    # changes are held back until the interval has passed ...
+    progress.setsection("repo1")
+    progress.helperstarted()
+    progress.helperstarted()
+    progress.repodone()
+    assert readrecord()["running"]["section"] == "<preparing>"
+    # ... or until they are flushed
+    progress.flush()
+    running = readrecord()["running"]
+    assert (running["section"], running["helper"], running["done"]) == (
+        "repo1", 2, 1)
+    with open(SECTIONFILE) as f:
+        assert f.read() == "repo1"
+
+    with editrecord() as record:
+        progress.finish(record, complete=True)
+    record = readrecord()
+    assert record["running"] is None
+    assert record["lastrun"]["helpers"] == 2
+
+    # the next update can estimate when it will finish
+    progress = ProgressReporter(2, interval=0)
+    progress.helperstarted()
+    running = readrecord()["running"]
+    assert running["helpers"] == 2
+    assert running["eta"] is not None
+    assert describeprogress(running).startswith("1/2 ETA ")
+
+    cmd = [sys.executable, '-c',
+           'from homely._status import entrypoint; entrypoint()',
+           'updatestatus', '--progress']
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    assert result.returncode == STATUSCODES[UpdateStatus.RUNNING]
+    assert result.stdout.startswith("<preparing> 1/2 ETA ")
+
+
+def test_interrupted_update(HOME, testrepo, monkeypatch):
+    import functools
+    import threading
+
+    import homely._ui
+    from homely._status import RUNFILE, ProgressReporter, readrecord
+    from homely._test import contents
+    from homely._utils import RepoListConfig
+
+    # hold back every change the update makes to its progress
+    monkeypatch.setattr(homely._ui, "ProgressReporter",
+                        functools.partial(ProgressReporter, interval=60))
+    contents(
+        testrepo.remotepath + '/HOMELY.py',
+        """
+        from homely.files import lineinfile
+
+        lineinfile('~/interrupted.txt', 'hello')
+        raise KeyboardInterrupt()
+        """
+    )
+
+    interrupted = []
+
+    def update():
+        try:
+            homely._ui.run_update(list(RepoListConfig().find_all()),
+                                  pullfirst=True, only=None, cancleanup=True)
+        except KeyboardInterrupt:
+            interrupted.append(True)
+
+    thread = threading.Thread(target=update, daemon=True)
+    thread.start()
+    thread.join(10)
+    assert not thread.is_alive(), "the interrupted update is stuck"
+    assert interrupted == [True]
+    assert not os.path.exists(RUNFILE)
+    assert readrecord()["running"] is None
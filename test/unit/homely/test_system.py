@@ -0,0 +1,189 @@
+import io
+import os
+import re
+import sys
+
+import pytest
+
+
+def test_execute_many(tmpdir, HOME):
+    from homely._asyncioutils import getloop
+    from homely._engine2 import resetengine
+    from homely._ui import setstreams
+    from homely.system import execute, execute_many
+
+    out = io.StringIO()
+    setstreams(out, out)
+
+    # the same event loop is used for every execute()
+    execute(['echo', 'one'])
+    loop = getloop()
+    execute(['echo', 'two'])
+    assert getloop() is loop
+
+    # commands are run concurrently: each one waits for the next one to
+    # create its flag file
+    flags = [os.path.join(tmpdir, 'flag{}'.format(i)) for i in range(3)]
+    cmds = []
+    for i, flag in enumerate(flags):
+        nextflag = flags[(i + 1) % len(flags)]
+        cmds.append(['sh', '-c',
+                     'touch {}; while [ ! -e {} ]; do sleep 0.01; done; '
+                     'echo done {}'.format(flag, nextflag, i)])
+    results = execute_many(cmds, stdout=True)
+    assert [r[1] for r in results] == [b'done 0\n', b'done 1\n', b'done 2\n']
+
+    # each line of output is tagged with its command
+    execute_many([['echo', 'aaa'], ['echo', 'bbb']])
+    log = out.getvalue()
+    for word in ('aaa', 'bbb'):
+        tag = re.search(r'(\[\d+\]) \$ echo ' + word, log).group(1)
+        assert '{} &> {}'.format(tag, word) in log
+
+    # all the commands are finished before an error is raised
+    marker = os.path.join(tmpdir, 'marker')
+    with pytest.raises(SystemError):
+        execute_many([['false'],
+                      ['sh', '-c', 'sleep 0.1; touch {}'.format(marker)]])
+    assert os.path.exists(marker)
+
+    # the engine closes the loop
+    resetengine()
+    assert loop.is_closed()
+
+
+def test_scheduler(tmpdir, HOME):
+    import time
+
+    from homely._errors import CommandTimeout
+    from homely._scheduler import (CAT_COMPILE, CAT_GIT, CAT_OTHER,
+                                   CAT_PACKAGES, categorize, getscheduler)
+    from homely._ui import setstreams
+    from homely._utils import run
+    from homely.system import execute, execute_many
+
+    out = io.StringIO()
+    setstreams(out, out)
+
+    assert categorize(['/usr/bin/git', 'pull']) == CAT_GIT
+    assert categorize(['python3', '-m', 'pip', 'install']) == CAT_PACKAGES
+    assert categorize(['make', '-j4']) == CAT_COMPILE
+    assert categorize(['echo']) == CAT_OTHER
+
+    scheduler = getscheduler()
+    scheduler.accounts.clear()
+
+    # every command is accounted for, including its cpu time
+    run(['true'])
+    run([sys.executable, '-c', 'sum(range(2000000))'], stdout=False)
+    execute(['sh', '-c', 'exit 3'], expectexit=3)
+    account = scheduler.accounts[CAT_OTHER]
+    assert account.count == 3
+    assert account.failed == 1
+    assert account.utime + account.stime > 0
+    assert account.maxrss > 0
+
+    # commands that take too long are killed
+    start = time.monotonic()
+    with pytest.raises(CommandTimeout):
+        run(['sleep', '5'], timeout=0.2)
+    with pytest.raises(SystemError):
+        execute(['sleep', '5'], timeout=0.2)
+    with pytest.raises(SystemError):
+        execute_many([['sleep', '5']], timeout=0.2)
+    assert time.monotonic() - start < 3
+    assert account.timeouts == 3
+
+    # commands in a limited category don't run at the same time
+    scheduler.setlimit(CAT_PACKAGES, 1)
+    log = os.path.join(tmpdir, 'log')
+    script = 'echo start >> {0}; sleep 0.1; echo stop >> {0}'.format(log)
+    execute_many([['sh', '-c', script]] * 3, category=CAT_PACKAGES)
+    with open(log) as f:
+        assert f.read().split() == ['start', 'stop'] * 3
+    assert scheduler.accounts[CAT_PACKAGES].count == 3
+
+    assert len(scheduler.summary()) == 3
+
+
+def test_privileged_worker(tmpdir, HOME):
+    import subprocess
+
+    import homely._privileged
+    from homely._asyncioutils import runcoroutine
+    from homely._errors import HelperError
+    from homely._privileged import PrivilegedWorker
+    from homely._ui import setstreams
+    from homely._utils import LineSplitter, runasync
+
+    out = io.StringIO()
+    setstreams(out, out)
+
+    # NOTE: the worker is started without sudo so that we can test it
+    worker = PrivilegedWorker(launcher=())
+    try:
+        # commands run in the worker, but their output arrives in our pipes
+        proc = worker.spawn(['sh', '-c', 'pwd; echo oops >&2; exit 3'],
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT,
+                            cwd=str(tmpdir))
+        assert proc.wait() == 3
+        assert proc.stdout.read() == (str(tmpdir) + "\noops\n").encode()
+        assert proc.rusage is not None
+        proc.stdout.close()
+
+        with pytest.raises(FileNotFoundError):
+            worker.spawn(['/does/not/exist'])
+
+        proc = worker.spawn(['sleep', '10'], stdout=subprocess.DEVNULL)
+        proc.kill()
+        assert proc.wait(timeout=5) != 0
+
+        # several commands can run at once
+        procs = [worker.spawn(['sleep', '0.2']) for _ in range(5)]
+        assert [p.wait(timeout=2) for p in procs] == [0] * 5
+
+        # the scheduler can send commands to the worker
+        lines = []
+        homely._privileged._WORKER = worker
+        result = runcoroutine(runasync(['echo', 'hello'], privileged=True,
+                                       stdout=LineSplitter(lines.append)))
+        assert result[0] == 0
+        assert lines == ['hello']
+
+        # stdin and env are passed on, but other Popen() arguments aren't
+        lines.clear()
+        with open(os.path.join(tmpdir, 'input.txt'), 'w') as f:
+            f.write('from stdin\n')
+        with open(os.path.join(tmpdir, 'input.txt')) as f:
+            result = runcoroutine(runasync(
+                ['sh', '-c', 'cat; echo $HOMELY_TEST'], privileged=True,
+                stdin=f, env={'HOMELY_TEST': 'from env'},
+                stdout=LineSplitter(lines.append)))
+        assert result[0] == 0
+        assert lines == ['from stdin', 'from env']
+        with pytest.raises(HelperError, match="start_new_session="):
+            runcoroutine(runasync(['true'], privileged=True,
+                                  start_new_session=True))
+    finally:
+        homely._privileged._WORKER = None
+        worker.close()
+    assert worker._proc.returncode == 0
+
+
+def test_checkexit_closes_spooled_output(HOME):
+    from homely._ui import setstreams
+    from homely._utils import CapturedOutput
+    from homely.system import _checkexit
+
+    setstreams(io.StringIO(), io.StringIO())
+
+    dumped = []
+    out = CapturedOutput()
+    out(b"some output\n", False)
+    with pytest.raises(SystemError, match="Unexpected exit code 3"):
+        _checkexit((3, out, None), 0,
+                   lambda prefix: lambda data, isend: dumped.append(data))
+    assert b"".join(dumped) == b"some output\n"
+    # the output was dumped, and the spool's temp file was closed
+    assert out._file.closed
@@ -0,0 +1,62 @@
+import io
+import os
+import re
+
+
+def test_buffered_log(HOME):
+    import homely._ui
+    from homely._ui import (LEVEL_NOTE, LEVEL_WARN, flushlog, head, note,
+                            setbuffered, setloglevel, setstreams, warn)
+
+    out = io.StringIO()
+    err = io.StringIO()
+    setstreams(out, err)
+    homely._ui._NOTECOUNT.clear()
+    setbuffered(True)
+    try:
+        with head("Heading"):
+            note("First")
+            with note("Second"):
+                warn("Oops")
+                note("Third", dash="> ")
+        flushlog()
+
+        lines = [re.sub(r'^\[[^]]+\] ', '', line)
+                 for line in out.getvalue().splitlines()]
+        assert lines == [
+            "::: Heading",
+            "    - First",
+            "    - Second",
+            "      > Third",
+        ]
+        assert re.sub(r'^\[[^]]+\] ', '', err.getvalue()) == "ERR     Oops\n"
+
+        # messages below the log level are dropped but still counted
+        setloglevel(LEVEL_WARN)
+        note("Hidden")
+        warn("Shown")
+        flushlog()
+        assert "Hidden" not in out.getvalue()
+        assert "Shown" in err.getvalue()
+        assert homely._ui._NOTECOUNT == {'head': 1, 'note': 4, 'warn': 2}
+    finally:
+        setloglevel(LEVEL_NOTE)
+        setbuffered(False)
+
+
+def test_bad_environment(HOME):
+    import subprocess
+    import sys
+
+    # bad environment variables are reported, but don't stop homely from
+    # working
+    env = dict(os.environ, HOME=HOME, HOMELY_LOGLEVEL='debug',
+               HOMELY_FSYNC='always')
+    proc = subprocess.run([sys.executable, '-m', 'homely._cli', '--help'],
+                          env=env, capture_output=True, text=True)
+    assert proc.returncode == 0
+    assert "Usage:" in proc.stdout
+    assert proc.stderr == (
+        "WARNING: Invalid $HOMELY_LOGLEVEL 'debug', using 'note'\n"
+        "WARNING: Invalid $HOMELY_FSYNC 'always', using 'file'\n")
+
@@ -21,6 +21,12 @@ def test_paths(tmpdir, HOME):
     assert isnecessarypath(d1, l1s)
     assert not isnecessarypath(d1, l1)
 
+    # a sibling whose name matches part of a deeper path isn't necessary
+    d2 = os.path.join(tmpdir, 'dir2')
+    os.makedirs(os.path.join(d1s, 'dir2'))
+    assert not isnecessarypath(d2, os.path.join(d1, 'dir2'))
+    assert not isnecessarypath(d2, os.path.join(d1s, 'dir2'))
+
 
 fixed = [
     'http://www.foo.com/foo.txt',
@@ -127,3 +133,168 @@ def test_time_interval_to_delta():
     # ordinary integers are not allowed, but it raises a TypeError instead
     with pytest.raises(TypeError):
         _time_interval_to_delta(5)
+
+
+def test_textfile_cache(tmpdir, HOME):
+    from homely._test import contents
+    from homely._utils import TextFile, filereplacer
+
+    f1 = os.path.join(tmpdir, 'f1.txt')
+
+    # missing files have no lines
+    assert TextFile.load(f1).lines is None
+    assert TextFile.load(f1).positions('AAA') == []
+
+    contents(f1, "AAA\r\nBBB\r\nAAA\r\n")
+    first = TextFile.load(f1)
+    assert first.lines == ["AAA", "BBB", "AAA"]
+    assert first.NL == "\r\n"
+    assert first.positions("AAA") == [0, 2]
+    assert first.positions("CCC") == []
+
+    # the file isn't parsed again while it is unchanged
+    assert TextFile.load(f1) is first
+
+    # a copy can be modified without affecting the cached version
+    second = first.copy()
+    second.lines = ["CCC"]
+    assert second.positions("CCC") == [0]
+    assert TextFile.load(f1).positions("CCC") == []
+
+    # writing the file with filereplacer() invalidates the cache
+    with filereplacer(f1) as (tmp, origlines, NL):
+        tmp.write("CCC" + NL)
+    third = TextFile.load(f1)
+    assert third is not first
+    assert third.lines == ["CCC"]
+
+    # so does changing the file by other means
+    contents(f1, "DDDDD\n")
+    assert TextFile.load(f1).lines == ["DDDDD"]
+
+
+def test_filereplacer(tmpdir, HOME):
+    import stat
+
+    from homely._test import contents
+    from homely._utils import (FSYNC_DIR, FSYNC_NONE, NoChangesNeeded,
+                               filereplacer)
+
+    d1 = os.path.join(tmpdir, 'd1')
+    d2 = os.path.join(tmpdir, 'd2')
+    os.mkdir(d1)
+    os.mkdir(d2)
+    f1 = os.path.join(d1, 'same.txt')
+    f2 = os.path.join(d2, 'same.txt')
+    contents(f1, "AAA\r\n")
+    os.chmod(f1, 0o640)
+    inode = os.stat(f1).st_ino
+
+    # files with the same basename can be replaced at the same time
+    with filereplacer(f1) as (tmp1, orig1, NL1), \
+            filereplacer(f2, FSYNC_DIR) as (tmp2, orig2, NL2):
+        assert orig2 is None and NL2 == "\n"
+        for line in orig1:
+            tmp1.write(line + "!" + NL1)
+            tmp2.write(line + "?" + NL2)
+        # the temp files are created next to the files they will replace
+        assert len(os.listdir(d1)) == 2
+        assert len(os.listdir(d2)) == 1
+    assert contents(f1) == "AAA!\r\n"
+    assert contents(f2) == "AAA?\n"
+    # the original file was replaced, but its permissions were kept
+    assert os.stat(f1).st_ino != inode
+    assert stat.S_IMODE(os.stat(f1).st_mode) == 0o640
+    assert os.listdir(d1) == ['same.txt']
+    assert os.listdir(d2) == ['same.txt']
+
+    # the original file is left alone when the block raises an exception, or
+    # when no changes are needed
+    with pytest.raises(ValueError):
+        with filereplacer(f1, FSYNC_NONE) as (tmp, orig, NL):
+            tmp.write("BBB")
+            raise ValueError()
+    with filereplacer(f1) as (tmp, orig, NL):
+        tmp.write("BBB")
+        raise NoChangesNeeded()
+    assert contents(f1) == "AAA!\r\n"
+    assert os.listdir(d1) == ['same.txt']
+
+    # new files get the permissions open() would give them, and finding the
+    # umask doesn't change it
+    f3 = os.path.join(d1, 'new.txt')
+    oldmask = os.umask(0o027)
+    try:
+        with filereplacer(f3) as (tmp, orig, NL):
+            assert os.umask(0o027) == 0o027
+            tmp.write("CCC")
+    finally:
+        os.umask(oldmask)
+    assert stat.S_IMODE(os.stat(f3).st_mode) == 0o640
+
+
+def test_bad_fsync(HOME, tmpdir, monkeypatch):
+    from homely._utils import FSYNC_FILE, filereplacer, getdurability
+
+    monkeypatch.setenv("HOMELY_FSYNC", "always")
+    assert getdurability() == FSYNC_FILE
+    path = os.path.join(tmpdir, 'file.txt')
+    with filereplacer(path) as (tmp, orig, NL):
+        tmp.write("hello")
+    with open(path) as f:
+        assert f.read() == "hello"
+
+
+def test_linesplitter():
+    from homely._utils import LineSplitter, run
+
+    lines = []
+    splitter = LineSplitter(lines.append)
+    # a multi-byte character split across chunks is decoded intact
+    data = "AAA\nBéB\n\nCC☃C".encode('utf-8')
+    for i in range(len(data)):
+        splitter(data[i:i + 1], False)
+    splitter(b"", True)
+    assert lines == ["AAA", "BéB", "", "CC☃C"]
+
+    lines.clear()
+    splitter(b"DDD\nEEE\n", True)
+    assert lines == ["DDD", "EEE"]
+
+    # filters receive streamed output from run()
+    lines.clear()
+    cmd = ['sh', '-c', 'echo one; printf "two\\nthree"; echo four >&2']
+    exitcode, out, err = run(cmd, stdout=LineSplitter(lines.append),
+                             stderr=LineSplitter(lines.append))
+    assert exitcode == 0
+    assert out is None and err is None
+    assert sorted(lines) == ["four", "one", "three", "two"]
+
+
+def test_spooled_output():
+    from homely._utils import CapturedOutput, run
+
+    # small outputs stay in memory
+    script = 'printf "one\\ntwo\\n\\nthree"'
+    exitcode, out, err = run(['sh', '-c', script], stdout="SPOOL")
+    assert exitcode == 0
+    assert err is None
+    with out:
+        assert isinstance(out, CapturedOutput)
+        assert list(out.lines()) == ["one", "two", "", "three"]
+        assert out.read() == b"one\ntwo\n\nthree"
+        assert out.mmap()[0:3] == b"one"
+
+    # large outputs are moved to disk
+    exitcode, out, err = run(['seq', '200000'], stdout="SPOOL",
+                             stderr="SPOOL")
+    with out, err:
+        assert out.size > 1024 * 1024
+        assert out._file._rolled
+        assert err.size == 0 and err.mmap() == b""
+        lines = out.lines()
+        assert next(lines) == "1"
+        assert sum(1 for _ in lines) == 199999
+        buf = out.mmap()
+        assert buf[-7:] == b"200000\n"
+        assert b"".join(out.chunks()) == buf[:]